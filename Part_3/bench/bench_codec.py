@@ -0,0 +1,159 @@
+"""
+Benchmark of the v1 and v2 framings of the control connection.
+
+First measures the codecs alone: a LIST_USERS reply of many users is
+encoded with each framing and decoded with client.FramedReader (v1,
+NUL-terminated decimal strings) and client.FrameReader (v2, length-prefixed
+fields and 32-bit integers). Then measures the round trip against a local
+server: full LIST_USERS replies and pipelined LOOKUP_USER requests over a
+v1 session and over a v2 session.
+
+Usage: python3 bench_codec.py [--users 50000] [--rounds 20] [--lookups 20000]
+                              [--server-bin ../server] [-p 9950]
+"""
+import argparse
+import os
+import struct
+import time
+
+from common import start_server, open_session, pipeline, client
+
+
+# Socket that returns a byte string in chunks, to decode without a server
+class BytesSocket:
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def recv(self, size):
+        chunk = bytes(self._view[self._pos:self._pos + size])
+        self._pos += len(chunk)
+        return chunk
+
+
+def encode_v1(users):
+    fields = [str(len(users)).encode()]
+    for name, ip, port in users:
+        fields += [name.encode(), ip.encode(), str(port).encode()]
+    return b'\0'.join(fields) + b'\0'
+
+
+def encode_v2(users):
+    string = struct.Struct('>I')
+    integer = struct.Struct('>i')
+    out = [integer.pack(len(users))]
+    for name, ip, port in users:
+        for value in (name.encode(), ip.encode()):
+            out += [string.pack(len(value)), value]
+        out.append(integer.pack(port))
+    return b''.join(out)
+
+
+def decode(reader):
+    return [(reader.read_string(), reader.read_string(), reader.read_int())
+            for _ in range(reader.read_int())]
+
+
+def codec(users, rounds):
+    payloads = {1: encode_v1(users), 2: encode_v2(users)}
+    readers = {1: lambda data: client.FramedReader(BytesSocket(data)),
+               2: client.FrameReader}
+    print(f"Codec, LIST_USERS reply of {len(users)} users")
+    for version in (1, 2):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            payloads[version] = (encode_v1 if version == 1 else encode_v2)(users)
+        encode_time = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decoded = decode(readers[version](payloads[version]))
+        decode_time = (time.perf_counter() - start) / rounds
+        assert decoded == users, f"v{version} decoded different users"
+        size = len(payloads[version])
+        print(f"  v{version} {size:10d} bytes   encode {encode_time * 1000:7.1f} ms   "
+              f"decode {decode_time * 1000:7.1f} ms   {size / decode_time / (1 << 20):7.1f} MB/s")
+
+
+# Function to get the full list with LIST_USERS over a control connection
+def list_users(conn, username):
+    conn.send_string("LIST_USERS")
+    conn.send_string("bench")
+    conn.send_string(username)
+    reader = conn.read_reply()
+    reader.read_byte()
+    return decode(reader)
+
+
+# Function to resolve users with LOOKUP_USER keeping up to window requests
+# in flight. Returns their ports.
+def lookup_users(conn, username, remote_users, window=64):
+    ports = []
+    in_flight = 0
+    for remote_user in remote_users:
+        conn.send_string("LOOKUP_USER")
+        conn.send_string("bench")
+        conn.send_string(username)
+        conn.send_string(remote_user)
+        conn.flush()
+        in_flight += 1
+        if in_flight == window:
+            ports.append(read_address(conn))
+            in_flight -= 1
+    ports.extend(read_address(conn) for _ in range(in_flight))
+    return ports
+
+
+def read_address(conn):
+    reader = conn.read_reply()
+    if reader.read_byte() != 0:
+        return None
+    reader.read_string()
+    return reader.read_int()
+
+
+def round_trip(port, names, rounds, lookups):
+    print(f"Server round trip, {len(names)} connected users")
+    for version in (1, 2):
+        conn = open_session('127.0.0.1', port, version)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            users = list_users(conn, names[0])
+        list_time = (time.perf_counter() - start) / rounds
+        assert len(users) == len(names), f"v{version} listed {len(users)} users"
+
+        start = time.perf_counter()
+        ports = lookup_users(conn, names[0], (names[i % len(names)] for i in range(lookups)))
+        lookup_time = time.perf_counter() - start
+        assert ports == [40000] * lookups, f"v{version} lookups failed"
+        conn.sock.close()
+        print(f"  v{version} LIST_USERS {list_time * 1000:8.1f} ms   "
+              f"LOOKUP_USER {lookups / lookup_time:9.0f} ops/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000, help='Users in the list')
+    parser.add_argument('--rounds', type=int, default=20, help='Lists encoded/decoded per framing')
+    parser.add_argument('--lookups', type=int, default=20000, help='Pipelined LOOKUP_USER per framing')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9950, help='Local server port')
+    args = parser.parse_args()
+
+    names = [f"bench{os.getpid()}_{i}" for i in range(args.users)]
+    codec([(name, '127.0.0.1', 40000 + i % 20000) for i, name in enumerate(names)], args.rounds)
+
+    kwargs = {'binary': args.server_bin} if args.server_bin else {}
+    proc = start_server(args.p, **kwargs)
+    try:
+        conn = open_session('127.0.0.1', args.p)
+        pipeline(conn, (["REGISTER", "bench", name] for name in names))
+        pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in names))
+        conn.sock.close()
+        round_trip(args.p, names, args.rounds, args.lookups)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of browsing a user with many files.
+
+Publishes many files for one user, then lists them with the old
+LIST_CONTENT (whole list in one reply, parsed into a list) and with
+client.iter_content (LIST_CONTENT_PAGE, one page at a time, with
+descriptions). Reports the time and the peak Python memory of each, and
+the time of a prefix query that matches a few files.
+
+Usage: python3 bench_content.py [--files 200000] [--page-size 500]
+                                [--server-bin ../server] [-p 9750]
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+from common import start_server, open_session, pipeline, client
+
+
+# Old listing kept here as the baseline: every file name in one reply
+def list_content(conn, username, remote_user):
+    conn.send_string("LIST_CONTENT")
+    conn.send_string("bench")
+    conn.send_string(username)
+    conn.send_string(remote_user)
+    reader = conn.read_reply()
+    reader.read_byte()
+    return [reader.read_string() for _ in range(int(reader.read_string()))]
+
+
+def run(name, function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:12s} {count:9d} files   {elapsed:7.2f} s   peak memory {peak / (1 << 20):8.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200000, help='Files of the browsed user')
+    parser.add_argument('--page-size', type=int, default=500, help='Files per page')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9750, help='Local server port')
+    args = parser.parse_args()
+
+    kwargs = {'binary': args.server_bin} if args.server_bin else {}
+    proc = start_server(args.p, **kwargs)
+    try:
+        conn = open_session('127.0.0.1', args.p)
+        owner, browser = f"bench{os.getpid()}_owner", f"bench{os.getpid()}_browser"
+        pipeline(conn, (["REGISTER", "bench", name] for name in (owner, browser)))
+        pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in (owner, browser)))
+        pipeline(conn, (["PUBLISH", "bench", owner, f"/data/{owner}/file_{i:07d}.bin",
+                         f"description of file {i}"] for i in range(args.files)))
+
+        client._server = '127.0.0.1'
+        client._port = args.p
+        client._persistent = True
+        client._registered_user = browser
+        client._content_page_size = args.page_size
+        client.get_datetime()
+
+        print(f"Listing {args.files} files")
+        run("LIST_CONTENT", lambda: len(list_content(conn, browser, owner)))
+        run("iter_content", lambda: sum(1 for _ in client.iter_content(owner)))
+        prefix = f"/data/{owner}/file_00001"
+        run("prefix", lambda: sum(1 for _ in client.iter_content(owner, prefix)))
+        conn.sock.close()
+        client.close_control()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Contention benchmark of the server user table.
+
+Fills the server with many connected users, then runs slow readers that
+ask for LIST_USERS and drain the reply a few kB at a time, next to writers
+that cycle REGISTER / CONNECT / DISCONNECT / UNREGISTER. When the listing
+is written to the socket under the table lock, a slow reader stalls every
+writer; with snapshot replies the writers are unaffected. Reports writer
+ops/s and latency percentiles, and the listings completed by the readers.
+
+Usage: python3 bench_contention.py [--users 50000] [--readers 8]
+                                   [--writers 8] [--duration 10]
+                                   [--read-delay 0.005]
+                                   [--server-bin ../server] [--port 9500]
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+from common import start_server, open_session, pipeline, percentile
+
+
+# Slow reader: one-shot LIST_USERS connections with a small receive buffer
+def reader(port, username, deadline, delay, listings):
+    while time.perf_counter() < deadline:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(('127.0.0.1', port))
+        sock.sendall(b"LIST_USERS\0bench\0" + username.encode() + b"\0")
+        # The server closes the connection after the reply
+        sock.shutdown(socket.SHUT_WR)
+        received = 0
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            received += len(data)
+            time.sleep(delay)
+        sock.close()
+        listings.append(received)
+
+
+# Writer: cycles one user through every change of the table
+def writer(port, name, deadline, latencies):
+    conn = open_session('127.0.0.1', port)
+    cycle = (["REGISTER", "bench", name], ["CONNECT", "bench", name, "40000"],
+             ["DISCONNECT", "bench", name], ["UNREGISTER", "bench", name])
+    while time.perf_counter() < deadline:
+        for fields in cycle:
+            start = time.perf_counter()
+            pipeline(conn, [fields], window=1)
+            latencies.append(time.perf_counter() - start)
+    conn.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000, help='Connected users listed')
+    parser.add_argument('--readers', type=int, default=8, help='Slow LIST_USERS clients')
+    parser.add_argument('--writers', type=int, default=8, help='Mutating clients')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run')
+    parser.add_argument('--read-delay', type=float, default=0.005,
+                        help='Pause of the readers after each 4 kB received')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('--port', type=int, default=9500, help='Local server port')
+    args = parser.parse_args()
+
+    kwargs = {'binary': args.server_bin} if args.server_bin else {}
+    proc = start_server(args.port, **kwargs)
+    try:
+        # Fill the table with connected users
+        conn = open_session('127.0.0.1', args.port)
+        prefix = f"bench{os.getpid()}_"
+        names = [f"{prefix}{i}" for i in range(args.users)]
+        pipeline(conn, (["REGISTER", "bench", name] for name in names))
+        pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in names))
+        conn.sock.close()
+
+        deadline = time.perf_counter() + args.duration
+        listings = []
+        latencies = []
+        threads = [threading.Thread(target=reader,
+                                    args=(args.port, names[0], deadline, args.read_delay, listings))
+                   for _ in range(args.readers)]
+        threads += [threading.Thread(target=writer,
+                                     args=(args.port, f"{prefix}w{i}", deadline, latencies))
+                    for i in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print(f"{args.users} users, {args.readers} slow readers, {args.writers} writers")
+        print(f"writers  {len(latencies) / args.duration:10.0f} ops/s   "
+              f"p50 {percentile(latencies, 50) * 1000:8.2f} ms   "
+              f"p99 {percentile(latencies, 99) * 1000:8.2f} ms   "
+              f"max {max(latencies, default=0) * 1000:8.2f} ms")
+        print(f"readers  {len(listings):10d} listings")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Benchmark of the P2P download side (GET_FILE data loop).
+
+A sender process serves a large file with p2p_client.UploadServer; the main
+process downloads it once with the old blocking recv(4096) + f.write loop
+and once with Client.receive_file of p2p_client (preallocated file,
+recv_into a reusable buffer on the event loop). Reports MB/s, receive calls
+and the bytes objects allocated by the receive path per transfer.
+
+Usage: python3 bench_download.py [--size-mb 1024] [--recv-buffer 1048576]
+                                 [--socket-buffer BYTES]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import p2p_client
+
+
+# Socket wrapper that counts receive calls and the bytes objects they return
+# (old loop)
+class CountingSocket:
+    def __init__(self, sock):
+        self._sock = sock
+        self.calls = 0
+        self.allocations = 0
+
+    def recv(self, size):
+        self.calls += 1
+        self.allocations += 1
+        return self._sock.recv(size)
+
+    def recv_into(self, view):
+        self.calls += 1
+        return self._sock.recv_into(view)
+
+
+# Peer reader that counts receive calls and the bytes objects they return
+class CountingReader(p2p_client.PeerReader):
+    calls = 0
+    allocations = 0
+
+    async def _fill(self):
+        self.calls += 1
+        self.allocations += 1
+        await super()._fill()
+
+    async def recv_into(self, view):
+        if self._pos >= len(self._buffer):
+            self.calls += 1
+        return await super().recv_into(view)
+
+
+# Old download loop kept here as the baseline
+def receive_file_chunked(reader, file_name, file_size):
+    with open(file_name, 'wb') as f:
+        bytes_received = 0
+        while bytes_received < file_size:
+            data = reader.recv(min(4096, file_size - bytes_received))
+            if not data:
+                break
+            f.write(data)
+            bytes_received += len(data)
+    return bytes_received
+
+
+# Sender process: serves one GET_FILE per accepted connection
+def serve(listener, rounds, socket_buffer):
+    async def run():
+        uploads = p2p_client.UploadServer(
+            p2p_client.Client(None, None, socket_buffer_size=socket_buffer))
+        listener.setblocking(False)
+        for _ in range(rounds):
+            peer, _ = await asyncio.get_running_loop().sock_accept(listener)
+            await uploads.handle(peer)
+
+    asyncio.run(run())
+
+
+def report(name, file_size, received, elapsed, calls, allocations):
+    status = "" if received == file_size else "  INCOMPLETE"
+    print(f"{name:10s} {file_size / (1 << 20) / elapsed:10.1f} MB/s   "
+          f"receive calls {calls:9d}   allocations {allocations:9d}{status}")
+
+
+def download_chunked(address, remote_file, local_file, socket_buffer):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if socket_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buffer)
+    sock.connect(address)
+    sock.sendall(b"GET_FILE\0" + remote_file.encode() + b"\0")
+    counting = CountingSocket(sock)
+    reader = p2p_client.FramedReader(counting)
+
+    start = time.perf_counter()
+    reader.read_byte()
+    file_size = int(reader.read_string())
+    received = receive_file_chunked(reader, local_file, file_size)
+    elapsed = time.perf_counter() - start
+    sock.close()
+    report("chunked", file_size, received, elapsed, counting.calls, counting.allocations)
+
+
+async def download_recv_into(address, remote_file, local_file, recv_buffer, socket_buffer):
+    api = p2p_client.Client(None, None, recv_buffer_size=recv_buffer,
+                            socket_buffer_size=socket_buffer)
+    sock = await api.connect_to_peer(*address)
+    await asyncio.get_running_loop().sock_sendall(
+        sock, p2p_client.encode_request(("GET_FILE", remote_file)))
+    reader = CountingReader(sock)
+
+    start = time.perf_counter()
+    await reader.read_byte()
+    file_size = int(await reader.read_string())
+    received = await api.receive_file(reader, local_file, file_size)
+    elapsed = time.perf_counter() - start
+    sock.close()
+    report("recv_into", file_size, received, elapsed, reader.calls, reader.allocations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024, help='Size of the test file')
+    parser.add_argument('--recv-buffer', type=int, default=1 << 20, help='Receive buffer size')
+    parser.add_argument('--socket-buffer', type=int, default=None, help='SO_RCVBUF/SO_SNDBUF')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench_download_')
+    remote_file = os.path.join(tmp, 'remote.bin')
+    local_file = os.path.join(tmp, 'local.bin')
+    block = os.urandom(1 << 20)
+    with open(remote_file, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(block)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    sender = multiprocessing.Process(target=serve, args=(listener, 2, args.socket_buffer))
+    sender.start()
+
+    try:
+        print(f"Downloading {args.size_mb} MB")
+        download_chunked(listener.getsockname(), remote_file, local_file, args.socket_buffer)
+        asyncio.run(download_recv_into(listener.getsockname(), remote_file, local_file,
+                                       args.recv_buffer, args.socket_buffer))
+    finally:
+        sender.join()
+        listener.close()
+        for name in (remote_file, local_file):
+            if os.path.exists(name):
+                os.remove(name)
+        os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Load generator for the front ends of the server.
+
+Starts the server with each front end (-m thread: a thread per connection,
+-m epoll: an event loop and a pool of workers) and keeps many clients
+connected at once. Like client.py without --persistent, every client opens
+a connection per request: it sends a LOOKUP_USER, reads the reply, closes
+the connection and starts again. Reports the connections served per
+second, the latency from connect to reply and the peak threads and memory
+of the server.
+
+Usage: python3 bench_frontend.py [--clients 10000] [--duration 10]
+                                 [--modes thread,epoll] [--workers 8]
+                                 [--server-bin ../server] [-p 9990]
+"""
+import argparse
+import asyncio
+import resource
+import socket
+import struct
+import time
+
+from common import start_server, open_session, pipeline, percentile, process_rss_kb
+
+REQUEST = b'\0'.join([b"LOOKUP_USER", b"bench", b"load", b"load"]) + b'\0'
+
+
+# Function to read the number of threads of a process
+def process_threads(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+    return 0
+
+
+# Function to check if a LOOKUP_USER reply is whole: an error code, or
+# code 0 followed by the IP and the port
+def reply_complete(reply):
+    return len(reply) > 0 and (reply[0] != 0 or reply.count(b'\0', 1) >= 2)
+
+
+# Simulated client: one connection per request until the deadline
+async def run_client(port, deadline, latencies, errors):
+    loop = asyncio.get_running_loop()
+    while time.perf_counter() < deadline:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Reset on close, so closed connections do not use up local ports
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        sock.setblocking(False)
+        start = time.perf_counter()
+        try:
+            await loop.sock_connect(sock, ('127.0.0.1', port))
+            await loop.sock_sendall(sock, REQUEST)
+            reply = b''
+            while not reply_complete(reply):
+                chunk = await loop.sock_recv(sock, 256)
+                if not chunk:
+                    break
+                reply += chunk
+            if reply_complete(reply) and reply[0] == 0:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors[0] += 1
+        except OSError:
+            errors[0] += 1
+            await asyncio.sleep(0.01)
+        finally:
+            sock.close()
+
+
+async def sample_server(pid, deadline, peaks):
+    while time.perf_counter() < deadline:
+        peaks['threads'] = max(peaks['threads'], process_threads(pid))
+        peaks['rss_kb'] = max(peaks['rss_kb'], process_rss_kb(pid))
+        await asyncio.sleep(0.2)
+
+
+async def run_load(pid, port, clients, duration):
+    latencies = []
+    errors = [0]
+    peaks = {'threads': 0, 'rss_kb': 0}
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(sample_server(pid, deadline, peaks),
+                         *(run_client(port, deadline, latencies, errors) for _ in range(clients)))
+    return latencies, errors[0], time.perf_counter() - start, peaks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=10000, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load per front end')
+    parser.add_argument('--modes', default='thread,epoll', help='Front ends to measure')
+    parser.add_argument('--workers', type=int, default=8, help='Workers of the epoll front end')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9990, help='Local server port')
+    args = parser.parse_args()
+
+    # Every client needs a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.clients + 64 > hard:
+        print(f"Warning: {args.clients} clients with an open files limit of {hard}")
+
+    print(f"{args.clients} concurrent clients, one connection per LOOKUP_USER, {args.duration:.0f} s")
+    print(f"{'mode':8s} {'conn/s':>9s} {'p50 ms':>8s} {'p99 ms':>8s} {'errors':>7s} "
+          f"{'threads':>8s} {'RSS MB':>7s}")
+    for mode in args.modes.split(','):
+        kwargs = {'binary': args.server_bin} if args.server_bin else {}
+        proc = start_server(args.p, args=['-m', mode, '-w', str(args.workers)], **kwargs)
+        try:
+            conn = open_session('127.0.0.1', args.p)
+            pipeline(conn, [["REGISTER", "bench", "load"], ["CONNECT", "bench", "load", "40000"]])
+            conn.sock.close()
+
+            latencies, errors, elapsed, peaks = asyncio.run(
+                run_load(proc.pid, args.p, args.clients, args.duration))
+            print(f"{mode:8s} {len(latencies) / elapsed:9.0f} "
+                  f"{percentile(latencies, 50) * 1000:8.1f} {percentile(latencies, 99) * 1000:8.1f} "
+                  f"{errors:7d} {peaks['threads']:8d} {peaks['rss_kb'] / 1024:7.1f}")
+        finally:
+            proc.terminate()
+            proc.wait()
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark of LIST_USERS against LIST_USERS_DELTA.
+
+Connects many users, then in each round reconnects a few of them and
+refreshes the user table of a client once with the full LIST_USERS and once
+with client.sync_users (LIST_USERS_DELTA). Reports the reply bytes and the
+time of both per number of changed users, and checks that the table kept
+from the deltas matches the full list.
+
+Usage: python3 bench_listusers.py [--users 50000] [--changes 0,10,100,1000]
+                                  [--server-bin ../server] [-p 9550]
+"""
+import argparse
+import os
+import time
+
+from common import start_server, open_session, pipeline, client
+
+
+# Function to get the full list with LIST_USERS. Returns the users as a
+# dict and the size of the reply in bytes.
+def list_users(conn, username):
+    conn.send_string("LIST_USERS")
+    conn.send_string("bench")
+    conn.send_string(username)
+    reader = conn.read_reply()
+    reader.read_byte()
+    size = 1
+    users = {}
+    num_users = reader.read_string()
+    size += len(num_users) + 1
+    for _ in range(int(num_users)):
+        name, ip, port = reader.read_string(), reader.read_string(), reader.read_string()
+        size += len(name) + len(ip) + len(port) + 3
+        users[name] = (ip, int(port))
+    return users, size
+
+
+# Function to get the size of a LIST_USERS_DELTA reply for a version
+def delta_size(conn, username, version):
+    conn.send_string("LIST_USERS_DELTA")
+    conn.send_string("bench")
+    conn.send_string(username)
+    conn.send_string(version)
+    reader = conn.read_reply()
+    reader.read_byte()
+    size = 1
+    fields = [reader.read_string() for _ in range(3)]
+    size += sum(len(field) + 1 for field in fields)
+    for _ in range(int(fields[2])):
+        change = reader.read_string()
+        count = 3 if change == "+" else 1
+        size += 2 + sum(len(reader.read_string()) + 1 for _ in range(count))
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000, help='Connected users')
+    parser.add_argument('--changes', default='0,10,100,1000', help='Users reconnected per round')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9550, help='Local server port')
+    args = parser.parse_args()
+
+    kwargs = {'binary': args.server_bin} if args.server_bin else {}
+    proc = start_server(args.p, **kwargs)
+    try:
+        conn = open_session('127.0.0.1', args.p)
+        names = [f"bench{os.getpid()}_{i}" for i in range(args.users)]
+        pipeline(conn, (["REGISTER", "bench", name] for name in names))
+        pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in names))
+        watcher = names[0]
+
+        # The client keeps its table over a persistent connection
+        client._server = '127.0.0.1'
+        client._port = args.p
+        client._persistent = True
+        client.sync_users(watcher)
+
+        print(f"{args.users} connected users")
+        print(f"{'changed':>8s} {'full bytes':>12s} {'full ms':>9s} "
+              f"{'delta bytes':>12s} {'delta ms':>9s}")
+        for changes in (int(value) for value in args.changes.split(',')):
+            changed = names[1:changes + 1]
+            pipeline(conn, (["DISCONNECT", "bench", name] for name in changed))
+            pipeline(conn, (["CONNECT", "bench", name, "40001"] for name in changed))
+
+            size = delta_size(conn, watcher, client.user(watcher).peers_version)
+            start = time.perf_counter()
+            client.sync_users(watcher)
+            delta_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            users, full_size = list_users(conn, watcher)
+            full_ms = (time.perf_counter() - start) * 1000
+
+            assert users == client.user(watcher).peers, "table kept from deltas differs from LIST_USERS"
+            print(f"{changes:8d} {full_size:12d} {full_ms:9.2f} {size:12d} {delta_ms:9.2f}")
+        conn.sock.close()
+        client.close_control()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark of the GET_FILE setup with many connected users.
+
+Connects many users plus a seeder whose files are served by a
+p2p_client.UploadServer in this process, then measures the time from
+GET_FILE to the first byte of the file: resolving the seeder and starting
+the download. The seeder is resolved with the old LIST_USERS scan, with
+LOOKUP_USER (User.lookup), and with the cached LOOKUP_USER result.
+
+Usage: python3 bench_lookup.py [--users 50000] [--rounds 20]
+                               [--server-bin ../server] [-p 9650]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from common import start_server, open_session, pipeline, percentile, p2p_client
+
+
+# Old resolution kept here as the baseline: full LIST_USERS and a scan
+async def resolve_list_users(user, remote_user):
+    async def parse(reply):
+        address = None
+        for _ in range(await reply.read_int()):
+            name, ip, port = (await reply.read_string(), await reply.read_string(),
+                              await reply.read_int())
+            if name == remote_user:
+                address = (ip, port)
+        return address
+
+    return await user.api.request("LIST_USERS", user.name, parse=parse)
+
+
+async def resolve_lookup(user, remote_user):
+    return await user.lookup(remote_user, refresh=True)
+
+
+async def resolve_cached(user, remote_user):
+    return await user.lookup(remote_user)
+
+
+async def measure(name, resolve, user, seeder, remote_file, local_file, rounds):
+    first_byte = memoryview(bytearray(1))
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        ip, port = await resolve(user, seeder)
+        response, _, sock, reader, journal, _ = await user.api.start_download(
+            ip, port, remote_file, local_file)
+        await reader.recv_into(first_byte)
+        times.append(time.perf_counter() - start)
+        sock.close()
+        journal.remove()
+    print(f"{name:12s} p50 {percentile(times, 50) * 1000:8.2f} ms   "
+          f"p99 {percentile(times, 99) * 1000:8.2f} ms")
+
+
+async def run(args, remote_file, local_file):
+    async with p2p_client.Client('127.0.0.1', args.p) as api:
+        # Seeder served from this process
+        uploads = p2p_client.UploadServer(api)
+        listener_port = await uploads.start()
+
+        conn = open_session('127.0.0.1', args.p)
+        prefix = f"bench{os.getpid()}_"
+        names = [f"{prefix}{i}" for i in range(args.users)]
+        downloader, seeder = f"{prefix}downloader", f"{prefix}seeder"
+        pipeline(conn, (["REGISTER", "bench", name] for name in names + [downloader, seeder]))
+        pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in names + [downloader]))
+        pipeline(conn, [["CONNECT", "bench", seeder, listener_port]])
+        conn.sock.close()
+
+        user = api.user(downloader)
+        print(f"GET_FILE setup with {args.users} connected users")
+        for name, resolve in (("LIST_USERS", resolve_list_users), ("LOOKUP_USER", resolve_lookup),
+                              ("cached", resolve_cached)):
+            await measure(name, resolve, user, seeder, remote_file, local_file, args.rounds)
+        await uploads.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000, help='Connected users')
+    parser.add_argument('--rounds', type=int, default=20, help='GET_FILE setups per method')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9650, help='Local server port')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench_lookup_')
+    remote_file = os.path.join(tmp, 'remote.bin')
+    local_file = os.path.join(tmp, 'local.bin')
+    with open(remote_file, 'wb') as f:
+        f.write(os.urandom(64 << 10))
+
+    kwargs = {'binary': args.server_bin} if args.server_bin else {}
+    proc = start_server(args.p, **kwargs)
+    try:
+        asyncio.run(run(args, remote_file, local_file))
+    finally:
+        proc.terminate()
+        proc.wait()
+        for name in (remote_file, local_file):
+            if os.path.exists(name):
+                os.remove(name)
+        os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Benchmark of PUBLISH/DELETE with many files per user.
+
+Registers and connects a few users, then publishes files for each of them
+through pipelined control connections. Reports PUBLISH throughput as the
+per-user file count grows, the server RSS at the end, and the DELETE
+throughput over the same files.
+
+Usage: python3 bench_publish.py [--files 100000] [--users 1] [--step 20000]
+                                [--server-bin ../server] [-p 9450]
+"""
+import argparse
+import os
+import time
+
+from common import start_server, open_session, pipeline, process_rss_kb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000, help='Files per user')
+    parser.add_argument('--users', type=int, default=1, help='Publishing users')
+    parser.add_argument('--step', type=int, default=20000, help='Files per measurement')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9450, help='Local server port')
+    args = parser.parse_args()
+
+    kwargs = {'binary': args.server_bin} if args.server_bin else {}
+    proc = start_server(args.p, **kwargs)
+    try:
+        conn = open_session('127.0.0.1', args.p)
+        names = [f"bench{os.getpid()}_{i}" for i in range(args.users)]
+        pipeline(conn, (["REGISTER", "bench", name] for name in names))
+        pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in names))
+        print(f"RSS with {args.users} empty user(s): {process_rss_kb(proc.pid) / 1024:.1f} MB")
+
+        print(f"{'files/user':>10s} {'PUBLISH/s':>12s}")
+        for first in range(0, args.files, args.step):
+            last = min(first + args.step, args.files)
+            requests = (["PUBLISH", "bench", name, f"/home/{name}/data/file_{i:07d}.bin",
+                         f"file number {i}"] for i in range(first, last) for name in names)
+            start = time.perf_counter()
+            codes = pipeline(conn, requests)
+            rate = len(codes) / (time.perf_counter() - start)
+            assert all(code == 0 for code in codes), "PUBLISH failed"
+            print(f"{last:10d} {rate:12.0f}")
+
+        print(f"RSS with {args.files} files per user: {process_rss_kb(proc.pid) / 1024:.1f} MB")
+
+        requests = (["DELETE", "bench", name, f"/home/{name}/data/file_{i:07d}.bin"]
+                    for i in range(args.files) for name in names)
+        start = time.perf_counter()
+        codes = pipeline(conn, requests)
+        rate = len(codes) / (time.perf_counter() - start)
+        assert all(code == 0 for code in codes), "DELETE failed"
+        print(f"DELETE/s over all files: {rate:.0f}")
+        conn.sock.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark of the LIST_USERS reply parsing on the client side.
+
+Compares the old byte-at-a-time receive loop (one recv per byte) with
+client.FramedReader on a synthetic 10k-entry listing served over a local
+TCP socket. Reports recv syscalls and wall time per listing.
+
+Usage: python3 bench_reader.py [--users 10000] [--rounds 5]
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from client import client
+
+
+# Socket wrapper that counts recv calls (one per syscall)
+class CountingSocket:
+    def __init__(self, sock):
+        self._sock = sock
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self._sock.recv(size)
+
+
+# Old receive loop kept here as the baseline
+def receive_string_bytewise(sock):
+    data = bytearray()
+    while True:
+        byte = sock.recv(1)
+        if not byte or byte == b'\0':
+            break
+        data.extend(byte)
+    return data.decode()
+
+
+# Builds a LIST_USERS reply as sent by server.c
+def build_reply(num_users):
+    parts = [b'\x00', str(num_users).encode() + b'\0']
+    for i in range(num_users):
+        parts.append(f"user{i:06d}".encode() + b'\0')
+        parts.append(f"10.0.{i // 256 % 256}.{i % 256}".encode() + b'\0')
+        parts.append(str(20000 + i % 40000).encode() + b'\0')
+    return b''.join(parts)
+
+
+def serve(listener, payload, rounds):
+    for _ in range(rounds):
+        conn, _ = listener.accept()
+        conn.sendall(payload)
+        conn.close()
+
+
+def parse_bytewise(sock):
+    response = sock.recv(1)[0]
+    num_users = int(receive_string_bytewise(sock))
+    for _ in range(num_users):
+        receive_string_bytewise(sock)
+        receive_string_bytewise(sock)
+        receive_string_bytewise(sock)
+    return response, num_users
+
+
+def parse_buffered(sock):
+    reader = client.FramedReader(sock)
+    response = reader.read_byte()
+    num_users = int(reader.read_string())
+    for _ in range(num_users):
+        reader.read_string()
+        reader.read_string()
+        reader.read_string()
+    return response, num_users
+
+
+def run(name, parser, payload, rounds):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = threading.Thread(target=serve, args=(listener, payload, rounds))
+    server.start()
+
+    calls = 0
+    elapsed = 0.0
+    for _ in range(rounds):
+        sock = socket.create_connection(listener.getsockname())
+        counting = CountingSocket(sock)
+        start = time.perf_counter()
+        parser(counting)
+        elapsed += time.perf_counter() - start
+        calls += counting.calls
+        sock.close()
+
+    server.join()
+    listener.close()
+    print(f"{name:10s} recv calls/listing: {calls // rounds:10d}   "
+          f"wall time/listing: {elapsed / rounds * 1000:9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000, help='Entries per listing')
+    parser.add_argument('--rounds', type=int, default=5, help='Listings per method')
+    args = parser.parse_args()
+
+    payload = build_reply(args.users)
+    print(f"LIST_USERS reply with {args.users} users ({len(payload)} bytes)")
+    run("bytewise", parse_bytewise, payload, args.rounds)
+    run("buffered", parse_buffered, payload, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of the server user registry at scale.
+
+Registers and connects many users through pipelined control connections
+and reports REGISTER and CONNECT throughput as the number of registered
+users grows. With a linear find_user the rate drops as the table grows;
+with the hash index it stays flat.
+
+Usage: python3 bench_registry.py [--users 100000] [--step 10000]
+                                 [--server-bin ../server] [--port 9400]
+       python3 bench_registry.py -s host -p port   (use a running server)
+"""
+import argparse
+import os
+import time
+
+from common import start_server, open_session, pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000, help='Users to register')
+    parser.add_argument('--step', type=int, default=10000, help='Users per measurement')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-s', default='127.0.0.1', help='Server host')
+    parser.add_argument('-p', type=int, default=9400, help='Server port')
+    args = parser.parse_args()
+
+    proc = None
+    if args.server_bin or args.s == '127.0.0.1':
+        kwargs = {'binary': args.server_bin} if args.server_bin else {}
+        proc = start_server(args.p, **kwargs)
+
+    try:
+        conn = open_session(args.s, args.p)
+        prefix = f"bench{os.getpid()}_"
+        print(f"{'users':>8s} {'REGISTER/s':>12s} {'CONNECT/s':>12s}")
+        for first in range(0, args.users, args.step):
+            names = [f"{prefix}{i}" for i in range(first, min(first + args.step, args.users))]
+
+            start = time.perf_counter()
+            codes = pipeline(conn, (["REGISTER", "bench", name] for name in names))
+            register_rate = len(names) / (time.perf_counter() - start)
+            assert all(code == 0 for code in codes), "REGISTER failed"
+
+            start = time.perf_counter()
+            codes = pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in names))
+            connect_rate = len(names) / (time.perf_counter() - start)
+            assert all(code == 0 for code in codes), "CONNECT failed"
+
+            print(f"{first + len(names):8d} {register_rate:12.0f} {connect_rate:12.0f}")
+        conn.sock.close()
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of finding who publishes a file.
+
+Publishes files named from a small vocabulary for many users, then looks
+for the files that contain two words: once by listing the content of every
+connected user and filtering on the client (the only way before SEARCH),
+and once with client.search. Reports the time of both and checks that
+they find the same files.
+
+Usage: python3 bench_search.py [--users 1000] [--files 100] [--queries 20]
+                               [--server-bin ../server] [-p 9850]
+"""
+import argparse
+import os
+import random
+import re
+import time
+
+from common import start_server, open_session, pipeline, client
+
+WORDS = ["jazz", "rock", "live", "remix", "demo", "concert", "album", "single",
+         "lecture", "notes", "draft", "final", "photo", "video", "backup", "report"]
+
+
+# Old search kept here as the baseline: LIST_CONTENT of every user
+def search_by_listing(username, words):
+    found = set()
+    _, users = client.query_users(username)
+    for owner, _, _ in users:
+        for filename, description in client.iter_content(owner, username=username):
+            text = set(re.findall(r'[a-z0-9]+', (filename + ' ' + description).lower()))
+            if all(word in text for word in words):
+                found.add((owner, filename))
+    return found
+
+
+def search_index(username, words):
+    found = set()
+    cursor = 0
+    while cursor != -1:
+        _, _, cursor, results = client.search(' '.join(words), cursor, 1000, username)
+        found.update((owner, filename) for owner, filename, _, _ in results)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000, help='Publishing users')
+    parser.add_argument('--files', type=int, default=100, help='Files per user')
+    parser.add_argument('--queries', type=int, default=20, help='Two-word searches')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9850, help='Local server port')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    kwargs = {'binary': args.server_bin} if args.server_bin else {}
+    proc = start_server(args.p, **kwargs)
+    try:
+        conn = open_session('127.0.0.1', args.p)
+        names = [f"bench{os.getpid()}_{i}" for i in range(args.users)]
+        pipeline(conn, (["REGISTER", "bench", name] for name in names))
+        pipeline(conn, (["CONNECT", "bench", name, "40000"] for name in names))
+        pipeline(conn, (["PUBLISH", "bench", name,
+                         f"/data/{'_'.join(rng.sample(WORDS, 2))}_{i}.bin",
+                         ' '.join(rng.sample(WORDS, 2))]
+                        for name in names for i in range(args.files)))
+        conn.sock.close()
+
+        client._server = '127.0.0.1'
+        client._port = args.p
+        client._persistent = True
+        client.get_datetime()
+
+        queries = [rng.sample(WORDS, 2) for _ in range(args.queries)]
+        print(f"{args.users} users x {args.files} files, {args.queries} two-word queries")
+        for name, function in (("LIST_CONTENT", search_by_listing), ("SEARCH", search_index)):
+            start = time.perf_counter()
+            results = [function(names[0], words) for words in queries]
+            elapsed = time.perf_counter() - start
+            print(f"{name:12s} {elapsed / args.queries * 1000:9.1f} ms/query   "
+                  f"{sum(map(len, results)) / args.queries:8.0f} files/query")
+            if name == "LIST_CONTENT":
+                expected = results
+            else:
+                assert results == expected, "SEARCH and LIST_CONTENT found different files"
+        client.close_control()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""
+Load generator and benchmark of the whole system.
+
+Starts the server (optionally with the log server behind it and the web
+service for the timestamps) and runs simulated users of p2p_client.py,
+the protocol code of client.py, on one event loop. Every user registers,
+connects with a shared upload server and publishes a shared file, then
+runs operations chosen at random with the weights of --mix until the end
+of the run:
+
+  REGISTER      registers a new user and unregisters it (UNREGISTER)
+  CONNECT       disconnects the user and connects it again (DISCONNECT)
+  PUBLISH       publishes a new file and deletes it (DELETE)
+  LIST_USERS    updates the table of connected users
+  LIST_CONTENT  lists every file of another user
+  SEARCH        searches the shared file
+  GET_FILE      downloads the shared file from another user
+
+Reports the ops/s and the p50/p95/p99 latency of every operation, the CPU
+time of the server and of the load generator, the log records of the
+server and its own metrics for the run (STATS, see server_stats.py). The results are saved as JSON with the commit and the settings;
+--compare prints the change against the JSON of an earlier run.
+
+--log-server needs rpcbind running, like log_server itself.
+
+Usage: python3 bench_system.py [--users 100] [--duration 10] [--mix REGISTER=2,...]
+                               [--file-size 65536] [--persistent] [--connections 1]
+                               [--protocol 1] [--server-args "-m epoll -w 8"]
+                               [--log-server] [--web-service] [--seed 1]
+                               [--output results.json] [--compare old.json]
+                               [--server-bin ../server] [-p 9960]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import resource
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from common import (BENCH_DIR, start_server, wait_port, percentile, process_rss_kb, client,
+                    p2p_client, server_stats)
+
+DEFAULT_MIX = "REGISTER=2,CONNECT=2,PUBLISH=10,LIST_USERS=30,LIST_CONTENT=30,SEARCH=0,GET_FILE=10"
+OPERATIONS = ("REGISTER", "CONNECT", "PUBLISH", "LIST_USERS", "LIST_CONTENT", "SEARCH", "GET_FILE")
+LOG_SERVER_BIN = os.path.join(BENCH_DIR, '..', 'log_server')
+WEB_SERVICE = os.path.join(BENCH_DIR, '..', 'web_service.py')
+
+
+# Function to parse a mix of OPERATION=weight entries
+def parse_mix(text):
+    mix = {}
+    for entry in text.split(','):
+        operation, _, weight = entry.partition('=')
+        operation = operation.strip().upper()
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}")
+        mix[operation] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("every weight is 0")
+    return mix
+
+
+# Function to read the CPU time (user + system) of a process in seconds
+def process_cpu_s(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+# Function to get the commit of the tree, None outside of git
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Latencies, errors and bytes received of the operations of a run
+class Samples:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.first_errors = {}
+        self.bytes = 0
+        self.server_stats = None    # Metrics of the server during the run
+
+    # Function to time a request. Returns whether it succeeded and its result.
+    async def timed(self, operation, coroutine):
+        start = time.perf_counter()
+        try:
+            result = await coroutine
+        except Exception as e:
+            self.errors[operation] += 1
+            self.first_errors.setdefault(operation, str(e) or repr(e))
+            return False, None
+        self.latencies[operation].append(time.perf_counter() - start)
+        return True, result
+
+
+async def collect(files):
+    return [file async for file in files]
+
+
+# Simulated user: operations of the mix one after another until the deadline
+async def run_user(user, names, shared_file, port, work_dir, mix, deadline, samples, rng):
+    operations, weights = list(mix), list(mix.values())
+    local_file = os.path.join(work_dir, user.name)
+
+    def other():
+        name = rng.choice(names)
+        while name == user.name and len(names) > 1:
+            name = rng.choice(names)
+        return name
+
+    count = 0
+    while time.perf_counter() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        count += 1
+        if operation == "REGISTER":
+            temp = user.api.user(f"{user.name}_{count}")
+            ok, _ = await samples.timed("REGISTER", temp.register())
+            if ok:
+                await samples.timed("UNREGISTER", temp.unregister())
+            del user.api.users[temp.name]
+        elif operation == "CONNECT":
+            await samples.timed("DISCONNECT", user.disconnect())
+            await samples.timed("CONNECT", user.connect(port))
+        elif operation == "PUBLISH":
+            file_name = f"/bench/{user.name}/{count}"
+            ok, _ = await samples.timed("PUBLISH", user.publish(file_name, f"file {count}"))
+            if ok:
+                await samples.timed("DELETE", user.delete(file_name))
+        elif operation == "LIST_USERS":
+            await samples.timed(operation, user.list_users())
+        elif operation == "LIST_CONTENT":
+            await samples.timed(operation, collect(user.list_content(other())))
+        elif operation == "SEARCH":
+            await samples.timed(operation, user.search("shared"))
+        elif operation == "GET_FILE":
+            ok, stats = await samples.timed(
+                operation, user.get_file(other(), shared_file, local_file))
+            if ok:
+                samples.bytes += stats.received
+                os.remove(local_file)
+
+
+# Function to register, connect and publish the shared file for every user,
+# at most 64 at once
+async def set_up(users, port, shared_file):
+    slots = asyncio.Semaphore(64)
+
+    async def set_up_user(user):
+        async with slots:
+            await user.register()
+            await user.connect(port)
+            await user.publish(shared_file, "shared bench file")
+
+    await asyncio.gather(*(set_up_user(user) for user in users))
+
+
+# Function to get the metrics of the server, None if it has no STATS
+async def scrape(api):
+    try:
+        return await api.server_stats()
+    except (p2p_client.RequestError, ConnectionError, EOFError, OSError):
+        return None
+
+
+async def run_load(args, shared_file, work_dir, timestamp):
+    api = p2p_client.Client('127.0.0.1', args.p, persistent=args.persistent,
+                            protocol=args.protocol, connections=args.connections,
+                            timestamp=timestamp, upload_queue_depth=max(64, args.users))
+    async with api:
+        # Every user is served by the same upload server, so CONNECT does not
+        # move the files to another port
+        uploads = p2p_client.UploadServer(api)
+        port = await uploads.start()
+        try:
+            names = [f"bench{os.getpid()}_{i}" for i in range(args.users)]
+            users = [api.user(name) for name in names]
+            await set_up(users, port, shared_file)
+
+            samples = Samples()
+            rng = random.Random(args.seed)
+            before = await scrape(api)
+            start = time.perf_counter()
+            cpu = resource.getrusage(resource.RUSAGE_SELF)
+            await asyncio.gather(*(
+                run_user(user, names, shared_file, port, work_dir, args.mix,
+                         start + args.duration, samples, random.Random(rng.random()))
+                for user in users))
+            elapsed = time.perf_counter() - start
+            used = resource.getrusage(resource.RUSAGE_SELF)
+            samples.cpu_s = used.ru_utime + used.ru_stime - cpu.ru_utime - cpu.ru_stime
+            after = await scrape(api)
+            if before and after:
+                samples.server_stats = server_stats.since(after, before)
+            return samples, elapsed
+        finally:
+            await uploads.close()
+
+
+# Function to get the results of a run as JSON values
+def summarize(samples, elapsed):
+    operations = {}
+    for operation in sorted(set(samples.latencies) | set(samples.errors)):
+        latencies = samples.latencies[operation]
+        operations[operation] = {
+            "count": len(latencies),
+            "errors": samples.errors[operation],
+            "ops_per_s": round(len(latencies) / elapsed, 1),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "first_error": samples.first_errors.get(operation),
+        }
+    count = sum(len(latencies) for latencies in samples.latencies.values())
+    return operations, {
+        "ops": count,
+        "errors": sum(samples.errors.values()),
+        "ops_per_s": round(count / elapsed, 1),
+        "get_file_mb_per_s": round(samples.bytes / elapsed / (1 << 20), 1),
+        "load_cpu_s": round(samples.cpu_s, 2),
+    }
+
+
+def print_results(results):
+    print(f"{'operation':14s} {'ops':>8s} {'errors':>7s} {'ops/s':>9s} "
+          f"{'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}")
+    for operation, stats in results["operations"].items():
+        print(f"{operation:14s} {stats['count']:8d} {stats['errors']:7d} {stats['ops_per_s']:9.1f} "
+              f"{stats['p50_ms']:8.2f} {stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f}")
+    total, server = results["total"], results["server"]
+    print(f"{'total':14s} {total['ops']:8d} {total['errors']:7d} {total['ops_per_s']:9.1f}")
+    print(f"GET_FILE {total['get_file_mb_per_s']:.1f} MB/s, CPU: server {server['cpu_s']:.2f} s, "
+          f"load generator {total['load_cpu_s']:.2f} s, server RSS {server['rss_kb'] / 1024:.1f} MB")
+    if server["log"]:
+        print(server["log"])
+    if server["stats"]:
+        print("\nServer metrics during the run:")
+        print(server_stats.render_table(server["stats"], results["seconds"]), end='')
+
+
+# Function to print the change of ops/s and p99 against an earlier run
+def print_comparison(results, baseline):
+    print(f"Against {baseline.get('commit') or 'baseline'} ({baseline.get('date', '?')})")
+    print(f"{'operation':14s} {'ops/s':>9s} {'before':>9s} {'change':>8s} "
+          f"{'p99 ms':>8s} {'before':>8s} {'change':>8s}")
+    rows = list(results["operations"].items()) + [("total", results["total"])]
+    for operation, stats in rows:
+        before = (baseline["operations"].get(operation) if operation != "total"
+                  else baseline["total"])
+        if not before:
+            continue
+        line = f"{operation:14s} {stats['ops_per_s']:9.1f} {before['ops_per_s']:9.1f} " \
+               f"{change(stats['ops_per_s'], before['ops_per_s']):>8s}"
+        if "p99_ms" in stats:
+            line += f" {stats['p99_ms']:8.2f} {before['p99_ms']:8.2f} " \
+                    f"{change(stats['p99_ms'], before['p99_ms']):>8s}"
+        print(line)
+
+
+def change(value, before):
+    return f"{(value - before) / before * 100:+.1f}%" if before else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100, help='Simulated users')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='Weights of the operations, OPERATION=weight,...')
+    parser.add_argument('--file-size', type=int, default=65536, help='Bytes of the shared file')
+    parser.add_argument('--persistent', action='store_true',
+                        help='Send the requests over sessions instead of a connection each')
+    parser.add_argument('--connections', type=int, default=1, help='Sessions with --persistent')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=1,
+                        help='Framing of the sessions, 2 implies --persistent')
+    parser.add_argument('--server-args', default='', help='Extra arguments of the server')
+    parser.add_argument('--log-server', action='store_true',
+                        help='Start log_server and ship the server logs to it')
+    parser.add_argument('--web-service', action='store_true',
+                        help='Start web_service.py and take the timestamps from it')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the operation mix')
+    parser.add_argument('--output', default=None, help='File for the JSON results')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run')
+    parser.add_argument('--server-bin', default=None, help='Server binary to start')
+    parser.add_argument('-p', type=int, default=9960, help='Local server port')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    helpers = []
+    env = dict(os.environ)
+    timestamp = None
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            if args.log_server:
+                log_env = dict(env, LOG_DIR=os.path.join(work_dir, 'logs'))
+                helpers.append(subprocess.Popen([LOG_SERVER_BIN], env=log_env,
+                                                stdout=subprocess.DEVNULL,
+                                                stderr=subprocess.DEVNULL))
+                env["LOG_RPC_IP"] = "localhost"
+                time.sleep(0.5)
+            if args.web_service:
+                web_port = args.p + 1
+                helpers.append(subprocess.Popen(
+                    [sys.executable, WEB_SERVICE, '--mode', 'async', '--port', str(web_port)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                if not wait_port(web_port):
+                    raise RuntimeError("web service did not start")
+                timestamps = client.TimestampProvider(f"http://127.0.0.1:{web_port}/fecha")
+                timestamps.start()
+                timestamp = timestamps.now
+
+            shared_file = os.path.join(work_dir, 'shared.bin')
+            with open(shared_file, 'wb') as f:
+                f.write(os.urandom(args.file_size))
+
+            server_log = open(os.path.join(work_dir, 'server.log'), 'w')
+            kwargs = {'binary': args.server_bin} if args.server_bin else {}
+            proc = start_server(args.p, args=shlex.split(args.server_args), env=env,
+                                stdout=server_log, **kwargs)
+            try:
+                samples, elapsed = asyncio.run(run_load(args, shared_file, work_dir, timestamp))
+                server = {"cpu_s": round(process_cpu_s(proc.pid), 2),
+                          "rss_kb": process_rss_kb(proc.pid), "stats": samples.server_stats}
+            finally:
+                # SIGINT stops the server cleanly, printing its log records
+                proc.send_signal(signal.SIGINT)
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+                server_log.close()
+            with open(server_log.name) as f:
+                server["log"] = next((line.strip() for line in f if "log records" in line), None)
+        finally:
+            for helper in helpers:
+                helper.terminate()
+                helper.wait()
+
+    operations, total = summarize(samples, elapsed)
+    settings = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    results = {"commit": current_commit(), "date": datetime.now().isoformat(timespec='seconds'),
+               "settings": settings, "seconds": round(elapsed, 3),
+               "operations": operations, "total": total, "server": server}
+
+    print(f"{args.users} users, {elapsed:.1f} s, "
+          f"{'sessions' if args.persistent or args.protocol == 2 else 'connection per request'}")
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == "__main__":
+    main()
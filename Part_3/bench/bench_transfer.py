@@ -0,0 +1,117 @@
+"""
+Benchmark of the P2P serving side (UploadServer.handle of p2p_client).
+
+Serves a large file to a receiver process over a local TCP socket, once with
+the old read/send loop in 4096-byte chunks and once with the current
+sendfile path on the event loop. Reports throughput and the CPU time the
+serving thread spends per GB.
+
+Usage: python3 bench_transfer.py [--size-mb 1024] [--file path]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import p2p_client
+
+
+# Old serving loop kept here as the baseline
+def handle_file_transfer_chunked(client_socket, client_address):
+    try:
+        reader = p2p_client.FramedReader(client_socket)
+        if reader.read_string() == "GET_FILE":
+            file_name = reader.read_string()
+            client_socket.send(b'\x00')
+            client_socket.sendall(str(os.path.getsize(file_name)).encode() + b'\0')
+            with open(file_name, 'rb') as f:
+                data = f.read(4096)
+                while data:
+                    client_socket.send(data)
+                    data = f.read(4096)
+    finally:
+        client_socket.close()
+
+
+# Current serving path, on an event loop of the serving thread
+def handle_file_transfer_sendfile(client_socket, client_address):
+    uploads = p2p_client.UploadServer(p2p_client.Client(None, None))
+    client_socket.setblocking(False)
+    asyncio.run(uploads.handle(client_socket))
+
+
+# Receiver process: requests the file and drains the socket
+def receive(address, file_name):
+    sock = socket.create_connection(address)
+    sock.sendall(p2p_client.encode_request(("GET_FILE", file_name)))
+    buffer = memoryview(bytearray(1 << 20))
+    while sock.recv_into(buffer):
+        pass
+    sock.close()
+
+
+def run(name, handler, file_name, size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    receiver = multiprocessing.Process(target=receive, args=(listener.getsockname(), file_name))
+    receiver.start()
+
+    conn, address = listener.accept()
+    result = {}
+
+    # Serve in a thread so its CPU time can be measured on its own
+    def serve():
+        cpu = time.thread_time()
+        start = time.perf_counter()
+        handler(conn, address)
+        result['wall'] = time.perf_counter() - start
+        result['cpu'] = time.thread_time() - cpu
+
+    server = threading.Thread(target=serve)
+    server.start()
+    server.join()
+    receiver.join()
+    listener.close()
+
+    gb = size / (1 << 30)
+    print(f"{name:10s} {size / (1 << 20) / result['wall']:10.1f} MB/s   "
+          f"serving CPU {result['cpu'] / gb:7.3f} s/GB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024, help='Size of the test file')
+    parser.add_argument('--file', help='Serve this file instead of a generated one')
+    args = parser.parse_args()
+
+    if args.file:
+        file_name = args.file
+        cleanup = False
+    else:
+        fd, file_name = tempfile.mkstemp(prefix='bench_transfer_')
+        # Write real data so both runs read from the page cache
+        block = os.urandom(1 << 20)
+        with os.fdopen(fd, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(block)
+        cleanup = True
+
+    try:
+        size = os.path.getsize(file_name)
+        print(f"Serving {size / (1 << 20):.0f} MB")
+        run("chunked", handle_file_transfer_chunked, file_name, size)
+        run("sendfile", handle_file_transfer_sendfile, file_name, size)
+    finally:
+        if cleanup:
+            os.remove(file_name)
+
+
+if __name__ == "__main__":
+    main()
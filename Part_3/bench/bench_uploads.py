@@ -0,0 +1,190 @@
+"""
+Load test of the peer-serving side (UploadServer of p2p_client).
+
+Runs a seeder process that serves one file, then opens many concurrent
+downloaders against it. The seeder runs either the listener of client.py
+before the upload pool (one new thread per peer, blocking sends of 4 KB)
+or the upload server of the library (event loop, bounded uploads and
+queue). Downloaders use a small receive buffer and do not read for --hold
+seconds, so their transfers are in flight at the same time instead of
+finishing one after the other. The RSS and thread count of the seeder are
+sampled during the whole run and reported with the completed downloads.
+
+Usage: python3 bench_uploads.py [--downloaders 1000] [--size-kb 1024]
+                                [--max-uploads 16] [--upload-queue 64]
+                                [--hold 1] [--rcvbuf-kb 16]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import p2p_client
+
+
+# Serving of a GET_FILE by client.py before the upload pool (the baseline):
+# blocking socket, file sent in chunks of 4 KB
+def handle_file_transfer(client_socket):
+    try:
+        reader = p2p_client.FramedReader(client_socket)
+        operation = reader.read_string()
+
+        if operation == "GET_FILE":
+            file_name = reader.read_string()
+
+            if not os.path.isfile(file_name):
+                client_socket.send(b'\x01')  # Code 1: File does not exist
+                return
+
+            client_socket.send(b'\x00')  # Code 0: Success
+            file_size = os.path.getsize(file_name)
+            client_socket.sendall(str(file_size).encode() + b'\0')
+
+            with open(file_name, 'rb') as f:
+                data = f.read(4096)
+                while data:
+                    client_socket.sendall(data)
+                    data = f.read(4096)
+    except Exception as e:
+        print(f"Error in file transfer: {e}")
+    finally:
+        client_socket.close()
+
+
+# Listener of client.py before the upload pool: one thread per peer
+def listener_unbounded(listener):
+    while True:
+        client_socket, _ = listener.accept()
+        transfer_thread = threading.Thread(target=handle_file_transfer, args=(client_socket,))
+        transfer_thread.daemon = True
+        transfer_thread.start()
+
+
+async def serve_uploads(api, ports):
+    uploads = p2p_client.UploadServer(api)
+    ports.put(await uploads.start())
+    await asyncio.Event().wait()
+
+
+# Seeder process: runs a listener and reports its port
+def seeder(mode, max_uploads, upload_queue, ports):
+    if mode == "unbounded":
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('0.0.0.0', 0))
+        listener.listen(1024)
+        ports.put(listener.getsockname()[1])
+        listener_unbounded(listener)
+    else:
+        api = p2p_client.Client(None, None, max_uploads=max_uploads,
+                                upload_queue_depth=upload_queue)
+        asyncio.run(serve_uploads(api, ports))
+
+
+# Function to read RSS (kB) and thread count of a process
+def sample(pid):
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ("VmRSS", "Threads"):
+                values[key] = int(value.split()[0])
+    return values.get("VmRSS", 0), values.get("Threads", 0)
+
+
+# Downloader: sends the request, then waits for reading before receiving
+# the file. The small receive buffer keeps most of the file at the seeder.
+async def download(port, file_name, rcvbuf, reading, results):
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+        except BaseException:
+            sock.close()
+            raise
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writer.write(b"GET_FILE\0" + file_name.encode() + b"\0")
+        await writer.drain()
+        await reading.wait()
+        received = 0
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received += len(data)
+        writer.close()
+        results.append(received)
+    except OSError:
+        results.append(-1)
+
+
+async def load(port, file_name, args, pid, samples):
+    results = []
+    reading = asyncio.Event()
+    tasks = [asyncio.create_task(download(port, file_name, args.rcvbuf_kb * 1024, reading, results))
+             for _ in range(args.downloaders)]
+    start = time.perf_counter()
+    while not all(task.done() for task in tasks):
+        samples.append(sample(pid))
+        if not reading.is_set() and time.perf_counter() - start >= args.hold:
+            reading.set()
+        await asyncio.sleep(0.2)
+    return results
+
+
+def run(mode, args, file_name, size):
+    # Spawn a fresh seeder so it does not inherit the memory of this process
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    proc = context.Process(target=seeder,
+                           args=(mode, args.max_uploads, args.upload_queue, ports))
+    proc.start()
+    port = ports.get()
+    idle_rss, _ = sample(proc.pid)
+
+    samples = []
+    start = time.perf_counter()
+    results = asyncio.run(load(port, file_name, args, proc.pid, samples))
+    elapsed = time.perf_counter() - start
+    proc.terminate()
+    proc.join()
+
+    complete = sum(1 for received in results if received >= size)
+    peak_rss = max(rss for rss, _ in samples) if samples else idle_rss
+    peak_threads = max(threads for _, threads in samples) if samples else 0
+    print(f"{mode:10s} complete {complete:5d}/{args.downloaders}   {elapsed:6.2f} s   "
+          f"RSS idle {idle_rss / 1024:6.1f} MB peak {peak_rss / 1024:6.1f} MB   "
+          f"peak threads {peak_threads}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--downloaders', type=int, default=1000, help='Concurrent downloaders')
+    parser.add_argument('--size-kb', type=int, default=1024, help='Size of the served file')
+    parser.add_argument('--max-uploads', type=int, default=16, help='Upload workers')
+    parser.add_argument('--upload-queue', type=int, default=64, help='Upload queue depth')
+    parser.add_argument('--hold', type=float, default=1,
+                        help='Seconds the downloaders wait before reading')
+    parser.add_argument('--rcvbuf-kb', type=int, default=16, help='Receive buffer of the downloaders')
+    args = parser.parse_args()
+
+    fd, file_name = tempfile.mkstemp(prefix='bench_uploads_')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(os.urandom(args.size_kb * 1024))
+    try:
+        print(f"{args.downloaders} downloaders of a {args.size_kb} KB file")
+        run("unbounded", args, file_name, args.size_kb * 1024)
+        run("pool", args, file_name, args.size_kb * 1024)
+    finally:
+        os.remove(file_name)
+
+
+if __name__ == "__main__":
+    main()
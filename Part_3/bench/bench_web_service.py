@@ -0,0 +1,122 @@
+"""
+Load benchmark of the /fecha web service.
+
+Starts web_service.py in Flask mode and in async mode, drives each one with
+concurrent keep-alive clients for a fixed time and reports req/s and latency
+percentiles (p50/p99).
+
+Usage: python3 bench_web_service.py [--clients 200] [--duration 10]
+                                    [--workers 1] [--path /fecha]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+WEB_SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_service.py')
+
+
+# Function to read one HTTP response, returns False if the server closes
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = 0
+    close = False
+    for line in head.decode('latin-1').split('\r\n')[1:]:
+        key, _, value = line.partition(':')
+        key = key.strip().lower()
+        if key == 'content-length':
+            length = int(value)
+        elif key == 'connection' and value.strip().lower() == 'close':
+            close = True
+    await reader.readexactly(length)
+    return not close
+
+
+# One simulated client: sequential requests, reconnecting when needed
+async def run_client(port, path, deadline, latencies, errors):
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            start = time.perf_counter()
+            writer.write(request)
+            keep = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if not keep:
+                writer.close()
+                writer = None
+        except (ConnectionError, asyncio.IncompleteReadError, OSError):
+            errors[0] += 1
+            if writer:
+                writer.close()
+            writer = None
+    if writer:
+        writer.close()
+
+
+async def load(port, path, clients, duration):
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(run_client(port, path, deadline, latencies, errors)
+                           for _ in range(clients)))
+    return latencies, errors[0]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Function to wait until the service accepts connections
+def wait_ready(port, timeout=10):
+    import socket
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def bench(name, args, port, extra):
+    proc = subprocess.Popen([sys.executable, WEB_SERVICE, '--host', '127.0.0.1',
+                             '--port', str(port)] + extra,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_ready(port):
+            print(f"{name}: service did not start")
+            return
+        latencies, errors = asyncio.run(load(port, args.path, args.clients, args.duration))
+        print(f"{name:8s} {len(latencies) / args.duration:10.0f} req/s   "
+              f"p50 {percentile(latencies, 50) * 1000:8.2f} ms   "
+              f"p99 {percentile(latencies, 99) * 1000:8.2f} ms   errors {errors}")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=200, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per run')
+    parser.add_argument('--workers', type=int, default=1, help='Workers in async mode')
+    parser.add_argument('--path', default='/fecha', help='Request target')
+    parser.add_argument('--port', type=int, default=5100, help='First port to use')
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients, {args.duration:.0f} s per run, GET {args.path}")
+    bench("flask", args, args.port, ['--mode', 'flask'])
+    bench("async", args, args.port + 1, ['--mode', 'async', '--workers', str(args.workers)])
+
+
+if __name__ == "__main__":
+    main()
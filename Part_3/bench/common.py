@@ -0,0 +1,83 @@
+"""
+Helpers shared by the benchmarks that drive the main server.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from client import client
+import p2p_client
+import server_stats
+
+SERVER_BIN = os.path.join(BENCH_DIR, '..', 'server')
+
+
+# Function to start the C server on a local port. Its output is discarded
+# unless stdout is an open file.
+def start_server(port, binary=SERVER_BIN, args=(), env=None, stdout=subprocess.DEVNULL):
+    proc = subprocess.Popen([binary, '-p', str(port)] + list(args), env=env,
+                            stdout=stdout, stderr=subprocess.DEVNULL)
+    if not wait_port(port):
+        proc.terminate()
+        raise RuntimeError(f"server {binary} did not start on port {port}")
+    return proc
+
+
+# Function to wait until a local port accepts connections
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+# Function to read the resident set size of a process in kB
+def process_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Function to open a control connection (session mode) with the server
+def open_session(host, port, version=1):
+    return client.ControlConnection(socket.create_connection((host, port)), version)
+
+
+# Function to send requests over a control connection keeping up to window
+# of them in flight. Each request is a list of string and integer fields;
+# only requests whose reply is a single response code are supported.
+# Returns the codes.
+def pipeline(conn, requests, window=64):
+    codes = []
+    in_flight = 0
+    for fields in requests:
+        for field in fields:
+            if isinstance(field, int):
+                conn.send_int(field)
+            else:
+                conn.send_string(field)
+        conn.flush()
+        in_flight += 1
+        if in_flight == window:
+            codes.append(conn.read_reply().read_byte())
+            in_flight -= 1
+    for _ in range(in_flight):
+        codes.append(conn.read_reply().read_byte())
+    return codes
@@ -1,11 +1,14 @@
 from enum import Enum
 import argparse
-import socket
+import asyncio
 import threading
+import json
 import os
 import sys
+from datetime import datetime
 import time
 import requests  # Required for HTTP requests
+import p2p_client
 
 class client:
     # ******************** TYPES *********************
@@ -16,543 +19,446 @@ class client:
         ERROR = 1
         USER_ERROR = 2
 
+    # *
+    # * @brief Types of the client library (p2p_client.py) used by scripts
+    RequestError = p2p_client.RequestError
+    FramedReader = p2p_client.FramedReader
+    FrameReader = p2p_client.FrameReader
+    ControlConnection = p2p_client.ControlConnection
+
+    # *
+    # * @brief Timestamp source backed by the /fecha web service. It syncs with
+    # *        the service on a background schedule and keeps the offset
+    # *        between the service clock and the local monotonic clock, so
+    # *        timestamps are served locally without an HTTP call per operation.
+    class TimestampProvider:
+        FORMAT = "%d/%m/%Y %H:%M:%S"
+
+        def __init__(self, url, interval=30.0, timeout=2.0, max_staleness=300.0):
+            self._url = url
+            self._interval = interval
+            self._timeout = timeout
+            self._max_staleness = max_staleness
+            self._session = requests.Session()
+            self._lock = threading.Lock()
+            self._stop = threading.Event()
+            self._thread = None
+            self._offset = None      # Service time minus monotonic time (s)
+            self._low = None         # Bounds of the offset from the syncs
+            self._high = None
+            self._last_sync = None   # Monotonic time of the last good sync
+            self._syncs = 0
+            self._sync_failures = 0
+            self._fallbacks = 0
+            self._last_drift_us = 0
+            self._max_drift_us = 0
+            self._failing = False
+
+        # Function to sync once and start the background sync thread
+        def start(self):
+            self.sync()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+        def stop(self):
+            self._stop.set()
+
+        def _run(self):
+            while not self._stop.wait(self._interval):
+                self.sync()
+
+        # Function to query the web service and update the clock offset
+        def sync(self):
+            try:
+                sent = time.monotonic()
+                response = self._session.get(self._url, timeout=self._timeout)
+                received = time.monotonic()
+                if response.status_code != 200:
+                    raise ValueError(f"status {response.status_code}")
+                service_time = datetime.strptime(response.json()["fecha"],
+                                                 client.TimestampProvider.FORMAT).timestamp()
+            except Exception as e:
+                with self._lock:
+                    self._sync_failures += 1
+                    failing, self._failing = self._failing, True
+                if not failing:
+                    print(f"Error connecting to web service: {e}", file=sys.stderr)
+                return False
+
+            # The service has one second resolution, so a reply only bounds the
+            # offset. Bounds of successive syncs are intersected to narrow it
+            # down; disjoint bounds mean the service clock moved and restart it.
+            low = service_time - received
+            high = service_time + 1 - sent
+            with self._lock:
+                if self._offset is not None and low <= self._high and high >= self._low:
+                    low = max(low, self._low)
+                    high = min(high, self._high)
+                self._low, self._high = low, high
+                offset = (low + high) / 2
+                if self._offset is not None:
+                    drift_us = int((offset - self._offset) * 1000000)
+                    self._last_drift_us = drift_us
+                    self._max_drift_us = max(self._max_drift_us, abs(drift_us))
+                self._offset = offset
+                self._last_sync = received
+                self._syncs += 1
+                self._failing = False
+            return True
+
+        # Function to get the current time in microseconds since the epoch.
+        # Falls back to the local clock if the last sync is too old.
+        def now_us(self):
+            now = time.monotonic()
+            with self._lock:
+                if self._offset is not None and now - self._last_sync <= self._max_staleness:
+                    return int((now + self._offset) * 1000000)
+                self._fallbacks += 1
+            return time.time_ns() // 1000
+
+        # Function to get the current time formatted for the protocol
+        def now(self):
+            return datetime.fromtimestamp(self.now_us() / 1000000).strftime(
+                client.TimestampProvider.FORMAT)
+
+        # Function to get the sync counters
+        def stats(self):
+            with self._lock:
+                return {
+                    "sync_age_s": None if self._last_sync is None
+                                  else time.monotonic() - self._last_sync,
+                    "last_drift_us": self._last_drift_us,
+                    "max_drift_us": self._max_drift_us,
+                    "syncs": self._syncs,
+                    "sync_failures": self._sync_failures,
+                    "fallbacks": self._fallbacks,
+                }
+
     # ****************** ATTRIBUTES ******************
+    _recv_buffer_size = 1 << 20     # Reusable buffer for downloads
+    _segment_size = 4 << 20         # Bytes per segment in multi-source downloads
+    _max_sources = 8                # Peers used at once in multi-source downloads
+    _stall_timeout = 10.0           # Seconds without data before a peer is dropped
+    _checkpoint_size = 8 << 20      # Bytes between journal records in downloads
+    _max_uploads = 16               # Files served to peers at once
+    _upload_queue_depth = 64        # Accepted peers waiting for an upload worker
+    _upload_timeout = 30.0          # Seconds a served peer may stay idle
+    _bytes_saved = 0                # Bytes not downloaded again thanks to resuming
+    _socket_buffer_size = None      # SO_RCVBUF/SO_SNDBUF for transfers, None keeps the OS default
     _server = None
     _port = -1
-    _listener_socket = None
-    _listener_thread = None
     _connected_user = None
     _registered_user = None
-    _listening_port = None
-    _running = True
     _web_service_url = "http://localhost:5000/fecha"  # Web service URL
+    _time_sync_interval = 30.0
+    _time_max_staleness = 300.0
+    _timestamps = None
+    _persistent = False
+    _protocol = 1                   # Framing of the control connection (1 or 2)
+    _peer_cache_ttl = 30.0          # Seconds a resolved peer is reused
+    _content_page_size = 500        # Files per LIST_CONTENT_PAGE request
+    _search_page_size = 20          # Results per SEARCH request
+    _api = None                     # Library client, created on first use
+    _loop = None                    # Event loop of the library, run by a background thread
+    _stats_file = None              # File of the metrics of the client
+    _stats_format = "json"          # Format of the stats file (json or prometheus)
+    _stats_interval = 0             # Seconds between writes of the stats file, 0 = only STATS and exit
+    _batch = None                   # File of commands to run instead of the shell
+    _batch_output = '-'             # File of the JSON results of the batch
+    _batch_window = 64              # Batch commands in flight
+    
+    # Settings of the library client, taken from the attributes with a '_' prefix
+    SETTINGS = ("recv_buffer_size", "segment_size", "max_sources", "stall_timeout",
+                "checkpoint_size", "max_uploads", "upload_queue_depth", "upload_timeout",
+                "socket_buffer_size", "peer_cache_ttl", "content_page_size", "search_page_size")
 
     # ******************** METHODS *******************
-    # Function to get date and time from web service
+    # Function to get date and time, served locally from the timestamp
+    # provider that syncs with the web service in the background
     @staticmethod
     def get_datetime():
-        try:
-            response = requests.get(client._web_service_url)
-            if response.status_code == 200:
-                return response.json()["fecha"]
-            else:
-                print(f"Error getting date from web service: {response.status_code}")
-                return "00/00/0000 00:00:00"  # Default value in case of error
-        except Exception as e:
-            print(f"Error connecting to web service: {e}")
-            return "00/00/0000 00:00:00"  # Default value in case of error
-
-    # Function to establish connection with server
+        if client._timestamps is None:
+            client._timestamps = client.TimestampProvider(
+                client._web_service_url,
+                interval=client._time_sync_interval,
+                max_staleness=client._time_max_staleness)
+            client._timestamps.start()
+        return client._timestamps.now()
+
+    # Function to run a coroutine of the library on its event loop and wait
+    # for the result. The loop runs in a background thread, where it also
+    # serves the files of the connected user to its peers.
     @staticmethod
-    def connect_to_server():
+    def run(coroutine):
+        if client._loop is None:
+            client._loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=client._loop.run_forever)
+            thread.daemon = True
+            thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, client._loop).result()
+
+    # Function to run a request of the library. Returns the response code
+    # (None if the server is unreachable) and the result.
+    @staticmethod
+    def call(coroutine):
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((client._server, client._port))
-            return sock
+            return 0, client.run(coroutine)
+        except client.RequestError as e:
+            return e.code, None
         except Exception as e:
-            print(f"Error connecting to server: {e}")
-            return None
+            return None, None
 
-    # Function to send strings through socket
+    # Function to get the library client, created from the settings
     @staticmethod
-    def send_string(sock, string):
-        sock.sendall(string.encode() + b'\0')
-
-    # Function to receive strings from socket
+    def api():
+        if client._api is None:
+            # Start the timestamp provider before the event loop asks for dates
+            client.get_datetime()
+            settings = {name: getattr(client, "_" + name) for name in client.SETTINGS}
+            client._api = p2p_client.Client(client._server, client._port,
+                                            persistent=client._persistent,
+                                            protocol=client._protocol,
+                                            timestamp=client.get_datetime, **settings)
+        return client._api
+
+    # Function to get the library user that sends the requests of username
     @staticmethod
-    def receive_string(sock):
-        data = bytearray()
-        while True:
-            byte = sock.recv(1)
-            if not byte or byte == b'\0':
-                break
-            data.extend(byte)
-        return data.decode()
+    def user(username):
+        return client.api().user(username or p2p_client.NONE_USER)
 
-    # Function to find a free port and create listener socket
+    # Function to close the connections with the server
     @staticmethod
-    def create_listener_socket():
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('0.0.0.0', 0))  # Random port
-        sock.listen(5)
-        return sock, sock.getsockname()[1]
+    def close_control():
+        api, client._api = client._api, None
+        if api:
+            client.run(api.close())
 
-    # Function that handles file transfers
+    # Function to update the table of connected users of username. Returns
+    # the response code (None if the server is unreachable).
     @staticmethod
-    def handle_file_transfer(client_socket, client_address):
-        try:
-            # Receive command
-            operation = client.receive_string(client_socket)
-            
-            if operation == "GET_FILE":
-                # Receive file name
-                file_name = client.receive_string(client_socket)
-                
-                # Check if file exists
-                if not os.path.isfile(file_name):
-                    client_socket.send(b'\x01')  # Code 1: File does not exist
-                    return
-                
-                # Send success code
-                client_socket.send(b'\x00')  # Code 0: Success
-                
-                # Get file size
-                file_size = os.path.getsize(file_name)
-                client.send_string(client_socket, str(file_size))
-                
-                # Send file content
-                with open(file_name, 'rb') as f:
-                    data = f.read(4096)
-                    while data:
-                        client_socket.send(data)
-                        data = f.read(4096)
-        except Exception as e:
-            print(f"Error in file transfer: {e}")
-        finally:
-            client_socket.close()
+    def sync_users(username):
+        response, _ = client.call(client.user(username).sync_users())
+        return response
 
-    # Function for listener thread
+    # Function to request the list of connected users on behalf of username.
+    # Returns the response code (None if the server is unreachable) and the
+    # list of (username, ip, port) entries.
     @staticmethod
-    def listener_thread():
-        while client._running:
-            try:
-                client_socket, client_address = client._listener_socket.accept()
-                # Create thread to handle file transfer
-                transfer_thread = threading.Thread(
-                    target=client.handle_file_transfer,
-                    args=(client_socket, client_address)
-                )
-                transfer_thread.daemon = True
-                transfer_thread.start()
-            except Exception as e:
-                if client._running:
-                    print(f"Error in listener thread: {e}")
-                break
+    def query_users(username):
+        response, users = client.call(client.user(username).list_users())
+        return response, users or []
+
+    # Generator of the (file name, description) entries published by
+    # remote_user whose name starts with prefix. Files are requested one
+    # page at a time, so memory use does not grow with the number of files.
+    # They come in publish order: a file deleted or published while the
+    # listing runs may be missing or included, but no other file is skipped
+    # or repeated.
+    # Raises RequestError if the server answers with an error code.
+    @staticmethod
+    def iter_content(remote_user, prefix="", page_size=None, username=None):
+        user = client.user(username or client._registered_user)
+        cursor = 0
+        while cursor != -1:
+            page = client.run(user.content_page(remote_user, cursor, page_size, prefix))
+            cursor = page.next_cursor
+            yield from page.files
+
+    # Function to search the files of every user whose name or description
+    # contains all the words of query, on behalf of username. Returns the
+    # response code (None if the server is unreachable), the total number of
+    # results, the cursor of the next page (-1 after the last one) and the
+    # list of (username, file name, description, score) results.
+    @staticmethod
+    def search(query, cursor=0, limit=None, username=None):
+        user = client.user(username or client._registered_user)
+        response, page = client.call(user.search(query, cursor, limit))
+        if response != 0:
+            return response, 0, -1, []
+        return response, page.total, page.next_cursor, page.results
 
     # Register method
     @staticmethod
     def register(user):
-        sock = client.connect_to_server()
-        if not sock:
-            print("c > REGISTER FAIL")
-            return client.RC.ERROR
+        response, _ = client.call(client.user(user).register())
         
-        try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation
-            client.send_string(sock, "REGISTER")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username
-            client.send_string(sock, user)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response == 0:
-                print("c > REGISTER OK")
-                client._registered_user = user
-                return client.RC.OK
-            elif response == 1:
-                print("c > USERNAME IN USE")
-                return client.RC.USER_ERROR
-            else:
-                print("c > REGISTER FAIL")
-                return client.RC.ERROR
-        except Exception as e:
-            print(f"c > REGISTER FAIL")
+        if response == 0:
+            print("c > REGISTER OK")
+            client._registered_user = user
+            return client.RC.OK
+        elif response == 1:
+            print("c > USERNAME IN USE")
+            return client.RC.USER_ERROR
+        else:
+            print("c > REGISTER FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
 
     # Unregister method
     @staticmethod
     def unregister(user):
-        sock = client.connect_to_server()
-        if not sock:
-            client._registered_user = None
-            print("c > UNREGISTER FAIL")
-            return client.RC.ERROR
+        # Disconnect if connected with this user
+        if client._connected_user == user:
+            client.disconnect(user)
         
-        try:
-            # Disconnect if connected with this user
-            if client._connected_user == user:
-                client.disconnect(user)
-            
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation
-            client.send_string(sock, "UNREGISTER")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username
-            client.send_string(sock, user)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response == 0:
-                client._registered_user = None
-                print("c > UNREGISTER OK")
-                return client.RC.OK
-            elif response == 1:
-                client._registered_user = None
-                print("c > USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            else:
-                client._registered_user = None
-                print("c > UNREGISTER FAIL")
-                return client.RC.ERROR
-        except Exception as e:
-            client._registered_user = None
+        response, _ = client.call(client.user(user).unregister())
+        client._registered_user = None
+        
+        if response == 0:
+            print("c > UNREGISTER OK")
+            return client.RC.OK
+        elif response == 1:
+            print("c > USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        else:
             print("c > UNREGISTER FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
 
-    # Connect method
+    # Connect method: peers download the files of the user from an upload
+    # server started on a free port
     @staticmethod
     def connect(user):
-                
-        # Create listener socket if it doesn't exist
-        if not client._listener_socket:
-            try:
-                client._listener_socket, client._listening_port = client.create_listener_socket()
-                # Create listener thread
-                client._running = True
-                client._listener_thread = threading.Thread(target=client.listener_thread)
-                client._listener_thread.daemon = True
-                client._listener_thread.start()
-            except Exception as e:
-                print(f"c > CONNECT FAIL")
-                return client.RC.ERROR
-        
-        sock = client.connect_to_server()
-        if not sock:
-            print("c > CONNECT FAIL")
-            return client.RC.ERROR
+        response, _ = client.call(client.user(user).connect())
         
-        try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-
-            # Send operation
-            client.send_string(sock, "CONNECT")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username
-            client.send_string(sock, user)
-            # Send listening port
-            client.send_string(sock, str(client._listening_port))
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response == 0:
-                client._connected_user = user
-                print("c > CONNECT OK")
-                return client.RC.OK
-            elif response == 1:
-                print("c > CONNECT FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response == 2:
-                print("c > USER ALREADY CONNECTED")
-                return client.RC.USER_ERROR
-            else:
-                print("c > CONNECT FAIL")
-                return client.RC.ERROR
-        except Exception as e:
+        if response == 0:
+            client._connected_user = user
+            print("c > CONNECT OK")
+            return client.RC.OK
+        elif response == 1:
+            print("c > CONNECT FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response == 2:
+            print("c > USER ALREADY CONNECTED")
+            return client.RC.USER_ERROR
+        else:
             print("c > CONNECT FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
 
-    # Disconnect method
+    # Disconnect method: the upload server is always closed
     @staticmethod
     def disconnect(user):
+        response, _ = client.call(client.user(user).disconnect())
+        client._connected_user = None
         
-        sock = client.connect_to_server()
-        if not sock:
-            # Even if server communication fails, close listener socket
-            client._running = False
-            if client._listener_socket:
-                client._listener_socket.close()
-                client._listener_socket = None
-            if client._listener_thread:
-                client._listener_thread.join(1)
-                client._listener_thread = None
-            client._connected_user = None
-            print("c > DISCONNECT FAIL")
-            return client.RC.ERROR
-        
-        try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation
-            client.send_string(sock, "DISCONNECT")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username
-            client.send_string(sock, user)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            # Always close listener socket
-            client._running = False
-            if client._listener_socket:
-                client._listener_socket.close()
-                client._listener_socket = None
-            if client._listener_thread:
-                client._listener_thread.join(1)
-                client._listener_thread = None
-            
-            if response == 0:
-                client._connected_user = None
-                print("c > DISCONNECT OK")
-                return client.RC.OK
-            elif response == 1:
-                client._connected_user = None
-                print("c > DISCONNECT FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response == 2:
-                client._connected_user = None
-                print("c > DISCONNECT FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            else:
-                client._connected_user = None
-                print("c > DISCONNECT FAIL")
-                return client.RC.ERROR
-        except Exception as e:
-            # Even if it fails, close listener socket
-            client._running = False
-            if client._listener_socket:
-                client._listener_socket.close()
-                client._listener_socket = None
-            if client._listener_thread:
-                client._listener_thread.join(1)
-                client._listener_thread = None
-            client._connected_user = None
+        if response == 0:
+            print("c > DISCONNECT OK")
+            return client.RC.OK
+        elif response == 1:
+            print("c > DISCONNECT FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response == 2:
+            print("c > DISCONNECT FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        else:
             print("c > DISCONNECT FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
+
+    # Function to create a published file that does not exist, using the
+    # description as content
+    @staticmethod
+    def create_published(fileName, description):
+        if not os.path.isfile(fileName):
+            with open(fileName, 'w') as f:
+                f.write(description + '\n')
+
+    # Function to delete the local copy of a deleted file, if it exists
+    @staticmethod
+    def remove_deleted(fileName):
+        if os.path.exists(fileName):
+            os.remove(fileName)
 
     # Publish method
     @staticmethod
     def publish(fileName, description):
-                
-        sock = client.connect_to_server()
-        if not sock:
-            print("c > PUBLISH FAIL")
-            return client.RC.ERROR
-        
-        try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation
-            client.send_string(sock, "PUBLISH")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username (can be None if not registered)
-            if not client._registered_user:
-                client.send_string(sock, "__NONE__")  # Send empty string if no user
-            else:
-                client.send_string(sock, client._registered_user)
-            # Send file name
-            client.send_string(sock, fileName)
-            # Send description
-            client.send_string(sock, description)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response == 0:
-                print("c > PUBLISH OK")
-                # If file doesn't exist, create it using description as content
-                if not os.path.isfile(fileName):
-                    with open(fileName, 'w') as f:
-                        f.write(description + '\n')
-                return client.RC.OK
-            elif response == 1:
-                print("c > PUBLISH FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response == 2:
-                print("c > PUBLISH FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            elif response == 3:
-                print("c > PUBLISH FAIL, CONTENT ALREADY PUBLISHED")
-                return client.RC.USER_ERROR
-                
-            else:
-                print("c > PUBLISH FAIL")
-                return client.RC.ERROR
-        except Exception as e:
+        # Username can be None if not registered
+        user = client.user(client._registered_user)
+        response, _ = client.call(user.publish(fileName, description))
         
+        if response == 0:
+            print("c > PUBLISH OK")
+            client.create_published(fileName, description)
+            return client.RC.OK
+        elif response == 1:
+            print("c > PUBLISH FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response == 2:
+            print("c > PUBLISH FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        elif response == 3:
+            print("c > PUBLISH FAIL, CONTENT ALREADY PUBLISHED")
+            return client.RC.USER_ERROR
+        else:
             print("c > PUBLISH FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
 
     # Delete method
     @staticmethod
     def delete(fileName):
-                
-        sock = client.connect_to_server()
-        if not sock:
-            print("c > DELETE FAIL")
-            return client.RC.ERROR
+        # Username can be None if not registered
+        user = client.user(client._registered_user)
+        response, _ = client.call(user.delete(fileName))
         
-        try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation
-            client.send_string(sock, "DELETE")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username (can be None if not registered)
-            if not client._registered_user:
-                client.send_string(sock, "__NONE__")  # Send empty string if no user
-            else:
-                client.send_string(sock, client._registered_user)
-            # Send file name
-            client.send_string(sock, fileName)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response == 0:
-                print("c > DELETE OK")
-                # Delete local file if it exists
-                if os.path.exists(fileName):
-                    os.remove(fileName)
-                return client.RC.OK
-            elif response == 1:
-                print("c > DELETE FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response == 2:
-                print("c > DELETE FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            elif response == 3:
-                print("c > DELETE FAIL, CONTENT NOT PUBLISHED")
-                return client.RC.USER_ERROR
-            else:
-                print("c > DELETE FAIL")
-                return client.RC.ERROR
-        except Exception as e:
+        if response == 0:
+            print("c > DELETE OK")
+            client.remove_deleted(fileName)
+            return client.RC.OK
+        elif response == 1:
+            print("c > DELETE FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response == 2:
+            print("c > DELETE FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        elif response == 3:
+            print("c > DELETE FAIL, CONTENT NOT PUBLISHED")
+            return client.RC.USER_ERROR
+        else:
             print("c > DELETE FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
 
     # ListUsers method
     @staticmethod
     def listusers():
-                
-        sock = client.connect_to_server()
-        if not sock:
-            print("c > LIST_USERS FAIL")
-            return client.RC.ERROR
+        # Username can be None if not registered
+        response, users = client.query_users(client._registered_user)
         
-        try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation
-            client.send_string(sock, "LIST_USERS")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username (can be None if not registered)
-            if not client._registered_user:
-                client.send_string(sock, "__NONE__")  # Send empty string if no user
-            else:
-                client.send_string(sock, client._registered_user)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response == 0:
-                # Receive number of users
-                num_users_str = client.receive_string(sock)
-                num_users = int(num_users_str)
-                
-                print("c > LIST_USERS OK")
-                # Receive information for each user
-                for _ in range(num_users):
-                    username = client.receive_string(sock)
-                    ip = client.receive_string(sock)
-                    port = client.receive_string(sock)
-                    print(f"{username} {ip} {port}")
-                
-                return client.RC.OK
-            elif response == 1:
-                print("c > LIST_USERS FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response == 2:
-                print("c > LIST_USERS FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            else:
-                print("c > LIST_USERS FAIL")
-                return client.RC.ERROR
-        except Exception as e:
+        if response == 0:
+            print("c > LIST_USERS OK")
+            for username, ip, port in users:
+                print(f"{username} {ip} {port}")
+            return client.RC.OK
+        elif response == 1:
+            print("c > LIST_USERS FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response == 2:
+            print("c > LIST_USERS FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        else:
             print("c > LIST_USERS FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
 
     # ListContent method
     @staticmethod
     def listcontent(user):
-                
-        sock = client.connect_to_server()
-        if not sock:
-            print("c > LIST_CONTENT FAIL")
-            return client.RC.ERROR
         
         try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation
-            client.send_string(sock, "LIST_CONTENT")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username (can be None if not registered)
-            if not client._registered_user:
-                client.send_string(sock, "__NONE__")  # Send empty string if no user
-            else:
-                client.send_string(sock, client._registered_user)
-            # Send remote username
-            client.send_string(sock, user)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response == 0:
-                # Receive number of files
-                num_files_str = client.receive_string(sock)
-                num_files = int(num_files_str)
-                
-                print("c > LIST_CONTENT OK")
-                # Receive name of each file
-                for _ in range(num_files):
-                    filename = client.receive_string(sock)
+            # Files are received and printed one page at a time
+            files = client.iter_content(user)
+            first = next(files, None)
+            
+            print("c > LIST_CONTENT OK")
+            if first:
+                print(f"{first[0]}")
+                for filename, _ in files:
                     print(f"{filename}")
-                
-                return client.RC.OK
-            elif response == 1:
+            return client.RC.OK
+        except client.RequestError as e:
+            if e.code == 1:
                 print("c > LIST_CONTENT FAIL, USER DOES NOT EXIST")
                 return client.RC.USER_ERROR
-            elif response == 2:
+            elif e.code == 2:
                 print("c > LIST_CONTENT FAIL, USER NOT CONNECTED")
                 return client.RC.USER_ERROR
-            elif response == 3:
+            elif e.code == 3:
                 print("c > LIST_CONTENT FAIL, REMOTE USER DOES NOT EXIST")
                 return client.RC.USER_ERROR
             else:
@@ -561,122 +467,320 @@ class client:
         except Exception as e:
             print("c > LIST_CONTENT FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
 
-    # GetFile method
+    # Search method: prints the best results of a search
     @staticmethod
-    def getfile(user, remote_FileName, local_FileName):
-                
-        # Get remote user information
-        sock = client.connect_to_server()
-        if not sock:
-            print("c > GET_FILE FAIL")
-            return client.RC.ERROR
+    def search_files(query):
+        response, total, _, results = client.search(query)
         
+        if response == 0:
+            print(f"c > SEARCH OK, {total} FILES")
+            for owner, filename, description, _ in results:
+                print(f"{owner} {filename} {description}")
+            return client.RC.OK
+        elif response == 1:
+            print("c > SEARCH FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response == 2:
+            print("c > SEARCH FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        else:
+            print("c > SEARCH FAIL")
+            return client.RC.ERROR
+
+    # Function to print the result of a download. Code 1 of the peer means
+    # that the file does not exist.
+    @staticmethod
+    def report_download(operation, coroutine):
         try:
-            # Get date and time from web service
-            datetime_str = client.get_datetime()
-            
-            # Send operation to list users
-            client.send_string(sock, "LIST_USERS")
-            # Send date and time
-            client.send_string(sock, datetime_str)
-            # Send username
-            client.send_string(sock, client._connected_user)
-            
-            # Receive response
-            response = sock.recv(1)[0]
-            
-            if response != 0:
-                print("c > GET_FILE FAIL")
-                return client.RC.ERROR
-            
-            # Receive number of users
-            num_users_str = client.receive_string(sock)
-            num_users = int(num_users_str)
-            
-            # Search for remote user
-            remote_ip = None
-            remote_port = None
-            for _ in range(num_users):
-                username = client.receive_string(sock)
-                ip = client.receive_string(sock)
-                port = client.receive_string(sock)
-                
-                
-                if username == user:
-                    remote_ip = ip
-                    remote_port = int(port)
-                    break
-        except Exception as e:
-            print("c > GET_FILE FAIL")
+            stats = client.run(coroutine)
+        except client.RequestError as e:
+            if e.operation in ("GET_FILE", "GET_FILE_MULTI") and e.code == 1:
+                print(f"c > {operation} FAIL, FILE NOT EXIST")
+                return client.RC.USER_ERROR
+            print(f"c > {operation} FAIL")
             return client.RC.ERROR
-        finally:
-            sock.close()
-        
-        # Check if we found the remote user
-        if not remote_ip or not remote_port:
-            print("c > GET_FILE FAIL")
+        except Exception as e:
+            # Transfer not completed, the library keeps what can be resumed
+            print(f"c > {operation} FAIL")
             return client.RC.ERROR
         
-        # Connect with remote client to request file
+        print(f"c > {operation} OK")
+        if stats.resumed:
+            client._bytes_saved += stats.resumed
+            print(f"c > {operation} RESUMED, {stats.resumed} BYTES NOT DOWNLOADED AGAIN")
+        return client.RC.OK
+
+    # GetFile method
+    @staticmethod
+    def getfile(user, remote_FileName, local_FileName):
+        downloader = client.user(client._connected_user)
+        return client.report_download(
+            "GET_FILE", downloader.get_file(user, remote_FileName, local_FileName))
+
+    # GetFileMulti method: downloads a file from every connected user that
+    # publishes it, fetching segments from all of them in parallel
+    @staticmethod
+    def getfile_multi(remote_FileName, local_FileName):
+        downloader = client.user(client._connected_user)
+        return client.report_download(
+            "GET_FILE_MULTI", downloader.get_file_multi(remote_FileName, local_FileName))
+
+    # Function to call a function from a coroutine, to run it on the event
+    # loop of the library
+    @staticmethod
+    async def as_coroutine(function):
+        return function()
+
+    # Function to get the metrics of the library (durations of the phases
+    # and requests, counters) and the sync counters of the timestamp
+    # provider, as JSON values. It must run on the event loop, where the
+    # metrics are updated.
+    @staticmethod
+    def read_stats():
+        stats = client.api().metrics.snapshot()
+        stats["timestamps"] = client._timestamps.stats()
+        return stats
+
+    # Function to get the metrics in the Prometheus text format. It must run
+    # on the event loop.
+    @staticmethod
+    def read_prometheus():
+        lines = [client.api().metrics.prometheus()]
+        for key, value in client._timestamps.stats().items():
+            if value is None:
+                continue
+            if key in ("syncs", "sync_failures", "fallbacks"):
+                lines.append(f"# TYPE p2p_client_timestamp_{key}_total counter\n"
+                             f"p2p_client_timestamp_{key}_total {value}\n")
+            else:
+                lines.append(f"# TYPE p2p_client_timestamp_{key} gauge\n"
+                             f"p2p_client_timestamp_{key} {value}\n")
+        return ''.join(lines)
+
+    # Function to write the metrics to the stats file, if set. The file is
+    # replaced at once, so readers never see it half written.
+    @staticmethod
+    def dump_stats():
+        if not client._stats_file:
+            return
+        client.api()
+        if client._stats_format == "prometheus":
+            text = client.run(client.as_coroutine(client.read_prometheus))
+        else:
+            text = json.dumps(client.run(client.as_coroutine(client.read_stats)), indent=2) + '\n'
+        temp = client._stats_file + ".tmp"
+        with open(temp, 'w') as f:
+            f.write(text)
+        os.replace(temp, client._stats_file)
+
+    # Function run by a background thread to write the stats file every
+    # stats interval
+    @staticmethod
+    def dump_stats_periodically():
+        while True:
+            time.sleep(client._stats_interval)
+            try:
+                # Nothing to write until the library client is created
+                if client._api:
+                    client.dump_stats()
+            except Exception as e:
+                print(f"Error writing stats file: {e}", file=sys.stderr)
+
+    # Stats method: prints the durations of the phases of the requests and
+    # transfers and of the requests per operation, and the counters
+    @staticmethod
+    def stats():
+        client.api()
+        stats = client.run(client.as_coroutine(client.read_stats))
+
+        print("c > STATS OK")
+        for title, section in (("phase", "phases"), ("request", "operations")):
+            print(f"{title:18s} {'count':>8s} {'mean ms':>9s} {'p50 ms':>9s} "
+                  f"{'p99 ms':>9s} {'max ms':>9s}")
+            for name, histogram in stats[section].items():
+                mean = histogram["sum"] / histogram["count"] if histogram["count"] else 0
+                print(f"{name:18s} {histogram['count']:8d} {mean * 1000:9.3f} "
+                      f"{histogram['p50'] * 1000:9.3f} {histogram['p99'] * 1000:9.3f} "
+                      f"{histogram['max'] * 1000:9.3f}")
+        print(' '.join(f"{name} {value}" for name, value in stats["counters"].items()))
+        print(' '.join(f"{name} {value if value is None or isinstance(value, int) else round(value, 3)}"
+                       for name, value in stats["timestamps"].items()))
+        client.dump_stats()
+        return client.RC.OK
+
+    # Function to publish a file in a batch, creating it like the shell
+    @staticmethod
+    async def publish_file(user, fileName, description):
+        await user.publish(fileName, description)
+        client.create_published(fileName, description)
+
+    # Function to delete a file in a batch, removing it like the shell
+    @staticmethod
+    async def delete_file(user, fileName):
+        await user.delete(fileName)
+        client.remove_deleted(fileName)
+
+    # Function to get every file of an async generator of the library
+    @staticmethod
+    async def collect(files):
+        return [file async for file in files]
+
+    # Function to get the coroutine of a batch command, or None if it is not
+    # valid. users holds the registered and connected users of the batch and
+    # is updated as the commands are started, not when they finish.
+    @staticmethod
+    def batch_request(words, users):
+        operation, args = words[0].upper(), words[1:]
+        registered = client.user(users["registered"])
+        connected = client.user(users["connected"])
+        if operation == "REGISTER" and len(args) == 1:
+            users["registered"] = args[0]
+            return client.user(args[0]).register()
+        elif operation == "UNREGISTER" and len(args) == 1:
+            users["registered"] = None
+            if users["connected"] == args[0]:
+                users["connected"] = None
+            return client.user(args[0]).unregister()
+        elif operation == "CONNECT" and len(args) == 1:
+            users["connected"] = args[0]
+            return client.user(args[0]).connect()
+        elif operation == "DISCONNECT" and len(args) == 1:
+            users["connected"] = None
+            return client.user(args[0]).disconnect()
+        elif operation == "PUBLISH" and len(args) >= 2:
+            return client.publish_file(registered, args[0], ' '.join(args[1:]))
+        elif operation == "DELETE" and len(args) == 1:
+            return client.delete_file(registered, args[0])
+        elif operation == "LIST_USERS" and len(args) == 0:
+            return registered.list_users()
+        elif operation == "LIST_CONTENT" and len(args) == 1:
+            return client.collect(registered.list_content(args[0]))
+        elif operation == "SEARCH" and len(args) >= 1:
+            return registered.search(' '.join(args))
+        elif operation == "GET_FILE" and len(args) == 3:
+            return connected.get_file(*args)
+        elif operation == "GET_FILE_MULTI" and len(args) == 2:
+            return connected.get_file_multi(*args)
+        elif operation == "STATS" and len(args) == 0:
+            return client.as_coroutine(client.read_stats)
+        return None
+
+    # Function to convert a result of the library to JSON values
+    @staticmethod
+    def to_json(result):
+        if hasattr(result, "_asdict"):
+            return {key: client.to_json(value) for key, value in result._asdict().items()}
+        if isinstance(result, (list, tuple)):
+            return [client.to_json(value) for value in result]
+        return result
+
+    # Function to run one command of a batch and get its JSON record: the
+    # response code (None if the server or the peer is unreachable), the
+    # result and the start and duration in milliseconds
+    @staticmethod
+    async def batch_command(number, command, request, start):
+        began = time.perf_counter()
+        record = {"line": number, "command": command, "ok": False}
         try:
-            remote_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            remote_sock.connect((remote_ip, remote_port))
-            
-            # Send operation
-            client.send_string(remote_sock, "GET_FILE")
-            # Send remote file name
-            client.send_string(remote_sock, remote_FileName)
-            
-            # Receive response
-            response = remote_sock.recv(1)[0]
-            
-            if response == 0:
-                # Receive file size
-                file_size_str = client.receive_string(remote_sock)
-                file_size = int(file_size_str)
-                
-                # Create local file
-                try:
-                    with open(local_FileName, 'wb') as f:
-                        bytes_received = 0
-                        while bytes_received < file_size:
-                            # Receive data
-                            data = remote_sock.recv(min(4096, file_size - bytes_received))
-                            if not data:
-                                break
-                            
-                            # Write data to file
-                            f.write(data)
-                            bytes_received += len(data)
-                    
-                    if bytes_received == file_size:
-                        print("c > GET_FILE OK")
-                        return client.RC.OK
-                    else:
-                        # Transfer not completed, delete file
-                        os.remove(local_FileName)
-                        print("c > GET_FILE FAIL")
-                        return client.RC.ERROR
-                except Exception as e:
-                    # Error writing file, delete if it exists
-                    if os.path.exists(local_FileName):
-                        os.remove(local_FileName)
-                    print("c > GET_FILE FAIL")
-                    return client.RC.ERROR
-            elif response == 1:
-                print("c > GET_FILE FAIL, FILE NOT EXIST")
-                return client.RC.USER_ERROR
+            if request is None:
+                record.update(code=None, error="invalid command")
             else:
-                print("c > GET_FILE FAIL")
-                return client.RC.ERROR
+                result = await request
+                record.update(ok=True, code=0)
+                if result is not None:
+                    record["result"] = client.to_json(result)
+        except client.RequestError as e:
+            record.update(code=e.code, error=str(e))
         except Exception as e:
-            print("c > GET_FILE FAIL")
-            return client.RC.ERROR
+            record.update(code=None, error=str(e) or repr(e))
+        record["start_ms"] = round((began - start) * 1000, 3)
+        record["ms"] = round((time.perf_counter() - began) * 1000, 3)
+        return record
+
+    # Function to run the (line number, command) entries of a batch on the
+    # event loop. Commands are started in order without waiting for the
+    # previous ones, up to window at once, and pipelined on the session,
+    # where the server runs them in order. Downloads run concurrently with
+    # the following commands; a command that names the local file of a
+    # download waits for it. DISCONNECT and UNREGISTER wait for every
+    # command before them and are waited for. Returns the records and the
+    # seconds taken.
+    @staticmethod
+    async def run_batch(commands, window):
+        start = time.perf_counter()
+        slots = asyncio.Semaphore(window)
+        running = set()
+        downloads = {}    # Local file -> download that writes it
+        users = {"registered": client._registered_user, "connected": client._connected_user}
+        tasks = []
+        for number, command in commands:
+            words = command.split()
+            operation = words[0].upper()
+            if operation == "QUIT":
+                break
+
+            if operation in ("DISCONNECT", "UNREGISTER"):
+                waits = set(running)
+            else:
+                waits = {downloads[word] for word in words[1:] if word in downloads}
+            if waits:
+                await asyncio.wait(waits)
+            await slots.acquire()
+
+            task = asyncio.ensure_future(client.batch_command(
+                number, command, client.batch_request(words, users), start))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+            tasks.append(task)
+            if operation in ("GET_FILE", "GET_FILE_MULTI"):
+                downloads[words[-1]] = task
+            elif operation in ("DISCONNECT", "UNREGISTER"):
+                await asyncio.wait([task])
+
+        records = await asyncio.gather(*tasks)
+        # Like QUIT, users left connected are disconnected
+        await asyncio.gather(*(user.disconnect() for user in client.api().users.values()
+                               if user.connected), return_exceptions=True)
+        return records, time.perf_counter() - start
+
+    # *
+    # * @brief Runs the commands of a batch file ('-' for stdin), one per line,
+    # *        and writes a JSON record per command and a summary to output
+    # *        ('-' for stdout). Blank lines and lines starting with '#' are
+    # *        skipped.
+    @staticmethod
+    def batch(path, output, window):
+        source = sys.stdin if path == '-' else open(path)
+        try:
+            commands = [(number, line.strip()) for number, line in enumerate(source, 1)
+                        if line.strip() and not line.lstrip().startswith('#')]
         finally:
-            remote_sock.close()
+            if source is not sys.stdin:
+                source.close()
+
+        client.api()
+        try:
+            records, elapsed = client.run(client.run_batch(commands, window))
+        finally:
+            client.dump_stats()
+            client.close_control()
+
+        ok = sum(record["ok"] for record in records)
+        summary = {"commands": len(records), "ok": ok, "failed": len(records) - ok,
+                   "seconds": round(elapsed, 3),
+                   "commands_per_s": round(len(records) / elapsed, 1) if elapsed else None}
+        out = sys.stdout if output == '-' else open(output, 'w')
+        try:
+            # One command per line, so large results can be read line by line
+            out.write('{"commands": [\n')
+            out.write(',\n'.join(json.dumps(record) for record in records))
+            out.write('\n],\n"summary": ' + json.dumps(summary) + '}\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return summary["failed"] == 0
 
     # *
     # **
@@ -734,6 +838,12 @@ class client:
                         else:
                             print("Syntax error. Usage: LIST_CONTENT <userName>")
 
+                    elif (line[0] == "SEARCH"):
+                        if (len(line) >= 2):
+                            client.search_files(' '.join(line[1:]))
+                        else:
+                            print("Syntax error. Usage: SEARCH <words>")
+
                     elif (line[0] == "DISCONNECT"):
                         if (len(line) == 2):
                             client.disconnect(line[1])
@@ -746,11 +856,25 @@ class client:
                         else:
                             print("Syntax error. Usage: GET_FILE <userName> <remote_fileName> <local_fileName>")
 
+                    elif (line[0] == "GET_FILE_MULTI"):
+                        if (len(line) == 3):
+                            client.getfile_multi(line[1], line[2])
+                        else:
+                            print("Syntax error. Usage: GET_FILE_MULTI <remote_fileName> <local_fileName>")
+
+                    elif (line[0] == "STATS"):
+                        if (len(line) == 1):
+                            client.stats()
+                        else:
+                            print("Syntax error. Use: STATS")
+
                     elif (line[0] == "QUIT"):
                         if (len(line) == 1):
                             # If there's a connected user, disconnect before exiting
                             if client._connected_user:
                                 client.disconnect(client._connected_user)
+                            client.dump_stats()
+                            client.close_control()
                             break
                         else:
                             print("Syntax error. Use: QUIT")
@@ -772,6 +896,34 @@ class client:
         parser = argparse.ArgumentParser()
         parser.add_argument('-s', type=str, required=True, help='Server IP')
         parser.add_argument('-p', type=int, required=True, help='Server Port')
+        parser.add_argument('--persistent', action='store_true',
+                            help='Send all requests over one long-lived connection')
+        parser.add_argument('--protocol', type=int, choices=(1, 2), default=1,
+                            help='Framing of the control connection, 2 implies --persistent')
+        parser.add_argument('--recv-buffer', type=int, default=1 << 20,
+                            help='Size in bytes of the download receive buffer')
+        parser.add_argument('--socket-buffer', type=int, default=None,
+                            help='SO_RCVBUF/SO_SNDBUF in bytes for P2P transfers')
+        parser.add_argument('--max-uploads', type=int, default=16,
+                            help='Maximum number of files served to peers at once')
+        parser.add_argument('--upload-queue', type=int, default=64,
+                            help='Maximum number of peers waiting for an upload slot')
+        parser.add_argument('--time-sync-interval', type=float, default=30.0,
+                            help='Seconds between syncs with the date web service')
+        parser.add_argument('--time-max-staleness', type=float, default=300.0,
+                            help='Seconds a sync stays valid before using the local clock')
+        parser.add_argument('--stats-file', type=str, default=None,
+                            help='File for the client metrics, written by STATS and at exit')
+        parser.add_argument('--stats-format', choices=('json', 'prometheus'), default='json',
+                            help='Format of the stats file')
+        parser.add_argument('--stats-interval', type=float, default=0,
+                            help='Seconds between writes of the stats file, 0 to disable')
+        parser.add_argument('--batch', type=str, default=None,
+                            help="Run the commands of a file ('-' for stdin) instead of the shell")
+        parser.add_argument('--batch-output', type=str, default='-',
+                            help="File for the JSON results of --batch ('-' for stdout)")
+        parser.add_argument('--batch-window', type=int, default=64,
+                            help='Maximum number of batch commands in flight')
         args = parser.parse_args()
 
         if (args.s is None):
@@ -784,6 +936,23 @@ class client:
 
         client._server = args.s
         client._port = args.p
+        client._persistent = args.persistent or args.protocol == 2
+        client._protocol = args.protocol
+        client._recv_buffer_size = max(4096, args.recv_buffer)
+        client._socket_buffer_size = args.socket_buffer
+        client._max_uploads = max(1, args.max_uploads)
+        client._upload_queue_depth = max(0, args.upload_queue)
+        client._time_sync_interval = args.time_sync_interval
+        client._time_max_staleness = args.time_max_staleness
+        client._stats_file = args.stats_file
+        client._stats_format = args.stats_format
+        client._stats_interval = args.stats_interval
+        client._batch = args.batch
+        client._batch_output = args.batch_output
+        client._batch_window = max(1, args.batch_window)
+        if args.batch:
+            # Batch commands are pipelined on a session
+            client._persistent = True
 
         return True
 
@@ -794,6 +963,15 @@ class client:
             client.usage()
             return
 
+        if client._stats_file and client._stats_interval > 0:
+            thread = threading.Thread(target=client.dump_stats_periodically)
+            thread.daemon = True
+            thread.start()
+
+        if client._batch:
+            sys.exit(0 if client.batch(client._batch, client._batch_output,
+                                       client._batch_window) else 1)
+
         client.shell()
         print("+++ FINISHED +++")
 
@@ -1,44 +1,229 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <pthread.h>
+#include <unistd.h>
+#include <time.h>
 #include <tirpc/rpc/rpc.h>
 #include "log_service.h"
+#include "metrics.h"
 
-/* 
+#define LOG_QUEUE_SIZE 8192     /* Records waiting to be shipped */
+#define LOG_BATCH_SIZE 256      /* Maximum records per RPC call */
+#define LOG_RETRY_DELAY 1       /* Seconds to wait after a failed call */
+#define LOG_RPC_TIMEOUT 5       /* Seconds before an RPC call fails */
+
+/* Record waiting in the queue, copied from the caller's strings */
+typedef struct {
+    char username[101];
+    char operation[257];
+    char timestamp[31];
+} log_record;
+
+/* Ring buffer of records shipped by a background thread */
+static log_record log_queue[LOG_QUEUE_SIZE];
+static int log_head = 0;
+static int log_count = 0;
+static int log_sending = 0;     /* Records taken by the shipper, not yet sent */
+static int log_stopping = 0;
+static pthread_mutex_t log_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t log_ready = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t log_idle = PTHREAD_COND_INITIALIZER;
+static pthread_once_t log_once = PTHREAD_ONCE_INIT;
+
+/* Counters, protected by log_mutex */
+static unsigned long log_enqueued = 0;
+static unsigned long log_shipped = 0;
+static unsigned long log_dropped = 0;       /* Queue full or no RPC server */
+static unsigned long log_lost = 0;          /* Part of a failed call */
+static unsigned long log_calls = 0;
+static unsigned long log_failed_calls = 0;
+
+/* Latencies, updated without locks */
+static histogram log_send_time;     /* send_log, waiting for log_mutex included */
+static histogram log_call_time;     /* log_batch RPC calls */
+
+static void *log_shipper(void *arg);
+
+/* Function to start the shipping thread */
+static void log_start(void) {
+    pthread_t thread_id;
+
+    if (pthread_create(&thread_id, NULL, log_shipper, NULL) != 0) {
+        perror("Error creating log thread");
+        return;
+    }
+    pthread_detach(thread_id);
+}
+
+/* Function to copy a string into a fixed size field, truncating it */
+static void copy_field(char *field, size_t size, const char *value) {
+    strncpy(field, value, size - 1);
+    field[size - 1] = '\0';
+}
+
+/*
  * Client function to send logs to RPC server
- * This function should be called from the main server
+ * This function should be called from the main server. The record is only
+ * queued: a background thread sends the queued records in batches, so the
+ * caller never waits for the RPC server. If the queue is full the record
+ * is dropped and counted.
  */
 void send_log(const char *username, const char *operation, const char *timestamp) {
-    CLIENT *cl;
-    int *result;
-    char *rpc_server;
-    log_data data;
-    
+    uint64_t start = metrics_now();
+    pthread_once(&log_once, log_start);
+
+    pthread_mutex_lock(&log_mutex);
+    if (log_count == LOG_QUEUE_SIZE || log_stopping) {
+        log_dropped++;
+    } else {
+        log_record *record = &log_queue[(log_head + log_count) % LOG_QUEUE_SIZE];
+        copy_field(record->username, sizeof(record->username), username);
+        copy_field(record->operation, sizeof(record->operation), operation);
+        copy_field(record->timestamp, sizeof(record->timestamp), timestamp);
+        log_count++;
+        log_enqueued++;
+        pthread_cond_signal(&log_ready);
+    }
+    pthread_mutex_unlock(&log_mutex);
+    histogram_observe(&log_send_time, metrics_now() - start);
+}
+
+/* Function to connect to the RPC server, NULL if it is not available */
+static CLIENT *log_connect(const char *rpc_server) {
+    CLIENT *cl = clnt_create(rpc_server, LOG_PROG, LOG_VERS, "tcp");
+    if (cl == NULL) {
+        clnt_pcreateerror(rpc_server);
+        return NULL;
+    }
+
+    struct timeval timeout = {LOG_RPC_TIMEOUT, 0};
+    clnt_control(cl, CLSET_TIMEOUT, (char *)&timeout);
+    return cl;
+}
+
+/*
+ * Shipping thread: takes up to LOG_BATCH_SIZE records from the queue and
+ * sends them with one log_batch call. The RPC client handle is kept open
+ * between calls and created again after a failure.
+ */
+static void *log_shipper(void *arg) {
+    static log_record batch[LOG_BATCH_SIZE];
+    static log_data records[LOG_BATCH_SIZE];
+    CLIENT *cl = NULL;
+
     /* Get RPC server address from environment variable */
-    rpc_server = getenv("LOG_RPC_IP");
+    const char *rpc_server = getenv("LOG_RPC_IP");
     if (rpc_server == NULL) {
         fprintf(stderr, "Error: Environment variable LOG_RPC_IP not defined\n");
-        return;
     }
-    
-    /* Initialize data structure */
-    data.username = (char *)username;
-    data.operation = (char *)operation;
-    data.timestamp = (char *)timestamp;
-    
-    /* Connect to RPC server */
-    cl = clnt_create(rpc_server, LOG_PROG, LOG_VERS, "tcp");
-    if (cl == NULL) {
-        clnt_pcreateerror(rpc_server);
-        return;
+
+    while (1) {
+        pthread_mutex_lock(&log_mutex);
+        while (log_count == 0) {
+            pthread_cond_broadcast(&log_idle);
+            pthread_cond_wait(&log_ready, &log_mutex);
+        }
+        int n = log_count < LOG_BATCH_SIZE ? log_count : LOG_BATCH_SIZE;
+        for (int i = 0; i < n; i++) {
+            batch[i] = log_queue[(log_head + i) % LOG_QUEUE_SIZE];
+        }
+        log_head = (log_head + n) % LOG_QUEUE_SIZE;
+        log_count -= n;
+        log_sending = n;
+        pthread_mutex_unlock(&log_mutex);
+
+        if (rpc_server == NULL) {
+            pthread_mutex_lock(&log_mutex);
+            log_dropped += n;
+            log_sending = 0;
+            pthread_mutex_unlock(&log_mutex);
+            continue;
+        }
+
+        if (cl == NULL) {
+            cl = log_connect(rpc_server);
+        }
+
+        int *result = NULL;
+        int called = cl != NULL;
+        if (called) {
+            log_batch_data data;
+            for (int i = 0; i < n; i++) {
+                records[i].username = batch[i].username;
+                records[i].operation = batch[i].operation;
+                records[i].timestamp = batch[i].timestamp;
+            }
+            data.records.records_len = n;
+            data.records.records_val = records;
+
+            /* Call remote procedure */
+            uint64_t start = metrics_now();
+            result = log_batch_1(&data, cl);
+            histogram_observe(&log_call_time, metrics_now() - start);
+            if (result == NULL) {
+                clnt_perror(cl, "Error in RPC call");
+                clnt_destroy(cl);
+                cl = NULL;
+            }
+        }
+
+        /* Without a connection no call was made: the batch is dropped */
+        pthread_mutex_lock(&log_mutex);
+        if (!called) {
+            log_dropped += n;
+        } else {
+            log_calls++;
+            if (result != NULL && *result >= 0) {
+                log_shipped += n;
+            } else {
+                log_failed_calls++;
+                log_lost += n;
+            }
+        }
+        log_sending = 0;
+        pthread_mutex_unlock(&log_mutex);
+
+        /* Give the RPC server time to come back before the next call */
+        if (result == NULL) {
+            sleep(LOG_RETRY_DELAY);
+        }
     }
-    
-    /* Call remote procedure */
-    result = log_operation_1(&data, cl);
-    if (result == NULL) {
-        clnt_perror(cl, "Error in RPC call");
+    return NULL;
+}
+
+/*
+ * Function to stop queueing new records and wait up to timeout seconds for
+ * the queued ones to be shipped. Prints the counters.
+ */
+void log_shutdown(int timeout) {
+    struct timespec deadline;
+    clock_gettime(CLOCK_REALTIME, &deadline);
+    deadline.tv_sec += timeout;
+
+    pthread_mutex_lock(&log_mutex);
+    log_stopping = 1;
+    while (log_count > 0 || log_sending > 0) {
+        if (pthread_cond_timedwait(&log_idle, &log_mutex, &deadline) != 0) {
+            break;
+        }
     }
-    
-    /* Free resources */
-    clnt_destroy(cl);
+    printf("s > log records: %lu queued, %lu shipped, %lu dropped, %lu lost in %lu failed calls of %lu\n",
+           log_enqueued, log_shipped, log_dropped + log_count, log_lost, log_failed_calls, log_calls);
+    pthread_mutex_unlock(&log_mutex);
+}
+
+/* Function to read the counters and latencies of the log shipper */
+void log_get_metrics(log_metrics *metrics) {
+    pthread_mutex_lock(&log_mutex);
+    metrics->enqueued = log_enqueued;
+    metrics->shipped = log_shipped;
+    metrics->dropped = log_dropped;
+    metrics->lost = log_lost;
+    metrics->calls = log_calls;
+    metrics->failed_calls = log_failed_calls;
+    metrics->queued = log_count + log_sending;
+    pthread_mutex_unlock(&log_mutex);
+    metrics->send_log = log_send_time;
+    metrics->call = log_call_time;
 }
@@ -0,0 +1,169 @@
+"""
+Query tool of the log store written by log_server.
+
+Finds the operations of a user between two dates using the sidecar index
+of each segment: segments whose time range does not overlap the query are
+skipped from their index header, the sorted index of a closed segment is
+searched for the first entry of the user in the time range and read from
+there, and only the lines of matching index entries are read from the
+segments. The index of the open segment is not sorted yet and is read whole.
+
+Usage: python3 log_query.py --user alice --from "01/05/2025 10:00:00"
+                            --to "01/05/2025 12:00:00" [--dir logs] [--stats]
+"""
+import argparse
+import os
+import re
+import struct
+import sys
+import time
+
+DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+INDEX_MAGIC = b"LOGIDX2\0"
+INDEX_SORTED = 1                    # Flag of an index sorted by hash and time
+HEADER = struct.Struct('<8sqqII')   # magic, min time, max time, flags, reserved
+ENTRY = struct.Struct('<IqQI')      # username hash, time, offset, length
+BLOCK_ENTRIES = 256                 # Entries read at a time from a sorted index
+ESCAPE = re.compile(r'\\(.)')
+ESCAPES = {'\\': '\\', 't': '\t', 'n': '\n'}
+
+
+# Function to hash a username like the log server (FNV-1a, 32 bits)
+def hash_username(username):
+    h = 2166136261
+    for byte in username.encode():
+        h = ((h ^ byte) * 16777619) & 0xFFFFFFFF
+    return h
+
+
+# Function to convert a DD/MM/YYYY HH:MM:SS date to seconds since the epoch
+def parse_time(value):
+    return int(time.mktime(time.strptime(value, DATE_FORMAT)))
+
+
+# Function to undo the escaping of backslashes, tabs and newlines of a field
+def unescape(field):
+    return ESCAPE.sub(lambda m: ESCAPES.get(m.group(1), m.group(0)), field)
+
+
+# Function to find the position of the first entry of a sorted index that
+# is not before key (hash, time), reading only the entries it compares
+def lower_bound(fd, count, key, stats):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        h, t, _, _ = ENTRY.unpack(os.pread(fd, ENTRY.size, HEADER.size + middle * ENTRY.size))
+        stats['entries'] += 1
+        if (h, t) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# Generator of the (time, offset, length) entries of an index that match a
+# query. In a sorted index the entries of a user are found with a binary
+# search and read until the first one after end; other indexes are read
+# whole and filtered.
+def index_matches(f, flags, user_hash, start, end, stats):
+    fd = f.fileno()
+    # A partially written last entry is ignored
+    count = (os.fstat(fd).st_size - HEADER.size) // ENTRY.size
+    if flags & INDEX_SORTED and user_hash is not None:
+        position = lower_bound(fd, count, (user_hash, start), stats)
+        while position < count:
+            n = min(BLOCK_ENTRIES, count - position)
+            block = os.pread(fd, n * ENTRY.size, HEADER.size + position * ENTRY.size)
+            position += n
+            stats['entries'] += n
+            for h, t, offset, length in ENTRY.iter_unpack(block):
+                if h != user_hash or t > end:
+                    return
+                yield t, offset, length
+        return
+
+    index = f.read(count * ENTRY.size)
+    stats['entries'] += count
+    for h, t, offset, length in ENTRY.iter_unpack(index):
+        if start <= t <= end and (user_hash is None or h == user_hash):
+            yield t, offset, length
+
+
+# Function to list the segments of the log directory in order
+def segments(log_dir):
+    names = sorted(name for name in os.listdir(log_dir)
+                   if name.startswith('segment-') and name.endswith('.idx'))
+    return [os.path.join(log_dir, name[:-4]) for name in names]
+
+
+# Generator of the (time, username, operation, timestamp) records of a user
+# (every user if None) between start and end, both included
+def query(log_dir, username=None, start=None, end=None, stats=None):
+    stats = stats if stats is not None else {}
+    for key in ('segments', 'skipped', 'entries', 'bytes_read'):
+        stats.setdefault(key, 0)
+    start = -2 ** 63 if start is None else start
+    end = 2 ** 63 - 1 if end is None else end
+    user_hash = hash_username(username) if username is not None else None
+
+    for segment in segments(log_dir):
+        stats['segments'] += 1
+        with open(segment + '.idx', 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                stats['skipped'] += 1
+                continue
+            magic, min_time, max_time, flags, _ = HEADER.unpack(header)
+            if magic != INDEX_MAGIC or min_time > end or max_time < start:
+                stats['skipped'] += 1
+                continue
+            matches = list(index_matches(f, flags, user_hash, start, end, stats))
+        if not matches:
+            continue
+
+        with open(segment + '.log', 'rb') as f:
+            for t, offset, length in matches:
+                line = os.pread(f.fileno(), length, offset)
+                stats['bytes_read'] += len(line)
+                if len(line) != length or not line.endswith(b'\n'):
+                    continue
+                fields = [unescape(field) for field in line[:-1].decode(errors='replace').split('\t')]
+                if len(fields) != 3:
+                    continue
+                # Different users may share a hash
+                if username is not None and fields[0] != username:
+                    continue
+                yield (t, fields[0], fields[1], fields[2])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='logs', help='Log directory of log_server')
+    parser.add_argument('--user', help='Username (all users if omitted)')
+    parser.add_argument('--from', dest='start', help='First date, DD/MM/YYYY HH:MM:SS')
+    parser.add_argument('--to', dest='end', help='Last date, DD/MM/YYYY HH:MM:SS')
+    parser.add_argument('--stats', action='store_true', help='Print what was read')
+    args = parser.parse_args()
+
+    try:
+        start = parse_time(args.start) if args.start else None
+        end = parse_time(args.end) if args.end else None
+    except ValueError:
+        print("Dates must have the format DD/MM/YYYY HH:MM:SS")
+        sys.exit(1)
+
+    stats = {}
+    records = sorted(query(args.dir, args.user, start, end, stats), key=lambda r: r[0])
+    for _, username, operation, timestamp in records:
+        print(f"{username} {operation} {timestamp}")
+
+    if args.stats:
+        total = sum(os.path.getsize(segment + '.log') for segment in segments(args.dir))
+        print(f"{len(records)} records, {stats['segments']} segments "
+              f"({stats['skipped']} skipped from the header), "
+              f"{stats['entries']} index entries, "
+              f"{stats['bytes_read']} of {total} log bytes read", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
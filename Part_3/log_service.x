@@ -9,9 +9,15 @@ struct log_data {
     string timestamp<30>;  /* Date and time */
 };
 
+/* Batch of records sent in a single call */
+struct log_batch_data {
+    log_data records<>;
+};
+
 /* Program, version, and procedure definition */
 program LOG_PROG {
     version LOG_VERS {
         int log_operation(log_data) = 1;
+        int log_batch(log_batch_data) = 2;
     } = 1;
 } = 0x20000001;
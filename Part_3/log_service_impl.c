@@ -7,15 +7,49 @@
 #include <string.h>
 #include "log_service.h"
 
+extern int log_store_append(log_data *records, u_int count);
+
+/* Function to print a record on stdout if LOG_ECHO is set. Records are left
+ * in the stdio buffer, so echoing never flushes on the write path. */
+static void echo_record(log_data *record) {
+    static int echo = -1;
+    if (echo < 0) {
+        const char *value = getenv("LOG_ECHO");
+        echo = value != NULL && atoi(value) > 0;
+    }
+    if (echo) {
+        printf("%s %s %s\n", record->username, record->operation, record->timestamp);
+    }
+}
+
 /* 
  * Implementation of the log_operation RPC procedure
+ * Returns 1 once the record is stored, 0 if it could not be stored
  */
 int *log_operation_1_svc(log_data *data, struct svc_req *rqstp) {
-    static int result = 1;
+    static int result;
+    
+    echo_record(data);
+    result = log_store_append(data, 1) == 0;
+    return &result;
+}
+
+/*
+ * Implementation of the log_batch RPC procedure
+ * Stores the whole batch in a single commit. Returns the number of records,
+ * or -1 if they could not be stored
+ */
+int *log_batch_1_svc(log_batch_data *data, struct svc_req *rqstp) {
+    static int result;
     
-    /* Print operation information */
-    printf("%s %s %s\n", data->username, data->operation, data->timestamp);
-    fflush(stdout);
+    for (u_int i = 0; i < data->records.records_len; i++) {
+        echo_record(&data->records.records_val[i]);
+    }
     
+    if (log_store_append(data->records.records_val, data->records.records_len) < 0) {
+        result = -1;
+    } else {
+        result = data->records.records_len;
+    }
     return &result;
 }
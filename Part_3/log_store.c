@@ -0,0 +1,400 @@
+/*
+ * Durable log store of the RPC logging service
+ *
+ * Records are appended to segment files in the log directory, one line per
+ * record: "username\toperation\ttimestamp\n", with backslashes, tabs and
+ * newlines of the fields escaped as \\, \t and \n. Every segment has a
+ * sidecar index with one fixed size entry per record (hash of the username,
+ * time of the record, position of its line) so records of a user in a time
+ * range are found without reading the segments. Each call commits all its
+ * records with one write per file and one fdatasync, and the segment is
+ * rotated when it reaches a maximum size or age.
+ *
+ * Entries are appended to the index of the open segment in arrival order.
+ * When a segment is closed its index is sorted by username hash and time
+ * and marked as sorted, so the records of a user in a time range are found
+ * with a binary search. Segments left open by a stopped server are sorted
+ * when the store is opened again.
+ *
+ * Index file layout (little-endian):
+ *   header: "LOGIDX2\0", int64 min time, int64 max time, uint32 flags,
+ *           uint32 reserved
+ *   entry:  uint32 username hash, int64 time, uint64 offset, uint32 length
+ */
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <time.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <dirent.h>
+#include <sys/stat.h>
+#include "log_service.h"
+
+#define LOG_DIR "logs"                  /* Default log directory */
+#define SEGMENT_SIZE (64L << 20)        /* Default maximum segment size */
+#define SEGMENT_SECONDS 3600            /* Default maximum segment age */
+#define INDEX_MAGIC "LOGIDX2"
+#define INDEX_HEADER_SIZE 32
+#define INDEX_ENTRY_SIZE 24
+#define INDEX_SORTED 1                  /* Flag of an index sorted by hash and time */
+#define TIME_FORMAT "%d/%m/%Y %H:%M:%S"
+
+/* Open segment and its index */
+static struct {
+    int opened;
+    char dir[256];
+    long max_size;
+    long max_seconds;
+    int sequence;       /* Number of the open segment */
+    int log_fd;
+    int index_fd;
+    uint64_t size;      /* Bytes in the open segment */
+    time_t created;
+    int64_t min_time;
+    int64_t max_time;
+} store;
+
+/* Entry of an index, decoded */
+typedef struct {
+    uint32_t hash;
+    int64_t time;
+    uint64_t offset;
+    uint32_t length;
+} index_entry;
+
+/* Function to hash a username (FNV-1a, same as the query tool) */
+static uint32_t hash_username(const char *username) {
+    uint32_t hash = 2166136261u;
+    for (const unsigned char *c = (const unsigned char *)username; *c; c++) {
+        hash ^= *c;
+        hash *= 16777619u;
+    }
+    return hash;
+}
+
+/* Function to get the time of a record, or the current time if its
+ * timestamp cannot be parsed */
+static int64_t record_time(const char *timestamp) {
+    struct tm tm;
+    memset(&tm, 0, sizeof(tm));
+    const char *end = strptime(timestamp, TIME_FORMAT, &tm);
+    if (end == NULL || *end != '\0') {
+        return time(NULL);
+    }
+    tm.tm_isdst = -1;
+    return mktime(&tm);
+}
+
+static void put_u32(unsigned char *p, uint32_t value) {
+    for (int i = 0; i < 4; i++) {
+        p[i] = value >> (8 * i);
+    }
+}
+
+static void put_u64(unsigned char *p, uint64_t value) {
+    for (int i = 0; i < 8; i++) {
+        p[i] = value >> (8 * i);
+    }
+}
+
+static uint32_t get_u32(const unsigned char *p) {
+    uint32_t value = 0;
+    for (int i = 0; i < 4; i++) {
+        value |= (uint32_t)p[i] << (8 * i);
+    }
+    return value;
+}
+
+static uint64_t get_u64(const unsigned char *p) {
+    uint64_t value = 0;
+    for (int i = 0; i < 8; i++) {
+        value |= (uint64_t)p[i] << (8 * i);
+    }
+    return value;
+}
+
+static void encode_entry(unsigned char *p, const index_entry *entry) {
+    put_u32(p, entry->hash);
+    put_u64(p + 4, entry->time);
+    put_u64(p + 12, entry->offset);
+    put_u32(p + 20, entry->length);
+}
+
+static void decode_entry(const unsigned char *p, index_entry *entry) {
+    entry->hash = get_u32(p);
+    entry->time = (int64_t)get_u64(p + 4);
+    entry->offset = get_u64(p + 12);
+    entry->length = get_u32(p + 20);
+}
+
+/* Function to write an index header with the time range of its segment */
+static int write_header(int fd, int64_t min_time, int64_t max_time, uint32_t flags) {
+    unsigned char header[INDEX_HEADER_SIZE];
+    memset(header, 0, sizeof(header));
+    memcpy(header, INDEX_MAGIC, strlen(INDEX_MAGIC));
+    put_u64(header + 8, min_time);
+    put_u64(header + 16, max_time);
+    put_u32(header + 24, flags);
+    return pwrite(fd, header, sizeof(header), 0) == sizeof(header) ? 0 : -1;
+}
+
+/* Function to order index entries by username hash, time and position */
+static int compare_entries(const void *a, const void *b) {
+    const index_entry *x = a, *y = b;
+    if (x->hash != y->hash) {
+        return x->hash < y->hash ? -1 : 1;
+    }
+    if (x->time != y->time) {
+        return x->time < y->time ? -1 : 1;
+    }
+    if (x->offset != y->offset) {
+        return x->offset < y->offset ? -1 : 1;
+    }
+    return 0;
+}
+
+/* Function to sort the index of a closed segment by username hash and time.
+ * The sorted index is written to a temporary file that then replaces the
+ * old one, so a crash leaves either of them. Returns 0 on success (or if
+ * there is nothing to sort), -1 on error. */
+static int seal_index(int sequence) {
+    char path[512], tmp_path[520];
+    unsigned char header[INDEX_HEADER_SIZE];
+    struct stat st;
+
+    snprintf(path, sizeof(path), "%s/segment-%06d.idx", store.dir, sequence);
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
+        return 0;
+    }
+    if (fstat(fd, &st) < 0 || pread(fd, header, sizeof(header), 0) != sizeof(header) ||
+        memcmp(header, INDEX_MAGIC, strlen(INDEX_MAGIC) + 1) != 0 ||
+        (get_u32(header + 24) & INDEX_SORTED)) {
+        close(fd);
+        return 0;
+    }
+
+    /* A partially written last entry is dropped */
+    size_t count = (st.st_size - INDEX_HEADER_SIZE) / INDEX_ENTRY_SIZE;
+    size_t size = count * INDEX_ENTRY_SIZE;
+    unsigned char *data = malloc(size + 1);
+    index_entry *entries = malloc(count * sizeof(index_entry) + 1);
+    if (data == NULL || entries == NULL ||
+        pread(fd, data, size, INDEX_HEADER_SIZE) != (ssize_t)size) {
+        perror(path);
+        free(data);
+        free(entries);
+        close(fd);
+        return -1;
+    }
+    close(fd);
+
+    int64_t min_time = INT64_MAX, max_time = INT64_MIN;
+    for (size_t i = 0; i < count; i++) {
+        decode_entry(data + i * INDEX_ENTRY_SIZE, &entries[i]);
+        if (entries[i].time < min_time) {
+            min_time = entries[i].time;
+        }
+        if (entries[i].time > max_time) {
+            max_time = entries[i].time;
+        }
+    }
+    qsort(entries, count, sizeof(index_entry), compare_entries);
+    for (size_t i = 0; i < count; i++) {
+        encode_entry(data + i * INDEX_ENTRY_SIZE, &entries[i]);
+    }
+    free(entries);
+
+    int result = 0;
+    snprintf(tmp_path, sizeof(tmp_path), "%s.tmp", path);
+    fd = open(tmp_path, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0 ||
+        write_header(fd, min_time, max_time, INDEX_SORTED) < 0 ||
+        pwrite(fd, data, size, INDEX_HEADER_SIZE) != (ssize_t)size ||
+        fdatasync(fd) < 0 || rename(tmp_path, path) < 0) {
+        perror("Error sorting log index");
+        unlink(tmp_path);
+        result = -1;
+    }
+    if (fd >= 0) {
+        close(fd);
+    }
+    free(data);
+    return result;
+}
+
+/* Function to open a new segment and its index */
+static int open_segment(int sequence) {
+    char path[512];
+
+    snprintf(path, sizeof(path), "%s/segment-%06d.log", store.dir, sequence);
+    store.log_fd = open(path, O_WRONLY | O_CREAT | O_TRUNC | O_APPEND, 0644);
+    if (store.log_fd < 0) {
+        perror(path);
+        return -1;
+    }
+    snprintf(path, sizeof(path), "%s/segment-%06d.idx", store.dir, sequence);
+    store.index_fd = open(path, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+    if (store.index_fd < 0) {
+        perror(path);
+        close(store.log_fd);
+        return -1;
+    }
+
+    store.sequence = sequence;
+    store.size = 0;
+    store.created = time(NULL);
+    store.min_time = INT64_MAX;
+    store.max_time = INT64_MIN;
+    return write_header(store.index_fd, store.min_time, store.max_time, 0);
+}
+
+/* Function to close the open segment and sort its index. An index that
+ * cannot be sorted stays valid, it is only read whole by queries. */
+static void close_segment(void) {
+    close(store.log_fd);
+    close(store.index_fd);
+    seal_index(store.sequence);
+}
+
+/* Function to read a numeric setting from the environment */
+static long env_long(const char *name, long default_value) {
+    const char *value = getenv(name);
+    if (value == NULL || atol(value) <= 0) {
+        return default_value;
+    }
+    return atol(value);
+}
+
+/* Function to open the store: a new segment after the last existing one.
+ * Settings: LOG_DIR, LOG_SEGMENT_MB and LOG_SEGMENT_SECONDS. */
+static int open_store(void) {
+    const char *dir = getenv("LOG_DIR");
+    snprintf(store.dir, sizeof(store.dir), "%s", dir ? dir : LOG_DIR);
+    store.max_size = env_long("LOG_SEGMENT_MB", SEGMENT_SIZE >> 20) << 20;
+    store.max_seconds = env_long("LOG_SEGMENT_SECONDS", SEGMENT_SECONDS);
+
+    if (mkdir(store.dir, 0755) < 0 && access(store.dir, W_OK) < 0) {
+        perror(store.dir);
+        return -1;
+    }
+
+    int last = 0;
+    DIR *d = opendir(store.dir);
+    if (d != NULL) {
+        struct dirent *entry;
+        while ((entry = readdir(d)) != NULL) {
+            int sequence;
+            if (sscanf(entry->d_name, "segment-%d.log", &sequence) == 1 && sequence > last) {
+                last = sequence;
+            }
+        }
+        closedir(d);
+    }
+
+    /* Sort the indexes of the segments a stopped server left open */
+    for (int sequence = 1; sequence <= last; sequence++) {
+        seal_index(sequence);
+    }
+
+    if (open_segment(last + 1) < 0) {
+        return -1;
+    }
+    store.opened = 1;
+    return 0;
+}
+
+/* Function to copy a field into a line, escaping backslashes, tabs and
+ * newlines so they cannot split the line. Returns the bytes written. */
+static size_t escape_field(char *out, const char *field) {
+    size_t length = 0;
+    for (const char *c = field; *c; c++) {
+        if (*c == '\\' || *c == '\t' || *c == '\n') {
+            out[length++] = '\\';
+            out[length++] = *c == '\t' ? 't' : *c == '\n' ? 'n' : '\\';
+        } else {
+            out[length++] = *c;
+        }
+    }
+    return length;
+}
+
+/*
+ * Function to append records to the store. The lines and index entries of
+ * all the records are written with one write each, followed by a single
+ * fdatasync of both files (group commit). Returns 0 when the records are
+ * on disk, -1 on error.
+ */
+int log_store_append(log_data *records, u_int count) {
+    if (!store.opened && open_store() < 0) {
+        return -1;
+    }
+
+    /* Rotate by size or age before writing */
+    if (store.size >= (uint64_t)store.max_size ||
+        (store.size > 0 && time(NULL) - store.created >= store.max_seconds)) {
+        close_segment();
+        if (open_segment(store.sequence + 1) < 0) {
+            store.opened = 0;
+            return -1;
+        }
+    }
+
+    /* Escaping at most doubles the fields */
+    size_t lines_size = 0;
+    for (u_int i = 0; i < count; i++) {
+        lines_size += 2 * (strlen(records[i].username) + strlen(records[i].operation) +
+                           strlen(records[i].timestamp)) + 3;
+    }
+    char *lines = malloc(lines_size + 1);
+    unsigned char *entries = malloc((size_t)count * INDEX_ENTRY_SIZE);
+    if (lines == NULL || entries == NULL) {
+        free(lines);
+        free(entries);
+        return -1;
+    }
+
+    size_t offset = 0;
+    for (u_int i = 0; i < count; i++) {
+        char *line = lines + offset;
+        size_t length = escape_field(line, records[i].username);
+        line[length++] = '\t';
+        length += escape_field(line + length, records[i].operation);
+        line[length++] = '\t';
+        length += escape_field(line + length, records[i].timestamp);
+        line[length++] = '\n';
+
+        int64_t t = record_time(records[i].timestamp);
+        index_entry entry = {hash_username(records[i].username), t, store.size + offset, length};
+        encode_entry(entries + (size_t)i * INDEX_ENTRY_SIZE, &entry);
+        offset += length;
+        if (t < store.min_time) {
+            store.min_time = t;
+        }
+        if (t > store.max_time) {
+            store.max_time = t;
+        }
+    }
+
+    int result = 0;
+    off_t index_end = lseek(store.index_fd, 0, SEEK_END);
+    if (write(store.log_fd, lines, offset) != (ssize_t)offset ||
+        pwrite(store.index_fd, entries, (size_t)count * INDEX_ENTRY_SIZE, index_end) !=
+            (ssize_t)count * INDEX_ENTRY_SIZE ||
+        write_header(store.index_fd, store.min_time, store.max_time, 0) < 0 ||
+        fdatasync(store.log_fd) < 0 || fdatasync(store.index_fd) < 0) {
+        perror("Error writing log segment");
+        result = -1;
+    }
+
+    /* After a short write, continue from the actual end of the segment */
+    struct stat st;
+    store.size = fstat(store.log_fd, &st) == 0 ? (uint64_t)st.st_size : store.size + offset;
+
+    free(lines);
+    free(entries);
+    return result;
+}
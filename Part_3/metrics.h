@@ -0,0 +1,56 @@
+/*
+ * Counters and latency histograms of the server, read by the STATS
+ * operation. They are updated with relaxed atomic adds, so recording a
+ * value never takes a lock.
+ */
+#ifndef METRICS_H
+#define METRICS_H
+
+#include <stdint.h>
+#include <time.h>
+
+/* Bucket i counts durations below 2^i microseconds (1 us to 16.8 s), the
+ * last one everything longer */
+#define HISTOGRAM_BUCKETS 26
+
+typedef struct {
+    unsigned long count;
+    unsigned long sum_ns;
+    unsigned long buckets[HISTOGRAM_BUCKETS];
+} histogram;
+
+/* Counters of the log shipper of log_client.c */
+typedef struct {
+    unsigned long enqueued;
+    unsigned long shipped;
+    unsigned long dropped;
+    unsigned long lost;
+    unsigned long calls;
+    unsigned long failed_calls;
+    int queued;                 /* Records waiting to be shipped */
+    histogram send_log;         /* Time to queue a record */
+    histogram call;             /* Time of a log_batch RPC call */
+} log_metrics;
+
+/* Function to read a monotonic clock in nanoseconds */
+static inline uint64_t metrics_now(void) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (uint64_t)now.tv_sec * 1000000000 + now.tv_nsec;
+}
+
+/* Function to record a duration in nanoseconds */
+static inline void histogram_observe(histogram *h, uint64_t ns) {
+    uint64_t us = ns / 1000;
+    int bucket = us == 0 ? 0 : 64 - __builtin_clzll(us);
+    if (bucket >= HISTOGRAM_BUCKETS) {
+        bucket = HISTOGRAM_BUCKETS - 1;
+    }
+    __atomic_fetch_add(&h->buckets[bucket], 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&h->sum_ns, ns, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&h->count, 1, __ATOMIC_RELAXED);
+}
+
+void log_get_metrics(log_metrics *metrics);
+
+#endif
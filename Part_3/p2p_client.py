@@ -0,0 +1,1404 @@
+"""
+Client library of the P2P file sharing system.
+
+Instance-based asyncio API over the protocol of the main server and the
+transfers between peers. A Client holds the connections to the server and
+the transfer settings; any number of User objects share it, each with its
+own state (connected user, upload server, table of connected users,
+resolved addresses), so one process can drive thousands of users at once.
+Operations return their results as named tuples and raise RequestError
+with the code sent by the server or the peer.
+
+    async with Client("localhost", 8888, persistent=True) as api:
+        alice = api.user("alice")
+        await alice.register()
+        await alice.connect()
+        await alice.publish("/tmp/notes.txt", "my notes")
+        for user in await alice.list_users():
+            print(user.name, user.ip, user.port)
+
+The blocking reader and control connection of the wire format
+(FramedReader, FrameReader, ControlConnection) are also here, for scripts
+that drive the server without an event loop.
+"""
+import asyncio
+import bisect
+import collections
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+NONE_USER = "__NONE__"           # Username sent when no user is registered
+DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+LENGTH = struct.Struct('>I')     # v2 string length
+INT = struct.Struct('>i')        # v2 integer field
+HEADER = struct.Struct('>II')    # v2 frame length, request id
+
+# ******************** RESULTS *******************
+UserInfo = collections.namedtuple('UserInfo', 'name ip port')
+FileInfo = collections.namedtuple('FileInfo', 'name description')
+ContentPage = collections.namedtuple('ContentPage', 'files next_cursor')
+SearchResult = collections.namedtuple('SearchResult', 'owner name description score')
+SearchPage = collections.namedtuple('SearchPage', 'total next_cursor results')
+TransferStats = collections.namedtuple('TransferStats', 'file size received resumed seconds sources')
+
+
+# ******************** METRICS *******************
+# Histogram of durations in seconds, with fixed buckets from 10 us to 10 s
+class Histogram:
+    BOUNDS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2,
+              2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(Histogram.BOUNDS) + 1)   # The last one has no bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(Histogram.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Function to estimate the p-th percentile: the bound of the bucket
+    # that holds it, or the largest duration if it is lower
+    def percentile(self, p):
+        rank = self.count * p / 100
+        seen = 0
+        for bound, count in zip(Histogram.BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    # Function to get the histogram as JSON values, with cumulative buckets
+    def snapshot(self):
+        buckets = {}
+        seen = 0
+        for bound, count in zip(Histogram.BOUNDS + (None,), self.buckets):
+            seen += count
+            buckets["+Inf" if bound is None else f"{bound:g}"] = seen
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "p50": self.percentile(50), "p95": self.percentile(95),
+                "p99": self.percentile(99), "buckets": buckets}
+
+    # Function to get the lines of the histogram in the Prometheus text format
+    def prometheus(self, name, labels):
+        lines = [f'{name}_bucket{{{labels},le="{le}"}} {count}'
+                 for le, count in self.snapshot()["buckets"].items()]
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+# Durations of the phases of the requests and transfers of a Client, of
+# every request per operation, and counters. The phases are:
+#   connect       opening a connection with the server (and its session)
+#   timestamp     getting the date of a request
+#   send          writing a request to the server
+#   reply         waiting for the reply of the server and reading it
+#   peer_connect  opening a connection with a peer
+#   peer_reply    sending a request to a peer and reading its answer
+#   transfer      receiving a file body, or a checkpoint of it, from a peer
+#   sync          syncing received data to disk
+#   upload        sending a file body to a peer
+class Metrics:
+    def __init__(self):
+        self.phases = collections.defaultdict(Histogram)
+        self.operations = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+
+    def observe(self, phase, seconds):
+        self.phases[phase].observe(seconds)
+
+    def snapshot(self):
+        return {"phases": {name: h.snapshot() for name, h in sorted(self.phases.items())},
+                "operations": {name: h.snapshot() for name, h in sorted(self.operations.items())},
+                "counters": dict(sorted(self.counters.items()))}
+
+    # Function to get the metrics in the Prometheus text format
+    def prometheus(self, prefix="p2p_client"):
+        lines = []
+        for kind, label, histograms in (("phase", "phase", self.phases),
+                                        ("request", "operation", self.operations)):
+            name = f"{prefix}_{kind}_seconds"
+            lines += [f"# HELP {name} Duration of the client {kind}s by {label}.",
+                      f"# TYPE {name} histogram"]
+            for key, histogram in sorted(histograms.items()):
+                lines += histogram.prometheus(name, f'{label}="{key}"')
+        for counter, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {prefix}_{counter}_total counter",
+                      f"{prefix}_{counter}_total {value}"]
+        return '\n'.join(lines) + '\n'
+
+
+# Error raised when the server or a peer answers a request with an error code
+class RequestError(Exception):
+    def __init__(self, operation, code):
+        super().__init__(f"{operation} failed with code {code}")
+        self.operation = operation
+        self.code = code
+
+
+# ****************** WIRE FORMAT *****************
+# Function to encode the fields of a request. With version 1 every field
+# is a NUL-terminated string, preceded by the request id in session mode.
+# With version 2 the request is a frame: its length, the request id and
+# the fields, strings prefixed by their length and integers as 32 bits.
+def encode_request(fields, version=1, request_id=None):
+    if version == 1:
+        out = [] if request_id is None else [str(request_id).encode() + b'\0']
+        out.extend(str(field).encode() + b'\0' for field in fields)
+        return b''.join(out)
+    out = []
+    for field in fields:
+        if isinstance(field, int):
+            out.append(INT.pack(field))
+        else:
+            data = field.encode()
+            out.append(LENGTH.pack(len(data)) + data)
+    body = b''.join(out)
+    return HEADER.pack(len(body) + 4, request_id) + body
+
+
+# Buffered reader for a blocking socket. It pulls large chunks and splits
+# them on '\0', keeping leftover bytes for the next field and for any raw
+# payload that follows the fields.
+class FramedReader:
+    CHUNK_SIZE = 65536
+
+    def __init__(self, sock, chunk_size=None):
+        self._sock = sock
+        self._chunk_size = chunk_size or FramedReader.CHUNK_SIZE
+        self._buffer = bytearray()
+        self._pos = 0
+
+    # Function to pull the next chunk from the socket, False on EOF
+    def _fill(self):
+        # Drop already consumed bytes before growing the buffer
+        if self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        chunk = self._sock.recv(self._chunk_size)
+        if not chunk:
+            return False
+        self._buffer.extend(chunk)
+        return True
+
+    # Function to receive a NUL-terminated string
+    def read_string(self):
+        start = self._pos
+        while True:
+            end = self._buffer.find(b'\0', start)
+            if end != -1:
+                data = self._buffer[self._pos:end]
+                self._pos = end + 1
+                return data.decode()
+            start = len(self._buffer) - self._pos
+            if not self._fill():
+                # Connection closed: return what we have, like a short read
+                data = self._buffer[self._pos:]
+                self._pos = len(self._buffer)
+                return data.decode()
+
+    # Function to receive a single response code
+    def read_byte(self):
+        if self._pos >= len(self._buffer) and not self._fill():
+            raise ConnectionError("connection closed by peer")
+        value = self._buffer[self._pos]
+        self._pos += 1
+        return value
+
+    # Function to receive an integer sent as a decimal string
+    def read_int(self):
+        return int(self.read_string())
+
+    # Function to receive exactly size bytes
+    def read_exact(self, size):
+        while len(self._buffer) - self._pos < size:
+            if not self._fill():
+                raise ConnectionError("connection closed by peer")
+        data = bytes(self._buffer[self._pos:self._pos + size])
+        self._pos += size
+        return data
+
+    # Function to receive raw payload bytes into a buffer, leftover bytes first
+    def recv_into(self, view):
+        if self._pos < len(self._buffer):
+            size = min(len(view), len(self._buffer) - self._pos)
+            view[:size] = self._buffer[self._pos:self._pos + size]
+            self._pos += size
+            return size
+        return self._sock.recv_into(view)
+
+    # Function to receive raw payload bytes, leftover bytes first
+    def recv(self, size):
+        if self._pos < len(self._buffer):
+            data = bytes(self._buffer[self._pos:self._pos + size])
+            self._pos += len(data)
+            return data
+        return self._sock.recv(size)
+
+
+# Reader of a whole reply frame of the v2 framing. Strings are a 32-bit
+# length followed by the bytes and integers are 32-bit fields, all
+# big-endian, so no byte needs to be scanned.
+class FrameReader:
+    def __init__(self, frame):
+        self._frame = frame
+        self._pos = 0
+
+    # Function to get the response code
+    def read_byte(self):
+        value = self._frame[self._pos]
+        self._pos += 1
+        return value
+
+    # Function to get a length-prefixed string field
+    def read_string(self):
+        (size,) = LENGTH.unpack_from(self._frame, self._pos)
+        start = self._pos + 4
+        self._pos = start + size
+        if self._pos > len(self._frame):
+            raise ConnectionError("truncated reply frame")
+        return self._frame[start:self._pos].decode()
+
+    # Function to get an integer field
+    def read_int(self):
+        (value,) = INT.unpack_from(self._frame, self._pos)
+        self._pos += 4
+        return value
+
+
+# Blocking control connection in session mode. Every request is tagged
+# with a request id, so several requests can be sent before reading their
+# replies, which arrive in order.
+class ControlConnection:
+    def __init__(self, sock, version=1):
+        self.sock = sock
+        self.version = version
+        self.reader = FramedReader(sock)
+        self._fields = []
+        self._next_id = 0
+        self._pending = collections.deque()
+
+        # Requests are small and pipelined: do not let Nagle delay them
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(session_request(version))
+        if self.reader.read_byte() != 0:
+            raise ConnectionError("session refused by server")
+
+    # Function to queue a string field of the current request
+    def send_string(self, string):
+        self._fields.append(string)
+
+    # Function to queue an integer field of the current request
+    def send_int(self, value):
+        self._fields.append(value)
+
+    # Function to send the current request
+    def flush(self):
+        if self._fields:
+            self._next_id += 1
+            self._pending.append(self._next_id)
+            self.sock.sendall(encode_request(self._fields, self.version, self._next_id))
+            self._fields = []
+
+    # Function to get a reader for the reply of the oldest pending request
+    def read_reply(self):
+        self.flush()
+        request_id = self._pending.popleft()
+        if self.version == 1:
+            reply_id = self.reader.read_string()
+            if reply_id != str(request_id):
+                raise ConnectionError(f"reply {reply_id} does not match request {request_id}")
+            return self.reader
+
+        # The whole frame is read at once and parsed from memory
+        length, reply_id = HEADER.unpack(self.reader.read_exact(8))
+        if reply_id != request_id or length < 5:
+            raise ConnectionError(f"reply {reply_id} does not match request {request_id}")
+        return FrameReader(self.reader.read_exact(length - 4))
+
+    def close(self):
+        self.sock.close()
+
+
+# Function to get the request that switches a connection to session mode
+# with the given framing. A server without the v2 framing reads the
+# version as the date of an unknown operation and closes the connection.
+def session_request(version):
+    if version == 2:
+        return b'SESSION_V2\0' + b'2\0'
+    return b'SESSION\0'
+
+
+# Buffered reader of fields for asyncio, the async counterpart of
+# FramedReader. receive is a coroutine function that returns the next
+# chunk of data (b'' at the end). Fields already in the buffer are
+# returned without waiting.
+class AsyncReader:
+    def __init__(self, receive):
+        self._receive = receive
+        self._buffer = bytearray()
+        self._pos = 0
+
+    # Function to pull the next chunk
+    async def _fill(self):
+        # Drop already consumed bytes before growing the buffer
+        if self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        chunk = await self._receive()
+        if not chunk:
+            raise ConnectionError("connection closed by peer")
+        self._buffer.extend(chunk)
+
+    # Function to receive a NUL-terminated string
+    async def read_string(self):
+        end = self._buffer.find(b'\0', self._pos)
+        while end == -1:
+            start = len(self._buffer) - self._pos
+            await self._fill()
+            end = self._buffer.find(b'\0', start)
+        data = self._buffer[self._pos:end]
+        self._pos = end + 1
+        return data.decode()
+
+    # Function to receive a single response code
+    async def read_byte(self):
+        if self._pos >= len(self._buffer):
+            await self._fill()
+        value = self._buffer[self._pos]
+        self._pos += 1
+        return value
+
+    # Function to receive an integer sent as a decimal string
+    async def read_int(self):
+        return int(await self.read_string())
+
+    # Function to receive exactly size bytes
+    async def read_exact(self, size):
+        while len(self._buffer) - self._pos < size:
+            await self._fill()
+        data = bytes(self._buffer[self._pos:self._pos + size])
+        self._pos += size
+        return data
+
+
+# Async view of a reply frame of the v2 framing, already in memory
+class FrameFields(FrameReader):
+    async def read_byte(self):
+        return FrameReader.read_byte(self)
+
+    async def read_string(self):
+        return FrameReader.read_string(self)
+
+    async def read_int(self):
+        return FrameReader.read_int(self)
+
+
+# ***************** SERVER CONNECTION ****************
+# Connection with the main server. In session mode requests are tagged and
+# pipelined: any number of coroutines can send requests at once and a
+# reader task hands every reply to the request that waits for it, in
+# order. A one-shot connection carries a single request.
+class ServerConnection:
+    CHUNK_SIZE = 65536
+
+    def __init__(self, stream, writer, version=1, session=False):
+        self._reader = AsyncReader(lambda: stream.read(ServerConnection.CHUNK_SIZE))
+        self._writer = writer
+        self.version = version
+        self.session = session
+        self.broken = False
+        self._next_id = 0
+        self._pending = collections.deque()
+        self._reader_task = asyncio.ensure_future(self._read_replies()) if session else None
+        self.metrics = None      # Metrics of the send and reply phases, if set
+
+    # Function to open a connection, in session mode with the given framing.
+    # If the server does not know SESSION_V2 the session is opened again
+    # with the v1 framing.
+    @staticmethod
+    async def open(host, port, version=1, session=True):
+        for attempt in sorted({version, 1}, reverse=True):
+            stream, writer = await asyncio.open_connection(host, port)
+            if not session:
+                return ServerConnection(stream, writer)
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                writer.write(session_request(attempt))
+                if (await stream.readexactly(1))[0] != 0:
+                    raise ConnectionError("session refused by server")
+                return ServerConnection(stream, writer, attempt, True)
+            except (OSError, EOFError) as e:
+                writer.close()
+                if attempt == 1:
+                    raise ConnectionError(f"cannot open session: {e}") from e
+
+    # Function to send a request and wait for its reply. parse reads the
+    # fields that follow response code 0; its result is returned. Raises
+    # RequestError for other codes and ConnectionError if the connection
+    # fails, which also fails every request pipelined after it.
+    async def request(self, fields, parse=None):
+        if self.broken:
+            raise ConnectionError("connection to server is broken")
+        start = sent = time.perf_counter()
+        try:
+            if not self.session:
+                self._writer.write(encode_request(fields))
+                try:
+                    await self._writer.drain()
+                    sent = time.perf_counter()
+                    return await self._read_result(self._reader, fields[0], parse)
+                except RequestError:
+                    raise
+                except Exception as e:
+                    raise ConnectionError(f"connection to server failed: {e!r}") from e
+
+            future = asyncio.get_running_loop().create_future()
+            self._next_id += 1
+            self._pending.append((self._next_id, fields[0], parse, future))
+            self._writer.write(encode_request(fields, self.version, self._next_id))
+            try:
+                await self._writer.drain()
+            except OSError as e:
+                self._fail(e)
+            sent = time.perf_counter()
+            return await future
+        finally:
+            if self.metrics:
+                self.metrics.observe("send", sent - start)
+                self.metrics.observe("reply", time.perf_counter() - sent)
+
+    # Function to read the response code of a reply and, if it is 0, the
+    # fields that follow with parse
+    @staticmethod
+    async def _read_result(fields, operation, parse):
+        code = await fields.read_byte()
+        if code != 0:
+            raise RequestError(operation, code)
+        return await parse(fields) if parse else None
+
+    # Function to get the request id and the fields of the next reply
+    async def _next_reply(self):
+        if self.version == 1:
+            return int(await self._reader.read_string()), self._reader
+
+        # The whole frame is read at once and parsed from memory
+        length, reply_id = HEADER.unpack(await self._reader.read_exact(8))
+        if length < 5:
+            raise ConnectionError(f"invalid reply frame of {length} bytes")
+        return reply_id, FrameFields(await self._reader.read_exact(length - 4))
+
+    # Reader task of a session: hands the replies to the pending requests
+    async def _read_replies(self):
+        try:
+            while True:
+                reply_id, fields = await self._next_reply()
+                if not self._pending or self._pending[0][0] != reply_id:
+                    raise ConnectionError(f"unexpected reply {reply_id}")
+                _, operation, parse, future = self._pending[0]
+                try:
+                    result = await self._read_result(fields, operation, parse)
+                except RequestError as e:
+                    result = e
+                self._pending.popleft()
+                if future.done():
+                    continue   # The caller stopped waiting
+                if isinstance(result, RequestError):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            self._fail(e)
+
+    # Function to mark the connection as broken and fail its pending requests
+    def _fail(self, error):
+        self.broken = True
+        self._writer.close()
+        while self._pending:
+            future = self._pending.popleft()[3]
+            if not future.done():
+                future.set_exception(ConnectionError(f"connection to server failed: {error!r}"))
+
+    async def close(self):
+        self.broken = True
+        self._writer.close()
+        if self._reader_task:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+
+
+# ****************** PEER TRANSFERS ******************
+# Reader for a non-blocking peer socket. Each receive waits at most
+# timeout seconds if it is set.
+class PeerReader(AsyncReader):
+    CHUNK_SIZE = 65536
+
+    def __init__(self, sock, timeout=None):
+        super().__init__(self._recv)
+        self.sock = sock
+        self._timeout = timeout
+        self._loop = asyncio.get_running_loop()
+
+    async def _wait(self, operation):
+        if self._timeout is None:
+            return await operation
+        return await asyncio.wait_for(operation, self._timeout)
+
+    async def _recv(self):
+        return await self._wait(self._loop.sock_recv(self.sock, PeerReader.CHUNK_SIZE))
+
+    # Function to receive raw payload bytes into a buffer, leftover bytes first
+    async def recv_into(self, view):
+        if self._pos < len(self._buffer):
+            size = min(len(view), len(self._buffer) - self._pos)
+            view[:size] = self._buffer[self._pos:self._pos + size]
+            self._pos += size
+            return size
+        return await self._wait(self._loop.sock_recv_into(self.sock, view))
+
+
+# Sidecar journal of the byte ranges of a download that are already safely
+# on disk, so an interrupted transfer can resume instead of starting over.
+# One JSON object per line: a header with the remote file name and size,
+# then one line per range.
+class TransferJournal:
+    SUFFIX = ".journal"
+
+    def __init__(self, local_file, remote_file, size, ranges=None):
+        self.path = local_file + TransferJournal.SUFFIX
+        self.remote_file = remote_file
+        self.size = size
+        self.ranges = list(ranges or [])
+        self._lock = threading.Lock()
+        if ranges is None:
+            # New download: start a new journal
+            with open(self.path, 'w') as f:
+                f.write(json.dumps({"file": remote_file, "size": size}) + '\n')
+        self._file = open(self.path, 'a')
+
+    # Function to load the journal of a previous attempt to download
+    # remote_file into local_file. Returns None if there is none.
+    @staticmethod
+    def resume(local_file, remote_file):
+        path = local_file + TransferJournal.SUFFIX
+        if not os.path.exists(local_file) or not os.path.exists(path):
+            return None
+        ranges = []
+        try:
+            with open(path) as f:
+                header = json.loads(f.readline())
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break   # Torn last line of an interrupted write
+                    ranges.append((entry["offset"], entry["length"]))
+        except (OSError, ValueError, KeyError):
+            return None
+        if header.get("file") != remote_file:
+            return None
+        return TransferJournal(local_file, remote_file, header["size"], ranges)
+
+    # Function to record a range whose data has been synced to disk
+    def record(self, offset, length):
+        with self._lock:
+            self.ranges.append((offset, length))
+            self._file.write(json.dumps({"offset": offset, "length": length}) + '\n')
+            self._file.flush()
+
+    # Function to get the end of the completed range starting at byte 0
+    def completed_prefix(self):
+        end = 0
+        for offset, length in sorted(self.ranges):
+            if offset > end:
+                break
+            end = max(end, offset + length)
+        return min(end, self.size)
+
+    # Function to check if a range is fully covered by completed ranges
+    def covers(self, offset, length):
+        end = offset
+        for start, size in sorted(self.ranges):
+            if start > end:
+                break
+            end = max(end, start + size)
+            if end >= offset + length:
+                return True
+        return length == 0
+
+    # Function to get the number of bytes already completed
+    def completed_bytes(self):
+        total = 0
+        end = 0
+        for offset, length in sorted(self.ranges):
+            start = max(offset, end)
+            if offset + length > start:
+                total += offset + length - start
+                end = offset + length
+        return total
+
+    def close(self):
+        self._file.close()
+
+    # Function to delete the journal once the download is complete
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Function to reserve the final size of a file being downloaded
+def preallocate(fd, size):
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not supported by the platform or file system
+        os.ftruncate(fd, size)
+
+
+# Function to clean up after a failed download. The partial file is kept
+# with its journal if some data was completed, otherwise both are deleted.
+def abort_download(local_file, journal):
+    if journal and journal.ranges:
+        journal.close()
+        return
+    if journal:
+        journal.remove()
+    if os.path.exists(local_file):
+        os.remove(local_file)
+
+
+# Server of the files of a connected user to its peers (GET_FILE and
+# GET_FILE_RANGE). At most max_uploads files are sent at once and at most
+# upload_queue_depth more peers wait for a slot; beyond that new peers
+# wait in the listen backlog. Peers that stop reading or sending are
+# dropped after upload_timeout seconds.
+class UploadServer:
+    FILE_CHUNK_SIZE = 65536
+
+    def __init__(self, api):
+        self.api = api
+        self.port = None
+        self._sock = None
+        self._task = None
+
+    # Function to start listening on a free port
+    async def start(self, host='0.0.0.0', port=0):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((host, port))
+            sock.listen(self.api.upload_queue_depth)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self.port = sock.getsockname()[1]
+        self._task = asyncio.ensure_future(self._accept_peers())
+        return self.port
+
+    # Function to stop accepting peers. Uploads in progress finish.
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, OSError):
+                pass
+            self._task = None
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    # Accept task. A slot is taken before each accept, so when every worker
+    # is busy and the queue is full the peers wait in the listen backlog.
+    async def _accept_peers(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.api.max_uploads + self.api.upload_queue_depth)
+        workers = asyncio.Semaphore(self.api.max_uploads)
+        while True:
+            await slots.acquire()
+            try:
+                peer, _ = await loop.sock_accept(self._sock)
+            except OSError as e:
+                print(f"Error in upload listener: {e}", file=sys.stderr)
+                return
+            task = asyncio.ensure_future(self._serve(peer, workers))
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _serve(self, peer, workers):
+        async with workers:
+            await self.handle(peer)
+
+    # Function that handles a file transfer to a peer
+    async def handle(self, peer):
+        try:
+            reader = PeerReader(peer, self.api.upload_timeout)
+            operation = await reader.read_string()
+            if operation == "GET_FILE":
+                file_name = await reader.read_string()
+                offset, length = 0, None
+            elif operation == "GET_FILE_RANGE":
+                # File name, start offset and length of the range
+                file_name = await reader.read_string()
+                offset = int(await reader.read_string())
+                length = int(await reader.read_string())
+            else:
+                return
+
+            # Check if file exists
+            if not os.path.isfile(file_name):
+                await self._send(peer, b'\x01')  # Code 1: File does not exist
+                return
+
+            if self.api.socket_buffer_size:
+                peer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.api.socket_buffer_size)
+
+            with open(file_name, 'rb') as f:
+                file_size = os.fstat(f.fileno()).st_size
+                if length is None:
+                    length = file_size
+                elif offset < 0 or length < 0 or offset > file_size:
+                    await self._send(peer, b'\x02')  # Code 2: Invalid range
+                    return
+
+                # Send success code (0) and total file size, then the content
+                await self._send(peer, b'\x00' + str(file_size).encode() + b'\0')
+                start = time.perf_counter()
+                sent = await self.send_file_body(peer, f, offset, min(length, file_size - offset))
+                self.api.metrics.observe("upload", time.perf_counter() - start)
+                self.api.metrics.counters["uploads"] += 1
+                self.api.metrics.counters["bytes_sent"] += sent
+        except Exception as e:
+            print(f"Error in file transfer: {e}", file=sys.stderr)
+        finally:
+            peer.close()
+
+    async def _send(self, peer, data):
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(loop.sock_sendall(peer, data), self.api.upload_timeout)
+
+    # Function to wait until a peer can take more data, at most upload_timeout
+    async def _writable(self, peer):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_writer(peer.fileno(), lambda: ready.done() or ready.set_result(None))
+        timer = loop.call_later(self.api.upload_timeout, lambda: ready.done() or
+                                ready.set_exception(TimeoutError("peer stopped reading")))
+        try:
+            await ready
+        finally:
+            timer.cancel()
+            loop.remove_writer(peer.fileno())
+
+    # Function to send count bytes of an open file starting at offset.
+    # Regular files go through sendfile, so the data never passes through
+    # Python; other files are copied in chunks. The loop only waits when
+    # the socket buffer of the peer is full.
+    async def send_file_body(self, peer, f, offset, count):
+        if count <= 0:
+            return 0
+        sent = 0
+        if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            if offset:
+                f.seek(offset)
+            while sent < count:
+                data = f.read(min(UploadServer.FILE_CHUNK_SIZE, count - sent))
+                if not data:
+                    break
+                await self._send(peer, data)
+                sent += len(data)
+            return sent
+
+        while sent < count:
+            try:
+                n = os.sendfile(peer.fileno(), f.fileno(), offset + sent, count - sent)
+            except BlockingIOError:
+                await self._writable(peer)
+                continue
+            if not n:
+                break
+            sent += n
+        return sent
+
+
+# ******************** CLIENT ********************
+# Client of one main server: the connections to it, the settings of the
+# transfers and the users that act on it. Settings can be overridden per
+# client with keyword arguments.
+class Client:
+    content_page_size = 500         # Files per LIST_CONTENT_PAGE request
+    search_page_size = 20           # Results per SEARCH request
+    peer_cache_ttl = 30.0           # Seconds a resolved peer is reused
+    recv_buffer_size = 1 << 20      # Reusable buffer for downloads
+    socket_buffer_size = None       # SO_RCVBUF/SO_SNDBUF for transfers, None keeps the OS default
+    segment_size = 4 << 20          # Bytes per segment in multi-source downloads
+    max_sources = 8                 # Peers used at once in multi-source downloads
+    stall_timeout = 10.0            # Seconds without data before a peer is dropped
+    checkpoint_size = 8 << 20       # Bytes between journal records in downloads
+    max_uploads = 16                # Files served to peers at once, per user
+    upload_queue_depth = 64         # Accepted peers waiting for an upload worker
+    upload_timeout = 30.0           # Seconds a served peer may stay idle
+    max_lookups = 64                # Requests in flight when a user scans the others
+
+    # persistent sends the requests over sessions (connections of them,
+    # shared round-robin by all the users) instead of a connection per
+    # request; protocol is the framing of the sessions. timestamp is a
+    # callable that returns the date of each request, the local clock if
+    # it is not set.
+    def __init__(self, host, port, persistent=True, protocol=1, connections=1,
+                 timestamp=None, **settings):
+        for name, value in settings.items():
+            if not hasattr(Client, name):
+                raise TypeError(f"unknown setting {name}")
+            setattr(self, name, value)
+        self.host = host
+        self.port = port
+        self.persistent = persistent or protocol == 2
+        self.protocol = protocol
+        self.users = {}
+        self._timestamp = timestamp
+        self._connections = [None] * max(1, connections)
+        self._opening = [None] * len(self._connections)
+        self._next = 0
+        self.metrics = Metrics()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # Function to get the user of the given name, created on first use
+    def user(self, name):
+        user = self.users.get(name)
+        if user is None:
+            user = self.users[name] = User(self, name)
+        return user
+
+    # Function to get the date of a request
+    def timestamp(self):
+        if self._timestamp:
+            return self._timestamp()
+        return datetime.now().strftime(DATE_FORMAT)
+
+    # Function to send a request (operation, date and fields) and wait for
+    # its reply. parse reads the fields of a successful reply. Raises
+    # RequestError with the response code if it is not 0.
+    async def request(self, operation, *fields, parse=None):
+        metrics = self.metrics
+        start = time.perf_counter()
+        fields = (operation, self.timestamp()) + fields
+        metrics.observe("timestamp", time.perf_counter() - start)
+        try:
+            if not self.persistent:
+                conn = await self._open(session=False)
+                try:
+                    return await conn.request(fields, parse)
+                finally:
+                    await conn.close()
+            conn = await self._session()
+            return await conn.request(fields, parse)
+        except Exception:
+            metrics.counters["request_errors"] += 1
+            raise
+        finally:
+            metrics.operations[operation].observe(time.perf_counter() - start)
+
+    async def _open(self, session):
+        start = time.perf_counter()
+        try:
+            conn = await ServerConnection.open(self.host, self.port, self.protocol, session)
+        except (OSError, EOFError) as e:
+            self.metrics.counters["connect_errors"] += 1
+            raise ConnectionError(f"cannot connect to server: {e}") from e
+        self.metrics.observe("connect", time.perf_counter() - start)
+        self.metrics.counters["connections"] += 1
+        conn.metrics = self.metrics
+        return conn
+
+    # Function to get the next session, opened again if it broke. Callers
+    # that arrive while it is being opened wait for the same attempt.
+    async def _session(self):
+        index = self._next
+        self._next = (self._next + 1) % len(self._connections)
+        conn = self._connections[index]
+        if conn is not None and not conn.broken:
+            return conn
+        if self._opening[index] is None:
+            self._opening[index] = asyncio.ensure_future(self._open(session=True))
+        opening = self._opening[index]
+        try:
+            conn = await opening
+        finally:
+            if self._opening[index] is opening:
+                self._opening[index] = None
+        self._connections[index] = conn
+        return conn
+
+    # Function to close the sessions and the upload servers of the users
+    async def close(self):
+        for user in self.users.values():
+            await user.stop_uploads()
+        for index, conn in enumerate(self._connections):
+            self._connections[index] = None
+            if conn:
+                await conn.close()
+
+    # Function to get the metrics of the server (STATS): a dict from the
+    # name of each sample, labels included, to its value
+    async def server_stats(self):
+        async def parse(reply):
+            return dict([(await reply.read_string(), float(await reply.read_string()))
+                         for _ in range(await reply.read_int())])
+
+        return await self.request("STATS", parse=parse)
+
+    # Function to open a connection with a peer for a file transfer
+    async def connect_to_peer(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            if self.socket_buffer_size:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer_size)
+            start = time.perf_counter()
+            await asyncio.get_running_loop().sock_connect(sock, (ip, port))
+        except BaseException:
+            sock.close()
+            raise
+        self.metrics.observe("peer_connect", time.perf_counter() - start)
+        return sock
+
+    # Function to send a request to a peer and read its response code and
+    # the file size. Returns them with the open socket and the reader,
+    # positioned at the start of the data.
+    async def request_file(self, ip, port, fields, timeout=None):
+        sock = await self.connect_to_peer(ip, port)
+        try:
+            start = time.perf_counter()
+            await asyncio.get_running_loop().sock_sendall(sock, encode_request(fields))
+            reader = PeerReader(sock, timeout)
+            response = await reader.read_byte()
+            file_size = int(await reader.read_string()) if response == 0 else 0
+        except BaseException:
+            sock.close()
+            raise
+        self.metrics.observe("peer_reply", time.perf_counter() - start)
+        return response, file_size, sock, reader
+
+    # Function to request a byte range of a remote file from a peer
+    async def request_range(self, ip, port, file_name, offset, length, timeout=None):
+        return await self.request_file(ip, port, ("GET_FILE_RANGE", file_name, offset, length),
+                                       timeout)
+
+    # Function to receive count bytes of a file body and write them at
+    # offset of an open file descriptor. Data is received straight into one
+    # reusable buffer, so no objects are allocated per chunk.
+    async def receive_file_body(self, reader, fd, offset, count):
+        buffer = memoryview(bytearray(min(self.recv_buffer_size, max(count, 1))))
+        start = time.perf_counter()
+        received = 0
+        try:
+            while received < count:
+                n = await reader.recv_into(buffer[:min(len(buffer), count - received)])
+                if not n:
+                    break
+                written = 0
+                while written < n:
+                    written += os.pwrite(fd, buffer[written:n], offset + received + written)
+                received += n
+        finally:
+            self.metrics.observe("transfer", time.perf_counter() - start)
+            self.metrics.counters["bytes_received"] += received
+        return received
+
+    # Function to sync the data written to an open file descriptor to disk,
+    # in a thread of the executor
+    async def sync_file(self, fd):
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, os.fdatasync, fd)
+        self.metrics.observe("sync", time.perf_counter() - start)
+
+    # Function to receive a file body into a local file preallocated to its
+    # final size, starting at offset. Data is synced and recorded in the
+    # journal every checkpoint, so an interrupted download can be resumed.
+    # Returns the number of bytes received.
+    async def receive_file(self, reader, file_name, file_size, journal=None, offset=0):
+        flags = os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC)
+        fd = os.open(file_name, flags, 0o644)
+        try:
+            preallocate(fd, file_size)
+            received = 0
+            while offset + received < file_size:
+                length = min(self.checkpoint_size, file_size - offset - received)
+                n = await self.receive_file_body(reader, fd, offset + received, length)
+                if n and journal:
+                    await self.sync_file(fd)
+                    journal.record(offset + received, n)
+                received += n
+                if n < length:
+                    break
+            return received
+        finally:
+            os.close(fd)
+
+    # Function to start the download of a remote file from a peer. If a
+    # journal of a previous attempt matches the remote file, only the missing
+    # tail is requested (GET_FILE_RANGE). Returns the response code, file
+    # size, socket, reader, journal and start offset.
+    async def start_download(self, ip, port, remote_file, local_file):
+        journal = TransferJournal.resume(local_file, remote_file)
+        if journal:
+            offset = journal.completed_prefix()
+            if offset:
+                response, file_size, sock, reader = await self.request_range(
+                    ip, port, remote_file, offset, journal.size - offset)
+                if response == 0 and file_size == journal.size:
+                    return response, file_size, sock, reader, journal, offset
+                # The remote file changed: start over
+                sock.close()
+            journal.close()
+
+        response, file_size, sock, reader = await self.request_file(
+            ip, port, ("GET_FILE", remote_file))
+        journal = TransferJournal(local_file, remote_file, file_size) if response == 0 else None
+        return response, file_size, sock, reader, journal, 0
+
+    # Function to download remote_file from the peer at address (ip, port)
+    # into local_file, resuming a previous attempt. Raises RequestError with
+    # the code of the peer, or ConnectionError if the transfer is cut, in
+    # which case what can be resumed is kept.
+    async def download(self, address, remote_file, local_file):
+        start = time.monotonic()
+        response, file_size, sock, reader, journal, offset = await self.start_download(
+            *address, remote_file, local_file)
+        try:
+            if response != 0:
+                raise RequestError("GET_FILE", response)
+            try:
+                received = await self.receive_file(reader, local_file, file_size, journal, offset)
+            except BaseException:
+                abort_download(local_file, journal)
+                raise
+            if offset + received != file_size:
+                abort_download(local_file, journal)
+                raise ConnectionError(f"transfer of {remote_file} cut at {offset + received} bytes")
+            journal.remove()
+        finally:
+            sock.close()
+        self.metrics.counters["downloads"] += 1
+        return TransferStats(local_file, file_size, received, offset,
+                             time.monotonic() - start, 1)
+
+    # Function run by each source of a multi-source download: takes segments
+    # from the queue and writes them at their offset in the local file.
+    # A peer that fails or stalls puts its segment back and stops.
+    async def download_segments(self, peer, file_name, fd, segments, progress):
+        while True:
+            offset, length = await segments.get()
+            sock = None
+            try:
+                response, _, sock, reader = await self.request_range(
+                    peer.ip, peer.port, file_name, offset, length, self.stall_timeout)
+                if response != 0:
+                    raise ConnectionError(f"range refused by {peer.name}")
+                received = await self.receive_file_body(reader, fd, offset, length)
+                if received != length:
+                    raise ConnectionError(f"short range from {peer.name}")
+                await self.sync_file(fd)
+                progress["journal"].record(offset, length)
+            except Exception:
+                # Reassign the segment to the remaining peers
+                segments.put_nowait((offset, length))
+                return
+            finally:
+                if sock:
+                    sock.close()
+
+            progress["received"] += length
+            if progress["received"] >= progress["size"]:
+                progress["done"].set()
+
+    # Function to download remote_file into local_file in segments fetched
+    # in parallel from the seeders (UserInfo), resuming a previous attempt.
+    # Raises ConnectionError if no seeder answers or the file is not
+    # completed, in which case what can be resumed is kept.
+    async def download_multi(self, seeders, remote_file, local_file):
+        start = time.monotonic()
+        seeders = seeders[:self.max_sources]
+
+        # Get the file size from the first seeder that answers
+        file_size = None
+        for peer in seeders:
+            try:
+                response, size, sock, _ = await self.request_range(
+                    peer.ip, peer.port, remote_file, 0, 0, self.stall_timeout)
+                sock.close()
+            except (OSError, ValueError, asyncio.TimeoutError):
+                continue
+            if response == 0 and size >= 0:
+                file_size = size
+                break
+        if file_size is None:
+            raise ConnectionError(f"no source answered for {remote_file}")
+
+        # Resume the segments of a previous attempt if its journal matches
+        journal = TransferJournal.resume(local_file, remote_file)
+        if journal and journal.size != file_size:
+            journal.close()
+            journal = None
+        flags = os.O_WRONLY | os.O_CREAT | (0 if journal else os.O_TRUNC)
+        if not journal:
+            journal = TransferJournal(local_file, remote_file, file_size)
+        fd = os.open(local_file, flags, 0o644)
+
+        # Split the missing part of the file in segments shared by all the seeders
+        segments = asyncio.Queue()
+        saved = 0
+        for offset in range(0, file_size, self.segment_size):
+            length = min(self.segment_size, file_size - offset)
+            if journal.covers(offset, length):
+                saved += length
+            else:
+                segments.put_nowait((offset, length))
+        progress = {"size": file_size, "received": saved, "journal": journal,
+                    "done": asyncio.Event()}
+        if saved >= file_size:
+            progress["done"].set()
+
+        try:
+            preallocate(fd, file_size)
+            sources = [asyncio.ensure_future(
+                self.download_segments(peer, remote_file, fd, segments, progress))
+                for peer in seeders]
+
+            # Wait until the file is complete or every source has failed
+            done = asyncio.ensure_future(progress["done"].wait())
+            failed = asyncio.gather(*sources)
+            await asyncio.wait([done, failed], return_when=asyncio.FIRST_COMPLETED)
+            for task in sources + [done]:
+                task.cancel()
+            await asyncio.gather(done, failed, return_exceptions=True)
+        finally:
+            os.close(fd)
+
+        if progress["received"] < file_size:
+            # Transfer not completed, keep what can be resumed
+            abort_download(local_file, journal)
+            raise ConnectionError(f"transfer of {remote_file} not completed")
+        journal.remove()
+        self.metrics.counters["downloads"] += 1
+        return TransferStats(local_file, file_size, file_size - saved, saved,
+                             time.monotonic() - start, len(seeders))
+
+
+# ********************* USER *********************
+# A user of the system acting through a Client. Requests are sent on
+# behalf of the user; connect starts the server of its files to peers.
+class User:
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+        self.connected = False
+        self.uploads = None          # Upload server while connected
+        self.peers = {}              # Connected users, username -> (ip, port)
+        self.peers_version = "0"     # Server version of peers
+        self._peer_cache = {}        # Resolved peers, username -> (ip, port, expiry)
+
+    def __repr__(self):
+        return f"User({self.name!r})"
+
+    async def register(self):
+        await self.api.request("REGISTER", self.name)
+
+    # Function to unregister the user, disconnecting it first if needed
+    async def unregister(self):
+        if self.connected:
+            try:
+                await self.disconnect()
+            except RequestError:
+                pass
+        await self.api.request("UNREGISTER", self.name)
+
+    # Function to connect the user. Peers download its files from port, or
+    # from a new upload server if port is not set.
+    async def connect(self, port=None):
+        started = None
+        if port is None:
+            if self.uploads is None:
+                started = self.uploads = UploadServer(self.api)
+                await started.start()
+            port = self.uploads.port
+        try:
+            await self.api.request("CONNECT", self.name, port)
+        except BaseException:
+            if started:
+                await self.stop_uploads()
+            raise
+        self.connected = True
+
+    # Function to disconnect the user. Its files stop being served even if
+    # the server cannot be told.
+    async def disconnect(self):
+        try:
+            await self.stop_uploads()
+        finally:
+            self.connected = False
+        await self.api.request("DISCONNECT", self.name)
+
+    async def stop_uploads(self):
+        uploads, self.uploads = self.uploads, None
+        if uploads:
+            await uploads.close()
+
+    async def publish(self, file_name, description):
+        await self.api.request("PUBLISH", self.name, file_name, description)
+
+    async def delete(self, file_name):
+        await self.api.request("DELETE", self.name, file_name)
+
+    # Function to update the table of connected users. Only the users changed
+    # since the last update are received, or the whole list if the server
+    # cannot send the changes. Returns the table, username -> (ip, port).
+    async def sync_users(self):
+        async def parse(reply):
+            version = await reply.read_string()
+            peers = {} if await reply.read_string() == "FULL" else dict(self.peers)
+            for _ in range(await reply.read_int()):
+                change = await reply.read_string()
+                name = await reply.read_string()
+                if change == "+":
+                    peers[name] = (await reply.read_string(), await reply.read_int())
+                else:
+                    peers.pop(name, None)
+            return version, peers
+
+        self.peers_version, self.peers = await self.api.request(
+            "LIST_USERS_DELTA", self.name, self.peers_version, parse=parse)
+        return self.peers
+
+    # Function to get the connected users, as UserInfo
+    async def list_users(self):
+        peers = await self.sync_users()
+        return [UserInfo(name, ip, port) for name, (ip, port) in peers.items()]
+
+    # Function to resolve the address (ip, port) of remote_user. Addresses
+    # are reused for peer_cache_ttl seconds unless refresh is set.
+    async def lookup(self, remote_user, refresh=False):
+        cached = self._peer_cache.get(remote_user)
+        if cached and not refresh and cached[2] > time.monotonic():
+            return cached[:2]
+
+        async def parse(reply):
+            return await reply.read_string(), await reply.read_int()
+
+        try:
+            ip, port = await self.api.request("LOOKUP_USER", self.name, remote_user, parse=parse)
+        except RequestError:
+            self._peer_cache.pop(remote_user, None)
+            raise
+        self._peer_cache[remote_user] = (ip, port, time.monotonic() + self.api.peer_cache_ttl)
+        return ip, port
+
+    # Function to get one page of the files published by remote_user: at
+    # most limit files whose name starts with prefix, published after the
+    # file the cursor stands for (0 for the first page). The cursor of the
+    # next page is -1 after the last one.
+    async def content_page(self, remote_user, cursor=0, limit=None, prefix=""):
+        async def parse(reply):
+            next_cursor = await reply.read_int()
+            files = [FileInfo(await reply.read_string(), await reply.read_string())
+                     for _ in range(await reply.read_int())]
+            return ContentPage(files, next_cursor)
+
+        return await self.api.request("LIST_CONTENT_PAGE", self.name, remote_user, cursor,
+                                      limit or self.api.content_page_size, prefix, parse=parse)
+
+    # Async generator of the files (FileInfo) published by remote_user whose
+    # name starts with prefix, requested one page at a time in publish
+    # order. Files deleted or published between pages are seen or not, but
+    # no other file is skipped or repeated.
+    async def list_content(self, remote_user, prefix="", page_size=None):
+        cursor = 0
+        while cursor != -1:
+            page = await self.content_page(remote_user, cursor, page_size, prefix)
+            cursor = page.next_cursor
+            for file in page.files:
+                yield file
+
+    # Function to search the files of every user whose name or description
+    # contains all the words of query, ranked by the server, limit at a
+    # time from position cursor
+    async def search(self, query, cursor=0, limit=None):
+        async def parse(reply):
+            total = await reply.read_int()
+            next_cursor = await reply.read_int()
+            results = [SearchResult(await reply.read_string(), await reply.read_string(),
+                                    await reply.read_string(), await reply.read_int())
+                       for _ in range(await reply.read_int())]
+            return SearchPage(total, next_cursor, results)
+
+        return await self.api.request("SEARCH", self.name, query, cursor,
+                                      limit or self.api.search_page_size, parse=parse)
+
+    # Function to find the connected users (other than this one) that
+    # publish file_name, as UserInfo. Their content is listed concurrently.
+    async def find_seeders(self, file_name):
+        lookups = asyncio.Semaphore(self.api.max_lookups)
+
+        async def publishes(user):
+            async with lookups:
+                try:
+                    # Only the files starting with the name are listed
+                    async for file in self.list_content(user.name, file_name):
+                        if file.name == file_name:
+                            return True
+                except RequestError:
+                    pass
+                return False
+
+        users = [user for user in await self.list_users() if user.name != self.name]
+        found = await asyncio.gather(*(publishes(user) for user in users))
+        return [user for user, publishing in zip(users, found) if publishing]
+
+    # Function to download remote_file published by remote_user into
+    # local_file. The address is resolved with LOOKUP_USER and resolved
+    # again if the connection to the peer fails. Returns TransferStats.
+    async def get_file(self, remote_user, remote_file, local_file):
+        address = await self.lookup(remote_user)
+        try:
+            return await self.api.download(address, remote_file, local_file)
+        except OSError:
+            # The cached address may be stale: resolve it again and retry
+            fresh = await self.lookup(remote_user, refresh=True)
+            if fresh == address:
+                raise
+        return await self.api.download(fresh, remote_file, local_file)
+
+    # Function to download remote_file into local_file from every connected
+    # user that publishes it, or from seeders if they are given. Returns
+    # TransferStats.
+    async def get_file_multi(self, remote_file, local_file, seeders=None):
+        if seeders is None:
+            seeders = await self.find_seeders(remote_file)
+        if not seeders:
+            raise RequestError("GET_FILE_MULTI", 1)
+        return await self.api.download_multi(seeders, remote_file, local_file)
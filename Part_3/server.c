@@ -3,53 +3,262 @@
 #include <string.h>
 #include <unistd.h>
 #include <sys/types.h>
+#include <sys/uio.h>
 #include <sys/socket.h>
 #include <netinet/in.h>
 #include <arpa/inet.h>
 #include <pthread.h>
 #include <signal.h>
+#include <time.h>
+#include <ctype.h>
+#include <stdint.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <sys/epoll.h>
+#include <sys/resource.h>
 #include "log_service.h"
+#include "metrics.h"
 
 #define MAX_USERS 100    // Initial capacity of users array
 #define MAX_STRING 256   // Maximum string size
 #define INITIAL_FILES 10    // Initial capacity of files array per user
+#define IO_BUFFER 4096   // Size of the connection input buffer
+#define INDEX_EMPTY -1    // Index slot never used
+#define INDEX_DELETED -2  // Index slot of a removed key
+#define JOURNAL_SIZE 65536  // Changes of the connected users kept for deltas
+#define MAX_PAGE 1000     // Maximum files per LIST_CONTENT_PAGE reply
+#define MIN_TOKEN 2       // Shorter words are not indexed for SEARCH
+#define MAX_TOKEN 64      // Longer words are indexed by their first bytes
+#define MAX_QUERY_TOKENS 16 // Words of a SEARCH query used
+#define MAX_FRAME (1 << 20)  // Maximum size of a v2 request frame
+#define DEFAULT_WORKERS 8  // Worker threads of the epoll front end
+#define MAX_EVENTS 256    // Events handled per epoll_wait
 
-// Structure to store published file information
+// Structure to store published file information. Both strings live in a
+// single allocation sized to their actual length (description follows the
+// filename), which is freed through filename. A deleted file keeps its
+// place, with a NULL filename, until the array is compacted.
 typedef struct {
-    char filename[MAX_STRING];
-    char description[MAX_STRING];
+    char *filename;
+    char *description;
+    int seq;            // Publish number, increasing for each user
 } File;
 
+// Hash index from a string key to a position in an array. It uses open
+// addressing; slots hold positions and the keys are read back from the
+// array through a callback, so the index never copies them.
+typedef struct {
+    int *slots;
+    int capacity;       // Number of slots (power of two)
+    int count;          // Positions stored
+    int deleted;        // Slots marked as deleted
+} Index;
+
+typedef const char *(*index_key_fn)(void *ctx, int position);
+
+// Growable buffer where a reply payload is built before it is sent
+typedef struct {
+    char *data;
+    size_t len;
+    size_t cap;
+    int failed;         // An allocation failed, the payload is incomplete
+    int binary;         // Encode fields with the v2 framing
+} Reply;
+
+// Structure to store the state of a client connection
+typedef struct Connection {
+    int sock;
+    int session;                    // Requests are tagged with a request id
+    char request_id[MAX_STRING];    // Id of the request being processed
+    char *in;                       // Buffered input from the socket
+    size_t in_cap;
+    size_t in_len;
+    size_t in_pos;
+    int binary;                     // v2 framing, negotiated with SESSION_V2
+    uint32_t frame_id;              // Request id of the current v2 frame
+    char *frame;                    // Fields of the current v2 frame
+    size_t frame_len;
+    size_t frame_pos;
+    size_t frame_cap;
+    int served;                     // Requests served
+    unsigned char response;         // Code of the last reply sent
+    // Epoll front end: the event loop buffers whole requests and hands the
+    // connection to a worker, so the request code never reads the socket
+    int evented;
+    int eof;                        // The peer closed its side
+    size_t scan_pos;                // Bytes of the request scanned so far
+    size_t field_start;             // Start of the field being scanned
+    int scan_fields;                // Fields of the request found
+    int scan_needed;                // Fields of the request, once known
+    char *out;                      // Reply bytes the socket did not take yet
+    size_t out_len;
+    size_t out_pos;
+    size_t out_cap;
+    int failed;                     // Writing to the peer failed
+    struct Connection *next;        // Next connection in the work queue
+} Connection;
+
 // Structure to store user information
 typedef struct {
-    char username[MAX_STRING];
+    char *username;     // Allocated, so it does not move with the array
     int connected;
     char ip[MAX_STRING];
     int port;
-    File *files;        // File pointer to allow resizing
-    int num_files;      // Current number of files
+    File *files;        // File pointer to allow resizing, in publish order
+    int num_files;      // Files in the array, deleted ones included
+    int num_deleted;    // Deleted files still in the array
     int max_files;      // Capacity of files array
+    Index files_index;  // Filename -> position in files
+    int last_seq;       // Publish number of the last file published
+    unsigned long version;  // Change number of the last connect/disconnect
 } User;
 
+// Change of the list of connected users: the user connected, disconnected
+// or was unregistered while connected
+typedef struct {
+    unsigned long seq;
+    char *username;
+} Change;
+
+// Published file in the search index: its owner and its strings, which do
+// not move while the file is published. The filename pointer identifies it.
+typedef struct {
+    const char *owner;
+    const char *filename;
+} Posting;
+
+// Word of the search index and the set of files that contain it, an open
+// addressing hash set of postings keyed by filename pointer
+typedef struct {
+    char *token;
+    Posting *slots;
+    int capacity;       // Number of slots (power of two)
+    int count;          // Postings stored
+    int deleted;        // Slots marked as deleted
+} Term;
+
+// Result of a search
+typedef struct {
+    const char *owner;
+    const char *filename;
+    int score;
+} Match;
+
+// Metrics of an operation for the STATS operation, updated with atomic
+// adds (see metrics.h)
+typedef struct {
+    unsigned long errors;   // Replies with a code other than 0, or the connection closed
+    histogram latency;      // From the date read to the reply sent
+} OperationMetrics;
+
 // Global variables
 int server_socket;
 User *users = NULL;
 int num_users = 0;
 int max_users = 0;
-pthread_mutex_t users_mutex = PTHREAD_MUTEX_INITIALIZER;
+Index users_index;      // Username -> position in users
+// Lookups and listings take the lock for reading, changes for writing.
+// Nothing is written to a socket while it is held.
+pthread_rwlock_t users_lock = PTHREAD_RWLOCK_INITIALIZER;
+
+// Last changes of the connected users, by change number modulo JOURNAL_SIZE.
+// Clients send back the version (server epoch and change number) they last
+// saw and get only the users changed since then. Protected by users_lock.
+Change journal[JOURNAL_SIZE];
+unsigned long change_seq = 0;
+unsigned long server_epoch = 0;
+
+// Search index: words of the filenames and descriptions of every published
+// file -> files containing them. Protected by users_lock.
+Term *terms = NULL;
+int num_terms = 0;
+int max_terms = 0;
+Index terms_index;      // Word -> position in terms
+
+// Epoll front end: connections with a whole request buffered wait in the
+// work queue for a worker
+int epoll_fd = -1;
+Connection *work_head = NULL;
+Connection *work_tail = NULL;
+pthread_mutex_t work_lock = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t work_ready = PTHREAD_COND_INITIALIZER;
+
+// Fields that follow the operation in a v1 request, the date included.
+// The epoll front end waits for all of them before handing the request
+// to a worker; keep it in sync with process_request.
+const struct {
+    const char *operation;
+    int fields;
+} request_fields[] = {
+    {"REGISTER", 2}, {"UNREGISTER", 2}, {"CONNECT", 3}, {"DISCONNECT", 2},
+    {"PUBLISH", 4}, {"DELETE", 3}, {"LIST_USERS", 2}, {"LIST_USERS_DELTA", 3},
+    {"LOOKUP_USER", 3}, {"LIST_CONTENT", 3}, {"LIST_CONTENT_PAGE", 6}, {"SEARCH", 5},
+    {"STATS", 1},
+};
+#define NUM_OPERATIONS (int)(sizeof(request_fields) / sizeof(request_fields[0]))
+
+// Metrics read by the STATS operation. Requests are counted by position
+// in request_fields, unknown operations in the last slot.
+OperationMetrics operation_metrics[NUM_OPERATIONS + 1];
+// Acquisitions of users_lock for reading [0] and writing [1], and the time
+// spent waiting for it when another thread held it
+unsigned long lock_acquired[2];
+unsigned long lock_contended[2];
+histogram lock_wait[2];
+// Threads serving a connection (thread per connection) or a request
+// (epoll workers), and the open connections
+int handlers_active = 0;
+int handlers_peak = 0;
+int connections_open = 0;
+unsigned long connections_total = 0;
+int workers_started = 0;    // Workers of the epoll front end
+int work_queued = 0;        // Connections in the work queue, protected by work_lock
+int work_queued_peak = 0;
+uint64_t start_time;
 
 // Function prototypes
+int index_init(Index *index, int capacity);
+void index_free(Index *index);
+int index_find(Index *index, const char *key, index_key_fn key_of, void *ctx);
+int index_insert(Index *index, const char *key, int position, index_key_fn key_of, void *ctx);
+void index_remove(Index *index, const char *key, index_key_fn key_of, void *ctx);
+void index_move(Index *index, const char *key, int position, index_key_fn key_of, void *ctx);
+void reply_append(Reply *reply, const char *data, size_t len);
+void reply_add_string(Reply *reply, const char *str);
+void reply_add_int(Reply *reply, int value);
+void reply_free(Reply *reply);
+void send_reply(Connection *conn, unsigned char response, Reply *payload);
+void send_evented(Connection *conn, struct iovec *iov, int iovcnt);
+int flush_output(Connection *conn);
 void *handle_client(void *socket_desc);
+Connection *connection_new(int sock);
+void connection_free(Connection *conn);
+int serve_request(Connection *conn);
+void run_event_loop(int workers);
+int process_request(Connection *conn, char *operation, char *datetime);
+int operation_index(const char *operation);
+void lock_users(int write);
+void gauge_add(int *gauge, int *peak, int delta);
+void add_metrics(Reply *reply);
 int find_user(char *username);
-void add_user(char *username);
+int add_user(char *username);
 void remove_user(char *username);
 void connect_user(int user_index, char *ip, int port);
 void disconnect_user(int user_index);
+void record_change(int user_index);
+void add_user_entry(Reply *reply, int user_index);
+void add_users_delta(Reply *reply, const char *since);
+const char *change_key(void *ctx, int position);
 int add_file(int user_index, char *filename, char *description);
 int remove_file(int user_index, char *filename);
-void handle_sigint(int sig);
+void compact_files(User *user);
+int search_add_file(const char *owner, File *file);
+void search_remove_file(File *file);
+int search_files(const char *query, Match **matches);
+void *handle_sigint(void *arg);
 void free_user_resources(int user_index);
 extern void send_log(const char *username, const char *operation, const char *timestamp);
+extern void log_shutdown(int timeout);
 
 int main(int argc, char *argv[]) {
     int port = 0;
@@ -59,25 +268,78 @@ int main(int argc, char *argv[]) {
     pthread_t thread_id;
     int *new_sock;
     char ip_str[INET_ADDRSTRLEN];
+    char *port_arg = NULL;
+    int use_epoll = 0;
+    int workers = DEFAULT_WORKERS;
+    int bad_args = 0;
+    int opt;
 
-    // Handle SIGINT signal (Ctrl+C)
-    signal(SIGINT, handle_sigint);
+    // Handle SIGINT signal (Ctrl+C) in a thread of its own. It is blocked
+    // in every other thread (they inherit the mask), so the shutdown never
+    // runs inside a thread that holds a lock it needs.
+    sigset_t sigint_set;
+    sigemptyset(&sigint_set);
+    sigaddset(&sigint_set, SIGINT);
+    pthread_sigmask(SIG_BLOCK, &sigint_set, NULL);
+    if (pthread_create(&thread_id, NULL, handle_sigint, NULL) != 0) {
+        perror("Error creating signal thread");
+        exit(1);
+    }
+    pthread_detach(thread_id);
+    // A peer that closes early must not kill the server on write
+    signal(SIGPIPE, SIG_IGN);
 
     // Parse command line arguments
-    if (argc != 3 || strcmp(argv[1], "-p") != 0) {
-        printf("Usage: %s -p <port>\n", argv[0]);
+    while ((opt = getopt(argc, argv, "p:m:w:")) != -1) {
+        switch (opt) {
+        case 'p':
+            port_arg = optarg;
+            break;
+        case 'm':
+            if (strcmp(optarg, "epoll") == 0) {
+                use_epoll = 1;
+            } else if (strcmp(optarg, "thread") != 0) {
+                bad_args = 1;
+            }
+            break;
+        case 'w':
+            workers = atoi(optarg);
+            break;
+        default:
+            bad_args = 1;
+        }
+    }
+    if (!port_arg || bad_args || optind != argc || workers <= 0) {
+        printf("Usage: %s -p <port> [-m thread|epoll] [-w <workers>]\n", argv[0]);
         exit(1);
     }
-    port = atoi(argv[2]);
+    port = atoi(port_arg);
     if (port <= 0) {
         printf("Error: Invalid port\n");
         exit(1);
     }
 
+    // Allow as many connections as the hard limit of open files
+    struct rlimit limit;
+    if (getrlimit(RLIMIT_NOFILE, &limit) == 0 && limit.rlim_cur < limit.rlim_max) {
+        limit.rlim_cur = limit.rlim_max;
+        setrlimit(RLIMIT_NOFILE, &limit);
+    }
+
+    // Versions sent to clients are only valid for this run of the server.
+    // The clock in nanoseconds and the process id tell apart runs started
+    // in the same second.
+    struct timespec now;
+    clock_gettime(CLOCK_REALTIME, &now);
+    server_epoch = ((unsigned long)now.tv_sec * 1000000000UL + now.tv_nsec) ^
+                   ((unsigned long)getpid() << 40);
+    start_time = metrics_now();
+
     // Initialize users array
     max_users = MAX_USERS;
     users = (User *)calloc(max_users, sizeof(User));
-    if (!users) {
+    if (!users || index_init(&users_index, 2 * MAX_USERS) < 0 ||
+        index_init(&terms_index, 1024) < 0) {
         perror("Error allocating memory for users");
         exit(1);
     }
@@ -90,7 +352,7 @@ int main(int argc, char *argv[]) {
     }
 
     // Allow port reuse
-    int opt = 1;
+    opt = 1;
     if (setsockopt(server_socket, SOL_SOCKET, SO_REUSEADDR, &opt, sizeof(opt)) < 0) {
         perror("Error in setsockopt");
         exit(1);
@@ -109,7 +371,7 @@ int main(int argc, char *argv[]) {
     }
 
     // Listen for connections
-    if (listen(server_socket, 10) < 0) {
+    if (listen(server_socket, SOMAXCONN) < 0) {
         perror("Error in listen");
         exit(1);
     }
@@ -124,6 +386,11 @@ int main(int argc, char *argv[]) {
     printf("s > init server %s:%d\n", local_ip, port);
     printf("s > \n");
 
+    // Event loop with a pool of workers, or a thread per connection
+    if (use_epoll) {
+        run_event_loop(workers);
+    }
+
     // Main server loop
     while (1) {
         // Accept client connection
@@ -155,83 +422,275 @@ int main(int argc, char *argv[]) {
     return 0;
 }
 
-// Function to handle SIGINT signal (Ctrl+C)
-void handle_sigint(int sig) {
+// Thread that waits for SIGINT (Ctrl+C) and stops the server
+void *handle_sigint(void *arg) {
+    sigset_t sigint_set;
+    int sig;
+    sigemptyset(&sigint_set);
+    sigaddset(&sigint_set, SIGINT);
+    while (sigwait(&sigint_set, &sig) != 0) {
+    }
+    
     printf("\nClosing server...\n");
     
-    // Free resources for each user
+    // Ship the queued log records
+    log_shutdown(2);
+    
+    // Free resources for each user. The lock is kept until exit, so no
+    // request uses them meanwhile.
+    pthread_rwlock_wrlock(&users_lock);
     for (int i = 0; i < num_users; i++) {
         free_user_resources(i);
     }
     
     close(server_socket);
     free(users);
+    index_free(&users_index);
+    for (int i = 0; i < num_terms; i++) {
+        free(terms[i].token);
+        free(terms[i].slots);
+    }
+    free(terms);
+    index_free(&terms_index);
     exit(0);
 }
 
 // Function to free resources for a specific user
 void free_user_resources(int user_index) {
     if (users[user_index].files != NULL) {
+        for (int i = 0; i < users[user_index].num_files; i++) {
+            free(users[user_index].files[i].filename);
+        }
         free(users[user_index].files);
         users[user_index].files = NULL;
+        users[user_index].num_files = 0;
     }
+    index_free(&users[user_index].files_index);
+    free(users[user_index].username);
+    users[user_index].username = NULL;
 }
 
-// Function to search for a user by name
-int find_user(char *username) {
+// Hash function for index keys (FNV-1a)
+unsigned int hash_string(const char *key) {
+    unsigned int hash = 2166136261u;
+    while (*key) {
+        hash ^= (unsigned char)*key++;
+        hash *= 16777619u;
+    }
+    return hash;
+}
 
-    for (int i = 0; i < num_users; i++) {
-        if (strcmp(users[i].username, username) == 0) {
-            return i;
+// Function to initialize an index. The capacity is rounded up to a power
+// of two so slots can be picked with a mask.
+int index_init(Index *index, int capacity) {
+    int rounded = 8;
+    while (rounded < capacity) {
+        rounded *= 2;
+    }
+    capacity = rounded;
+    
+    index->slots = malloc(capacity * sizeof(int));
+    if (!index->slots) {
+        return -1;
+    }
+    for (int i = 0; i < capacity; i++) {
+        index->slots[i] = INDEX_EMPTY;
+    }
+    index->capacity = capacity;
+    index->count = 0;
+    index->deleted = 0;
+    return 0;
+}
+
+// Function to free the slots of an index
+void index_free(Index *index) {
+    free(index->slots);
+    index->slots = NULL;
+    index->capacity = 0;
+    index->count = 0;
+    index->deleted = 0;
+}
+
+// Function to get the slot holding a key, -1 if the key is not indexed
+int index_slot(Index *index, const char *key, index_key_fn key_of, void *ctx) {
+    unsigned int mask = index->capacity - 1;
+    unsigned int slot = hash_string(key) & mask;
+    
+    while (index->slots[slot] != INDEX_EMPTY) {
+        int position = index->slots[slot];
+        if (position != INDEX_DELETED && strcmp(key_of(ctx, position), key) == 0) {
+            return slot;
         }
+        slot = (slot + 1) & mask;
     }
     
     return -1;
 }
 
-// Function to add a new user
-void add_user(char *username) {
+// Function to get the position of a key, -1 if the key is not indexed
+int index_find(Index *index, const char *key, index_key_fn key_of, void *ctx) {
+    int slot = index_slot(index, key, key_of, ctx);
+    return slot == -1 ? -1 : index->slots[slot];
+}
+
+// Function to rebuild an index with a new capacity
+int index_resize(Index *index, int capacity, index_key_fn key_of, void *ctx) {
+    Index resized;
+    if (index_init(&resized, capacity) < 0) {
+        return -1;
+    }
+    
+    unsigned int mask = capacity - 1;
+    for (int i = 0; i < index->capacity; i++) {
+        int position = index->slots[i];
+        if (position < 0) {
+            continue;
+        }
+        unsigned int slot = hash_string(key_of(ctx, position)) & mask;
+        while (resized.slots[slot] != INDEX_EMPTY) {
+            slot = (slot + 1) & mask;
+        }
+        resized.slots[slot] = position;
+        resized.count++;
+    }
+    
+    free(index->slots);
+    *index = resized;
+    return 0;
+}
+
+// Function to add a key stored at position. The index is kept at most half
+// full (counting deleted slots) so probe sequences stay short.
+int index_insert(Index *index, const char *key, int position, index_key_fn key_of, void *ctx) {
+    if (2 * (index->count + index->deleted + 1) > index->capacity) {
+        int capacity = index->capacity;
+        if (2 * (index->count + 1) > capacity / 2) {
+            capacity *= 2;  // Grow, otherwise only clean deleted slots
+        }
+        if (index_resize(index, capacity, key_of, ctx) < 0) {
+            return -1;
+        }
+    }
+    
+    unsigned int mask = index->capacity - 1;
+    unsigned int slot = hash_string(key) & mask;
+    while (index->slots[slot] >= 0) {
+        slot = (slot + 1) & mask;
+    }
+    if (index->slots[slot] == INDEX_DELETED) {
+        index->deleted--;
+    }
+    index->slots[slot] = position;
+    index->count++;
+    return 0;
+}
+
+// Function to remove a key
+void index_remove(Index *index, const char *key, index_key_fn key_of, void *ctx) {
+    int slot = index_slot(index, key, key_of, ctx);
+    if (slot != -1) {
+        index->slots[slot] = INDEX_DELETED;
+        index->count--;
+        index->deleted++;
+    }
+}
+
+// Function to update the position of a key after its entry was moved
+void index_move(Index *index, const char *key, int position, index_key_fn key_of, void *ctx) {
+    int slot = index_slot(index, key, key_of, ctx);
+    if (slot != -1) {
+        index->slots[slot] = position;
+    }
+}
+
+// Function to get the username of the user at a position (index key)
+const char *user_key(void *ctx, int position) {
+    return users[position].username;
+}
+
+// Function to search for a user by name
+int find_user(char *username) {
+    return index_find(&users_index, username, user_key, NULL);
+}
+
+// Function to add a new user. Returns 0 on success, -1 if memory could
+// not be allocated (the user is not added).
+int add_user(char *username) {
     
     // Check if we need to resize the array
     if (num_users >= max_users) {
-        max_users *= 2;
-        User *temp = realloc(users, max_users * sizeof(User));
+        User *temp = realloc(users, 2 * max_users * sizeof(User));
         if (!temp) {
             perror("Error resizing users array");
-            
-            return;
+            return -1;
         }
         users = temp;
+        max_users *= 2;
     }
 
     // Initialize new user
-    strncpy(users[num_users].username, username, MAX_STRING - 1);
-    users[num_users].username[MAX_STRING - 1] = '\0';
+    users[num_users].username = strndup(username, MAX_STRING - 1);
+    if (!users[num_users].username) {
+        perror("Error allocating username");
+        return -1;
+    }
     users[num_users].connected = 0;
     users[num_users].num_files = 0;
+    users[num_users].num_deleted = 0;
+    users[num_users].last_seq = 0;
+    users[num_users].version = 0;
     
     // Initialize dynamic files array
     users[num_users].max_files = INITIAL_FILES;
     users[num_users].files = (File *)calloc(users[num_users].max_files, sizeof(File));
     if (!users[num_users].files) {
         perror("Error allocating memory for files");
-        return;
+        free(users[num_users].username);
+        return -1;
+    }
+    if (index_init(&users[num_users].files_index, 2 * INITIAL_FILES) < 0) {
+        perror("Error allocating memory for files index");
+        free(users[num_users].files);
+        users[num_users].files = NULL;
+        free(users[num_users].username);
+        return -1;
+    }
+    
+    // Index the user by name. Positions do not change when the array is
+    // reallocated, so the index stays valid after a resize.
+    if (index_insert(&users_index, users[num_users].username, num_users, user_key, NULL) < 0) {
+        perror("Error resizing users index");
+        free_user_resources(num_users);
+        return -1;
     }
     
     num_users++;
+    return 0;
 }
 
 // Function to remove a user
 void remove_user(char *username) {
     int index = find_user(username);
     
-    // Free memory from files array
-    free_user_resources(index);
-    
     if (index != -1) {
+        // Connected users disappear from the list
+        if (users[index].connected) {
+            record_change(index);
+        }
+        
+        // Remove the files from the search index, then free the user
+        for (int i = 0; i < users[index].num_files; i++) {
+            if (users[index].files[i].filename) {
+                search_remove_file(&users[index].files[i]);
+            }
+        }
+        index_remove(&users_index, username, user_key, NULL);
+        free_user_resources(index);
+        
         // Move last user to deleted position
         if (index < num_users - 1) {
             users[index] = users[num_users - 1];
+            index_move(&users_index, users[index].username, index, user_key, NULL);
         }
         num_users--;
     }
@@ -243,130 +702,1288 @@ void connect_user(int user_index, char *ip, int port) {
     strncpy(users[user_index].ip, ip, MAX_STRING - 1);
     users[user_index].ip[MAX_STRING - 1] = '\0';
     users[user_index].port = port;
+    record_change(user_index);
 }
 
 
 // Function to disconnect a user
 void disconnect_user(int user_index) {
     users[user_index].connected = 0;
+    record_change(user_index);
+}
+
+// Function to record a change of the connected users in the journal
+void record_change(int user_index) {
+    unsigned long seq = ++change_seq;
+    Change *change = &journal[seq % JOURNAL_SIZE];
+    
+    free(change->username);
+    change->seq = seq;
+    change->username = strdup(users[user_index].username);  // NULL forces full lists
+    users[user_index].version = seq;
+}
+
+// Function to add the username, IP and port of a user to a reply
+void add_user_entry(Reply *reply, int user_index) {
+    reply_add_string(reply, users[user_index].username);
+    reply_add_string(reply, users[user_index].ip);
+    reply_add_int(reply, users[user_index].port);
+}
+
+// Function to get the username of the journal change at a position (index key)
+const char *change_key(void *ctx, int position) {
+    return journal[position].username;
+}
+
+// Function to add the changes of the connected users since a version to a
+// reply: the current version, "DELTA" or "FULL", the number of entries and
+// the entries, "+" username ip port for connected users and "-" username
+// for users no longer connected. The full list is sent when the version is
+// from another run of the server or older than the journal.
+void add_users_delta(Reply *reply, const char *since) {
+    char buffer[MAX_STRING];
+    unsigned long epoch = 0, seq = 0;
+    Reply entries = {.binary = reply->binary};
+    int count = 0;
+    
+    int full = sscanf(since, "%lu.%lu", &epoch, &seq) != 2 || epoch != server_epoch ||
+               seq > change_seq || change_seq - seq > JOURNAL_SIZE;
+    for (unsigned long s = seq + 1; !full && s <= change_seq; s++) {
+        if (journal[s % JOURNAL_SIZE].username == NULL) {
+            full = 1;
+        }
+    }
+    
+    if (full) {
+        for (int i = 0; i < num_users; i++) {
+            if (users[i].connected) {
+                reply_add_string(&entries, "+");
+                add_user_entry(&entries, i);
+                count++;
+            }
+        }
+    } else {
+        // Usernames already sent as "-" for changes that are not the last
+        // change of a registered user
+        Index removed = {0};
+        
+        for (unsigned long s = seq + 1; s <= change_seq; s++) {
+            Change *change = &journal[s % JOURNAL_SIZE];
+            int user_index = find_user(change->username);
+            
+            // Only the last change of a user is sent
+            if (user_index != -1 && users[user_index].version > s) {
+                continue;
+            }
+            if (user_index != -1 && users[user_index].version == s) {
+                if (users[user_index].connected) {
+                    reply_add_string(&entries, "+");
+                    add_user_entry(&entries, user_index);
+                } else {
+                    reply_add_string(&entries, "-");
+                    reply_add_string(&entries, change->username);
+                }
+                count++;
+                continue;
+            }
+            
+            // The user was unregistered, or registered again and not
+            // connected since: it is gone from the list, and every change
+            // about it would say so again
+            if (removed.slots == NULL && index_init(&removed, 64) < 0) {
+                entries.failed = 1;
+                break;
+            }
+            if (index_find(&removed, change->username, change_key, NULL) != -1) {
+                continue;
+            }
+            if (index_insert(&removed, change->username, s % JOURNAL_SIZE, change_key, NULL) < 0) {
+                entries.failed = 1;
+                break;
+            }
+            reply_add_string(&entries, "-");
+            reply_add_string(&entries, change->username);
+            count++;
+        }
+        index_free(&removed);
+    }
+    
+    sprintf(buffer, "%lu.%lu", server_epoch, change_seq);
+    reply_add_string(reply, buffer);
+    reply_add_string(reply, full ? "FULL" : "DELTA");
+    reply_add_int(reply, count);
+    if (entries.failed) {
+        reply->failed = 1;
+    } else {
+        reply_append(reply, entries.data, entries.len);
+    }
+    reply_free(&entries);
+}
+
+// Function to get the filename of the file at a position of a user (index key)
+const char *file_key(void *ctx, int position) {
+    return ((User *)ctx)->files[position].filename;
 }
 
 // Function to add a file
 int add_file(int user_index, char *filename, char *description) {
-    
-    int result = 0;
+    User *user = &users[user_index];
     
     // Check if file already exists
-    for (int i = 0; i < users[user_index].num_files; i++) {
-        if (strcmp(users[user_index].files[i].filename, filename) == 0) {
-            result = -1;
+    if (index_find(&user->files_index, filename, file_key, user) != -1) {
+        return -1;
+    }
+    
+    // Check if we need to resize files array
+    if (user->num_files >= user->max_files) {
+        File *temp = realloc(user->files, 2 * user->max_files * sizeof(File));
+        if (!temp) {
+            perror("Error resizing files array");
+            return -2;  // Error resizing
+        }
+        user->files = temp;
+        user->max_files *= 2;
+    }
+    
+    // Store filename and description in one allocation of their exact size
+    size_t filename_len = strnlen(filename, MAX_STRING - 1);
+    size_t description_len = strnlen(description, MAX_STRING - 1);
+    char *data = malloc(filename_len + description_len + 2);
+    if (!data) {
+        perror("Error allocating file");
+        return -2;
+    }
+    memcpy(data, filename, filename_len);
+    data[filename_len] = '\0';
+    memcpy(data + filename_len + 1, description, description_len);
+    data[filename_len + 1 + description_len] = '\0';
+    
+    // Add file
+    File *file = &user->files[user->num_files];
+    file->filename = data;
+    file->description = data + filename_len + 1;
+    file->seq = user->last_seq + 1;
+    if (index_insert(&user->files_index, file->filename, user->num_files, file_key, user) < 0) {
+        perror("Error resizing files index");
+        free(data);
+        return -2;
+    }
+    if (search_add_file(user->username, file) < 0) {
+        perror("Error indexing file for search");
+        search_remove_file(file);
+        index_remove(&user->files_index, file->filename, file_key, user);
+        free(data);
+        return -2;
+    }
+    
+    user->num_files++;
+    user->last_seq++;
+    
+    return 0;
+}
+
+// Function to remove a file
+int remove_file(int user_index, char *filename) {
+    User *user = &users[user_index];
+    
+    // Search for file
+    int i = index_find(&user->files_index, filename, file_key, user);
+    if (i == -1) {
+        return -1;
+    }
+    
+    index_remove(&user->files_index, filename, file_key, user);
+    search_remove_file(&user->files[i]);
+    free(user->files[i].filename);
+    
+    // The file keeps its place, so the files stay in publish order for the
+    // cursors of LIST_CONTENT_PAGE. Once half of the array is deleted
+    // files it is compacted.
+    user->files[i].filename = NULL;
+    user->files[i].description = NULL;
+    user->num_deleted++;
+    if (2 * user->num_deleted > user->num_files) {
+        compact_files(user);
+    }
+    
+    return 0;
+}
+
+// Function to drop the deleted files of a user, keeping the order of the
+// others. Files only move down and in order, so while a file is moved the
+// index entries of the files already moved point below it and those of the
+// files not moved yet above it: the lookup by name cannot match another.
+void compact_files(User *user) {
+    int kept = 0;
+    for (int i = 0; i < user->num_files; i++) {
+        if (!user->files[i].filename) {
+            continue;
+        }
+        if (kept < i) {
+            user->files[kept] = user->files[i];
+            index_move(&user->files_index, user->files[kept].filename, kept, file_key, user);
+        }
+        kept++;
+    }
+    user->num_files = kept;
+    user->num_deleted = 0;
+}
+
+// Function to read the next word of a text, lowercased into token (at most
+// MAX_TOKEN - 1 bytes). Words are runs of letters and digits; shorter than
+// MIN_TOKEN ones are skipped. Returns 0 at the end of the text.
+int next_token(const char **text, char *token) {
+    const unsigned char *c = (const unsigned char *)*text;
+    
+    while (*c) {
+        while (*c && !isalnum(*c)) {
+            c++;
+        }
+        int len = 0;
+        int total = 0;
+        while (*c && isalnum(*c)) {
+            if (len < MAX_TOKEN - 1) {
+                token[len++] = tolower(*c);
+            }
+            total++;
+            c++;
+        }
+        if (total >= MIN_TOKEN) {
+            token[len] = '\0';
+            *text = (const char *)c;
+            return 1;
+        }
+    }
+    *text = (const char *)c;
+    return 0;
+}
+
+// Function to check if a text contains a word
+int text_has_token(const char *text, const char *token) {
+    char word[MAX_TOKEN];
+    while (next_token(&text, word)) {
+        if (strcmp(word, token) == 0) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+// Function to get the word of the term at a position (index key)
+const char *term_key(void *ctx, int position) {
+    return terms[position].token;
+}
+
+// Function to hash a filename pointer, the key of a posting
+unsigned int posting_hash(const char *filename) {
+    uint64_t h = (uint64_t)(uintptr_t)filename * 0x9E3779B97F4A7C15ULL;
+    return (unsigned int)(h >> 32);
+}
+
+// Marker of a removed posting
+static const char posting_deleted[] = "";
+
+// Function to get the slot of a posting, -1 if the file is not in the term
+int posting_slot(Term *term, const char *filename) {
+    unsigned int mask = term->capacity - 1;
+    unsigned int slot = posting_hash(filename) & mask;
+    
+    while (term->slots[slot].filename != NULL) {
+        if (term->slots[slot].filename == filename) {
+            return slot;
+        }
+        slot = (slot + 1) & mask;
+    }
+    return -1;
+}
+
+// Function to rebuild the postings of a term with a new capacity
+int posting_resize(Term *term, int capacity) {
+    Posting *slots = calloc(capacity, sizeof(Posting));
+    if (!slots) {
+        return -1;
+    }
+    
+    unsigned int mask = capacity - 1;
+    for (int i = 0; i < term->capacity; i++) {
+        Posting *posting = &term->slots[i];
+        if (posting->filename == NULL || posting->filename == posting_deleted) {
+            continue;
+        }
+        unsigned int slot = posting_hash(posting->filename) & mask;
+        while (slots[slot].filename != NULL) {
+            slot = (slot + 1) & mask;
+        }
+        slots[slot] = *posting;
+    }
+    
+    free(term->slots);
+    term->slots = slots;
+    term->capacity = capacity;
+    term->deleted = 0;
+    return 0;
+}
+
+// Function to add a file to the postings of a term, kept at most half full
+int posting_insert(Term *term, const char *owner, const char *filename) {
+    if (posting_slot(term, filename) != -1) {
+        return 0;   // The word appears more than once in the file
+    }
+    if (2 * (term->count + term->deleted + 1) > term->capacity) {
+        int capacity = term->capacity;
+        if (2 * (term->count + 1) > capacity / 2) {
+            capacity *= 2;  // Grow, otherwise only clean deleted slots
+        }
+        if (posting_resize(term, capacity) < 0) {
+            return -1;
+        }
+    }
+    
+    unsigned int mask = term->capacity - 1;
+    unsigned int slot = posting_hash(filename) & mask;
+    while (term->slots[slot].filename != NULL && term->slots[slot].filename != posting_deleted) {
+        slot = (slot + 1) & mask;
+    }
+    if (term->slots[slot].filename == posting_deleted) {
+        term->deleted--;
+    }
+    term->slots[slot].owner = owner;
+    term->slots[slot].filename = filename;
+    term->count++;
+    return 0;
+}
+
+// Function to get the term of a word, created if needed (NULL on error)
+Term *get_term(const char *token, int create) {
+    int position = index_find(&terms_index, token, term_key, NULL);
+    if (position != -1) {
+        return &terms[position];
+    }
+    if (!create) {
+        return NULL;
+    }
+    
+    if (num_terms >= max_terms) {
+        int capacity = max_terms ? 2 * max_terms : 1024;
+        Term *temp = realloc(terms, capacity * sizeof(Term));
+        if (!temp) {
+            return NULL;
+        }
+        terms = temp;
+        max_terms = capacity;
+    }
+    
+    Term *term = &terms[num_terms];
+    term->token = strdup(token);
+    term->capacity = 2;     // Most words are in a single file
+    term->slots = calloc(term->capacity, sizeof(Posting));
+    term->count = 0;
+    term->deleted = 0;
+    if (!term->token || !term->slots ||
+        index_insert(&terms_index, term->token, num_terms, term_key, NULL) < 0) {
+        free(term->token);
+        free(term->slots);
+        return NULL;
+    }
+    num_terms++;
+    return term;
+}
+
+// Function to remove a term without postings
+void remove_term(Term *term) {
+    int position = term - terms;
+    
+    index_remove(&terms_index, term->token, term_key, NULL);
+    free(term->token);
+    free(term->slots);
+    
+    // Move last term to deleted position
+    if (position < num_terms - 1) {
+        terms[position] = terms[num_terms - 1];
+        index_move(&terms_index, terms[position].token, position, term_key, NULL);
+    }
+    num_terms--;
+}
+
+// Function to add the words of a file's name and description to the
+// search index
+int search_add_file(const char *owner, File *file) {
+    const char *fields[2] = {file->filename, file->description};
+    char token[MAX_TOKEN];
+    
+    for (int f = 0; f < 2; f++) {
+        const char *text = fields[f];
+        while (next_token(&text, token)) {
+            Term *term = get_term(token, 1);
+            if (!term || posting_insert(term, owner, file->filename) < 0) {
+                return -1;
+            }
+        }
+    }
+    return 0;
+}
+
+// Function to remove a file from the search index
+void search_remove_file(File *file) {
+    const char *fields[2] = {file->filename, file->description};
+    char token[MAX_TOKEN];
+    
+    for (int f = 0; f < 2; f++) {
+        const char *text = fields[f];
+        while (next_token(&text, token)) {
+            Term *term = get_term(token, 0);
+            if (!term) {
+                continue;
+            }
+            int slot = posting_slot(term, file->filename);
+            if (slot == -1) {
+                continue;
+            }
+            term->slots[slot].filename = posting_deleted;
+            term->count--;
+            term->deleted++;
+            if (term->count == 0) {
+                remove_term(term);
+            }
+        }
+    }
+}
+
+// Function to order search results: best score first, then by owner and
+// filename so that pages of the same query do not overlap
+int compare_matches(const void *a, const void *b) {
+    const Match *x = a;
+    const Match *y = b;
+    if (x->score != y->score) {
+        return y->score - x->score;
+    }
+    int c = strcmp(x->owner, y->owner);
+    return c != 0 ? c : strcmp(x->filename, y->filename);
+}
+
+// Function to find the files that contain every word of a query. Words in
+// the filename score 2 and words only in the description score 1. Returns
+// the number of matches, stored sorted in *matches (to be freed), or -1 on
+// error.
+int search_files(const char *query, Match **matches) {
+    Term *query_terms[MAX_QUERY_TOKENS];
+    char token[MAX_TOKEN];
+    int num_query_terms = 0;
+    
+    *matches = NULL;
+    while (num_query_terms < MAX_QUERY_TOKENS && next_token(&query, token)) {
+        Term *term = get_term(token, 0);
+        if (!term) {
+            return 0;   // No file contains this word
+        }
+        int repeated = 0;
+        for (int i = 0; i < num_query_terms; i++) {
+            repeated |= query_terms[i] == term;
+        }
+        if (!repeated) {
+            query_terms[num_query_terms++] = term;
+        }
+    }
+    if (num_query_terms == 0) {
+        return 0;
+    }
+    
+    // Walk the rarest word and check the others
+    Term *rarest = query_terms[0];
+    for (int i = 1; i < num_query_terms; i++) {
+        if (query_terms[i]->count < rarest->count) {
+            rarest = query_terms[i];
+        }
+    }
+    *matches = malloc(rarest->count * sizeof(Match));
+    if (!*matches) {
+        return -1;
+    }
+    
+    int count = 0;
+    for (int s = 0; s < rarest->capacity; s++) {
+        Posting *posting = &rarest->slots[s];
+        if (posting->filename == NULL || posting->filename == posting_deleted) {
+            continue;
+        }
+        int score = 0;
+        for (int i = 0; i < num_query_terms && score >= 0; i++) {
+            if (query_terms[i] != rarest && posting_slot(query_terms[i], posting->filename) == -1) {
+                score = -1;
+            } else {
+                score += text_has_token(posting->filename, query_terms[i]->token) ? 2 : 1;
+            }
+        }
+        if (score > 0) {
+            (*matches)[count].owner = posting->owner;
+            (*matches)[count].filename = posting->filename;
+            (*matches)[count].score = score;
+            count++;
+        }
+    }
+    
+    qsort(*matches, count, sizeof(Match), compare_matches);
+    return count;
+}
+
+// Function to read from the socket of a connection. Connections of the
+// epoll front end have their whole request buffered, so reading means the
+// request is malformed.
+ssize_t read_socket(Connection *conn, char *buffer, size_t len) {
+    if (conn->evented) {
+        return -1;
+    }
+    return read(conn->sock, buffer, len);
+}
+
+// Function to make at least need bytes (up to the buffer size) available in
+// the connection buffer, moving the unread ones to its start
+int fill_input(Connection *conn, size_t need) {
+    if (conn->in_pos > 0 && conn->in_len - conn->in_pos < need) {
+        memmove(conn->in, conn->in + conn->in_pos, conn->in_len - conn->in_pos);
+        conn->in_len -= conn->in_pos;
+        conn->in_pos = 0;
+    }
+    while (conn->in_len - conn->in_pos < need) {
+        ssize_t n = read_socket(conn, conn->in + conn->in_len, conn->in_cap - conn->in_len);
+        if (n <= 0) {
+            return -1; // Read error
+        }
+        conn->in_len += n;
+    }
+    return 0;
+}
+
+// Function to decode a 32-bit big-endian integer
+uint32_t get_uint32(const char *data) {
+    const unsigned char *p = (const unsigned char *)data;
+    return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16) | ((uint32_t)p[2] << 8) | p[3];
+}
+
+// Function to encode a 32-bit big-endian integer
+void put_uint32(char *data, uint32_t value) {
+    unsigned char *p = (unsigned char *)data;
+    p[0] = value >> 24;
+    p[1] = value >> 16;
+    p[2] = value >> 8;
+    p[3] = value;
+}
+
+// Function to read a whole v2 request frame: its length, the request id
+// and the fields, which are then taken from the frame by read_string and
+// read_int. Returns -1 on error or if the frame is too large.
+int read_frame(Connection *conn) {
+    if (fill_input(conn, 4) < 0) {
+        return -1;
+    }
+    uint32_t len = get_uint32(conn->in + conn->in_pos);
+    conn->in_pos += 4;
+    if (len < 4 || len > MAX_FRAME) {
+        return -1;
+    }
+    
+    if (len > conn->frame_cap) {
+        char *frame = realloc(conn->frame, len);
+        if (!frame) {
+            return -1;
+        }
+        conn->frame = frame;
+        conn->frame_cap = len;
+    }
+    
+    // Take the buffered bytes, then read the rest of the frame directly
+    size_t got = conn->in_len - conn->in_pos;
+    if (got > len) {
+        got = len;
+    }
+    memcpy(conn->frame, conn->in + conn->in_pos, got);
+    conn->in_pos += got;
+    while (got < len) {
+        ssize_t n = read_socket(conn, conn->frame + got, len - got);
+        if (n <= 0) {
+            return -1; // Read error
+        }
+        got += n;
+    }
+    
+    conn->frame_id = get_uint32(conn->frame);
+    conn->frame_len = len;
+    conn->frame_pos = 4;
+    return 0;
+}
+
+// Function to read a string from a connection. Bytes are pulled from the
+// socket in chunks and kept in the connection buffer for the next fields.
+// With the v2 framing the string is the next field of the current frame,
+// a 32-bit length followed by the bytes.
+int read_string(Connection *conn, char *buffer, int max_length) {
+    memset(buffer, 0, max_length);
+    int total_read = 0;
+    
+    if (conn->binary) {
+        if (conn->frame_len - conn->frame_pos < 4) {
+            return -1; // No more fields
+        }
+        uint32_t len = get_uint32(conn->frame + conn->frame_pos);
+        conn->frame_pos += 4;
+        if (len > conn->frame_len - conn->frame_pos) {
+            return -1; // Truncated field
+        }
+        
+        // Bytes beyond the maximum length are discarded
+        total_read = len < (uint32_t)max_length - 1 ? (int)len : max_length - 1;
+        memcpy(buffer, conn->frame + conn->frame_pos, total_read);
+        conn->frame_pos += len;
+        return total_read;
+    }
+    
+    while (1) {
+        if (conn->in_pos >= conn->in_len) {
+            ssize_t n = read_socket(conn, conn->in, conn->in_cap);
+            if (n <= 0) {
+                return -1; // Read error
+            }
+            conn->in_len = n;
+            conn->in_pos = 0;
+        }
+        
+        char c = conn->in[conn->in_pos++];
+        if (c == '\0') {
             break;
         }
-    }
-    
-    // Check if we need to resize files array
-    if (users[user_index].num_files >= users[user_index].max_files) {
-        users[user_index].max_files *= 2;
-        File *temp = realloc(users[user_index].files, users[user_index].max_files * sizeof(File));
-        if (!temp) {
-            perror("Error resizing files array");
-            return -2;  // Error resizing
+        
+        // Characters beyond the maximum length are discarded
+        if (total_read < max_length - 1) {
+            buffer[total_read++] = c;
+        }
+    }
+    
+    buffer[total_read] = '\0';
+    return total_read;
+}
+
+// Function to read an integer from a connection: a decimal string, or a
+// 32-bit big-endian field with the v2 framing
+int read_int(Connection *conn, int *value) {
+    if (conn->binary) {
+        if (conn->frame_len - conn->frame_pos < 4) {
+            return -1; // No more fields
+        }
+        *value = (int32_t)get_uint32(conn->frame + conn->frame_pos);
+        conn->frame_pos += 4;
+        return 0;
+    }
+    
+    char buffer[MAX_STRING];
+    if (read_string(conn, buffer, MAX_STRING) <= 0) {
+        return -1;
+    }
+    *value = atoi(buffer);
+    return 0;
+}
+
+// Function to append bytes to a reply payload
+void reply_append(Reply *reply, const char *data, size_t len) {
+    if (reply->failed) {
+        return;
+    }
+    if (reply->len + len > reply->cap) {
+        size_t cap = reply->cap ? reply->cap : IO_BUFFER;
+        while (cap < reply->len + len) {
+            cap *= 2;
+        }
+        char *data_new = realloc(reply->data, cap);
+        if (!data_new) {
+            reply->failed = 1;
+            return;
+        }
+        reply->data = data_new;
+        reply->cap = cap;
+    }
+    memcpy(reply->data + reply->len, data, len);
+    reply->len += len;
+}
+
+// Function to append a string field, with its terminating '\0' or, with
+// the v2 framing, preceded by its length
+void reply_add_string(Reply *reply, const char *str) {
+    size_t len = strlen(str);
+    
+    if (reply->binary) {
+        char prefix[4];
+        put_uint32(prefix, len);
+        reply_append(reply, prefix, 4);
+        reply_append(reply, str, len);
+        return;
+    }
+    reply_append(reply, str, len + 1);
+}
+
+// Function to append an integer field: a decimal string, or a 32-bit
+// big-endian field with the v2 framing
+void reply_add_int(Reply *reply, int value) {
+    char buffer[16];
+    
+    if (reply->binary) {
+        put_uint32(buffer, (uint32_t)value);
+        reply_append(reply, buffer, 4);
+        return;
+    }
+    sprintf(buffer, "%d", value);
+    reply_append(reply, buffer, strlen(buffer) + 1);
+}
+
+// Function to free a reply payload
+void reply_free(Reply *reply) {
+    free(reply->data);
+    reply->data = NULL;
+    reply->len = reply->cap = 0;
+}
+
+// Function to send the response code of a request followed by an optional
+// payload, with a single system call where possible. In session mode the
+// code is preceded by the id of the request it answers; with the v2
+// framing by the length of the frame and the request id.
+void send_reply(Connection *conn, unsigned char response, Reply *payload) {
+    char header[MAX_STRING + 1];
+    size_t len = 0;
+    size_t payload_len = payload ? payload->len : 0;
+    
+    if (conn->binary) {
+        put_uint32(header, 4 + 1 + payload_len);
+        put_uint32(header + 4, conn->frame_id);
+        len = 8;
+    } else if (conn->session) {
+        len = strlen(conn->request_id) + 1;
+        memcpy(header, conn->request_id, len);
+    }
+    header[len++] = response;
+    conn->response = response;
+    
+    struct iovec iov[2];
+    int iovcnt = 1;
+    iov[0].iov_base = header;
+    iov[0].iov_len = len;
+    if (payload_len > 0) {
+        iov[1].iov_base = payload->data;
+        iov[1].iov_len = payload_len;
+        iovcnt = 2;
+    }
+    
+    // The epoll front end never waits for a peer that does not read
+    if (conn->evented) {
+        send_evented(conn, iov, iovcnt);
+        return;
+    }
+    
+    // Resume after partial writes until everything has been sent
+    struct iovec *next = iov;
+    while (iovcnt > 0) {
+        ssize_t n = writev(conn->sock, next, iovcnt);
+        if (n < 0) {
+            return;
+        }
+        while (iovcnt > 0 && (size_t)n >= next->iov_len) {
+            n -= next->iov_len;
+            next++;
+            iovcnt--;
+        }
+        if (iovcnt > 0) {
+            next->iov_base = (char *)next->iov_base + n;
+            next->iov_len -= n;
+        }
+    }
+}
+
+// Function to send a reply of the epoll front end without blocking. What
+// the socket does not take is kept in the output buffer of the connection,
+// and the worker stops serving it until the event loop has written it.
+void send_evented(Connection *conn, struct iovec *iov, int iovcnt) {
+    size_t sent = 0;
+    
+    if (conn->out_len == 0) {
+        struct msghdr msg = {0};
+        msg.msg_iov = iov;
+        msg.msg_iovlen = iovcnt;
+        ssize_t n;
+        do {
+            n = sendmsg(conn->sock, &msg, MSG_DONTWAIT);
+        } while (n < 0 && errno == EINTR);
+        if (n < 0 && errno != EAGAIN && errno != EWOULDBLOCK) {
+            conn->failed = 1;
+            return;
+        }
+        sent = n > 0 ? n : 0;
+    }
+    
+    for (int i = 0; i < iovcnt; i++) {
+        if (sent >= iov[i].iov_len) {
+            sent -= iov[i].iov_len;
+            continue;
+        }
+        size_t len = iov[i].iov_len - sent;
+        if (conn->out_len + len > conn->out_cap) {
+            size_t cap = conn->out_cap ? conn->out_cap : IO_BUFFER;
+            while (cap < conn->out_len + len) {
+                cap *= 2;
+            }
+            char *out = realloc(conn->out, cap);
+            if (!out) {
+                conn->failed = 1;
+                return;
+            }
+            conn->out = out;
+            conn->out_cap = cap;
+        }
+        memcpy(conn->out + conn->out_len, (char *)iov[i].iov_base + sent, len);
+        conn->out_len += len;
+        sent = 0;
+    }
+}
+
+// Function to write the output buffer of a connection. Returns 1 once it
+// is empty, 0 if the socket is full again and -1 on error.
+int flush_output(Connection *conn) {
+    while (conn->out_pos < conn->out_len) {
+        ssize_t n = send(conn->sock, conn->out + conn->out_pos,
+                         conn->out_len - conn->out_pos, MSG_DONTWAIT);
+        if (n > 0) {
+            conn->out_pos += n;
+        } else if (n < 0 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+            return 0;
+        } else if (n < 0 && errno == EINTR) {
+            continue;
+        } else {
+            return -1;
+        }
+    }
+    
+    // Replies only wait here when a peer reads slowly; do not keep the memory
+    free(conn->out);
+    conn->out = NULL;
+    conn->out_len = conn->out_pos = conn->out_cap = 0;
+    return 1;
+}
+
+// Function to send the response code of a request
+void send_response(Connection *conn, unsigned char response) {
+    send_reply(conn, response, NULL);
+}
+
+// Main function to handle client connections. Operations are served until
+// the peer closes the connection, so a client may either send one request
+// per connection or open a session (SESSION operation) and send many
+// requests tagged with a request id. SESSION_V2 opens a session where
+// requests and replies are length-prefixed frames.
+void *handle_client(void *socket_desc) {
+    int sock = *(int*)socket_desc;
+    free(socket_desc);
+    
+    Connection *conn = connection_new(sock);
+    if (!conn) {
+        perror("Error allocating connection");
+        close(sock);
+        return NULL;
+    }
+    
+    gauge_add(&handlers_active, &handlers_peak, 1);
+    while (serve_request(conn) == 0) {
+    }
+    gauge_add(&handlers_active, &handlers_peak, -1);
+    
+    // Close socket
+    connection_free(conn);
+    return NULL;
+}
+
+// Function to allocate the state of a connection
+Connection *connection_new(int sock) {
+    Connection *conn = calloc(1, sizeof(Connection));
+    if (!conn) {
+        return NULL;
+    }
+    conn->in = malloc(IO_BUFFER);
+    if (!conn->in) {
+        free(conn);
+        return NULL;
+    }
+    conn->sock = sock;
+    conn->in_cap = IO_BUFFER;
+    __atomic_fetch_add(&connections_open, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&connections_total, 1, __ATOMIC_RELAXED);
+    return conn;
+}
+
+// Function to close a connection and free its state
+void connection_free(Connection *conn) {
+    __atomic_fetch_sub(&connections_open, 1, __ATOMIC_RELAXED);
+    close(conn->sock);
+    free(conn->out);
+    free(conn->frame);
+    free(conn->in);
+    free(conn);
+}
+
+// Function to read and process the next request of a connection. Returns
+// -1 if the connection must be closed.
+int serve_request(Connection *conn) {
+    char operation[MAX_STRING];
+    char datetime[MAX_STRING];
+    
+    // The request is consumed: the next one is scanned from its start
+    conn->scan_pos = conn->field_start = 0;
+    conn->scan_fields = conn->scan_needed = 0;
+    
+    // Read the whole frame (v2 framing) or the request id (session mode)
+    if (conn->binary) {
+        if (read_frame(conn) < 0) {
+            return -1;
+        }
+    } else if (conn->session && read_string(conn, conn->request_id, MAX_STRING) <= 0) {
+        return -1;
+    }
+    
+    // Read requested operation
+    if (read_string(conn, operation, MAX_STRING) <= 0) {
+        // A closed connection after the first request is the normal end
+        if (!conn->served) {
+            printf("s > Error reading operation\n");
+        }
+        return -1;
+    }
+    
+    // Switch the connection to session mode
+    if (!conn->session && strcmp(operation, "SESSION") == 0) {
+        send_response(conn, 0);
+        conn->session = 1;
+        conn->served++;
+        return 0;
+    }
+    
+    // Switch the connection to session mode with the framing version
+    // sent as argument (2): every request is then a frame of
+    // length-prefixed fields. Older servers read the version as the
+    // date of an unknown operation and close the connection.
+    if (!conn->session && strcmp(operation, "SESSION_V2") == 0) {
+        if (read_string(conn, datetime, MAX_STRING) <= 0) {
+            return -1;
+        }
+        if (strcmp(datetime, "2") != 0) {
+            send_response(conn, 1); // Unsupported version
+            return 0;
+        }
+        send_response(conn, 0);
+        conn->session = 1;
+        conn->binary = 1;
+        conn->served++;
+        return 0;
+    }
+
+    // Read date and time (new functionality)
+    if (read_string(conn, datetime, MAX_STRING) <= 0) {
+        printf("s > Error reading date and time\n");
+        return -1;
+    }
+    
+    // Count the request and time it up to its reply
+    OperationMetrics *metrics = &operation_metrics[operation_index(operation)];
+    uint64_t start = metrics_now();
+    conn->response = 0;
+    int result = process_request(conn, operation, datetime);
+    if (result < 0 || conn->response != 0) {
+        __atomic_fetch_add(&metrics->errors, 1, __ATOMIC_RELAXED);
+    }
+    histogram_observe(&metrics->latency, metrics_now() - start);
+    if (result < 0) {
+        return -1;
+    }
+    conn->served++;
+    return 0;
+}
+
+// Function to get the position of an operation in request_fields,
+// NUM_OPERATIONS if it is unknown
+int operation_index(const char *operation) {
+    for (int i = 0; i < NUM_OPERATIONS; i++) {
+        if (strcmp(operation, request_fields[i].operation) == 0) {
+            return i;
+        }
+    }
+    return NUM_OPERATIONS;
+}
+
+// Function to get the number of fields that follow an operation in a v1
+// request. Unknown operations are read up to their date and then rejected.
+int count_request_fields(const char *operation, int session) {
+    if (!session && strcmp(operation, "SESSION") == 0) {
+        return 0;
+    }
+    if (!session && strcmp(operation, "SESSION_V2") == 0) {
+        return 1;
+    }
+    int i = operation_index(operation);
+    return i < NUM_OPERATIONS ? request_fields[i].fields : 1;
+}
+
+// Function to check if the next request of a connection is in its buffer.
+// A v2 frame is complete once its length is buffered; a v1 request once
+// its operation and the fields of that operation are. The scan resumes
+// where the previous call stopped, so every byte is looked at once.
+int request_ready(Connection *conn) {
+    const char *data = conn->in + conn->in_pos;
+    size_t avail = conn->in_len - conn->in_pos;
+    
+    if (conn->binary) {
+        if (avail < 4) {
+            return 0;
+        }
+        uint32_t len = get_uint32(data);
+        // A frame of invalid size is handed over for read_frame to reject
+        return len < 4 || len > MAX_FRAME || avail - 4 >= len;
+    }
+    
+    // The request id (session mode) and the operation come first
+    int operation_field = conn->session ? 1 : 0;
+    if (conn->scan_needed == 0) {
+        conn->scan_needed = operation_field + 1;
+    }
+    while (conn->scan_fields < conn->scan_needed) {
+        const char *end = memchr(data + conn->scan_pos, '\0', avail - conn->scan_pos);
+        if (!end) {
+            conn->scan_pos = avail;
+            return 0;
+        }
+        if (conn->scan_fields == operation_field) {
+            conn->scan_needed += count_request_fields(data + conn->field_start, conn->session);
+        }
+        conn->scan_fields++;
+        conn->scan_pos = conn->field_start = end - data + 1;
+    }
+    return 1;
+}
+
+// Function to read what a peer has sent without blocking. The buffer grows
+// while it holds no whole request, up to MAX_FRAME. Returns -1 on error.
+int read_available(Connection *conn) {
+    while (!conn->eof) {
+        if (conn->in_len == conn->in_cap) {
+            if (conn->in_pos > 0) {
+                // Move the unread bytes to the start of the buffer
+                memmove(conn->in, conn->in + conn->in_pos, conn->in_len - conn->in_pos);
+                conn->in_len -= conn->in_pos;
+                conn->in_pos = 0;
+            } else if (request_ready(conn)) {
+                return 0;   // Read the rest once the request is served
+            } else if (conn->in_cap < MAX_FRAME + 4) {
+                char *in = realloc(conn->in, conn->in_cap * 2);
+                if (!in) {
+                    return -1;
+                }
+                conn->in = in;
+                conn->in_cap *= 2;
+            } else {
+                return -1;  // Request too large
+            }
+        }
+        
+        ssize_t n = recv(conn->sock, conn->in + conn->in_len,
+                         conn->in_cap - conn->in_len, MSG_DONTWAIT);
+        if (n > 0) {
+            conn->in_len += n;
+        } else if (n == 0) {
+            conn->eof = 1;
+        } else if (errno == EAGAIN || errno == EWOULDBLOCK) {
+            return 0;
+        } else if (errno != EINTR) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+// Function to wait for the next event of a connection: writable while a
+// reply is waiting in its output buffer, readable otherwise
+int watch_connection(Connection *conn, int op) {
+    struct epoll_event event;
+    event.events = (conn->out_len > 0 ? EPOLLOUT : EPOLLIN) | EPOLLONESHOT;
+    event.data.ptr = conn;
+    return epoll_ctl(epoll_fd, op, conn->sock, &event);
+}
+
+// Function to hand a connection with a whole request to the workers
+void queue_connection(Connection *conn) {
+    pthread_mutex_lock(&work_lock);
+    conn->next = NULL;
+    if (work_tail) {
+        work_tail->next = conn;
+    } else {
+        work_head = conn;
+    }
+    work_tail = conn;
+    if (++work_queued > work_queued_peak) {
+        work_queued_peak = work_queued;
+    }
+    pthread_cond_signal(&work_ready);
+    pthread_mutex_unlock(&work_lock);
+}
+
+// Worker of the epoll front end: serves the buffered requests of a
+// connection, then gives it back to the event loop. The connection is
+// not watched meanwhile (EPOLLONESHOT), so only one thread uses it.
+void *worker_thread(void *arg) {
+    while (1) {
+        pthread_mutex_lock(&work_lock);
+        while (!work_head) {
+            pthread_cond_wait(&work_ready, &work_lock);
+        }
+        Connection *conn = work_head;
+        work_head = conn->next;
+        if (!work_head) {
+            work_tail = NULL;
+        }
+        work_queued--;
+        pthread_mutex_unlock(&work_lock);
+        
+        int closing = 0;
+        gauge_add(&handlers_active, &handlers_peak, 1);
+        while (!closing && !conn->failed && conn->out_len == 0 && request_ready(conn)) {
+            closing = serve_request(conn) < 0;
+        }
+        gauge_add(&handlers_active, &handlers_peak, -1);
+        
+        // A reply the socket did not take is written by the event loop,
+        // which hands the connection back once it is out
+        if (closing || conn->failed || (conn->eof && conn->out_len == 0) ||
+            watch_connection(conn, EPOLL_CTL_MOD) < 0) {
+            connection_free(conn);
+        }
+    }
+    return NULL;
+}
+
+// Function to accept every pending connection and watch it
+void accept_connections() {
+    while (1) {
+        int sock = accept(server_socket, NULL, NULL);
+        if (sock < 0) {
+            if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+                perror("Error in accept");
+            }
+            if (errno != EINTR) {
+                return;
+            }
+            continue;
+        }
+        
+        Connection *conn = connection_new(sock);
+        if (!conn) {
+            perror("Error allocating connection");
+            close(sock);
+            continue;
+        }
+        conn->evented = 1;
+        if (watch_connection(conn, EPOLL_CTL_ADD) < 0) {
+            perror("Error in epoll_ctl");
+            connection_free(conn);
         }
-        users[user_index].files = temp;
     }
-    
-    // Add file
-    strncpy(users[user_index].files[users[user_index].num_files].filename, filename, MAX_STRING - 1);
-    users[user_index].files[users[user_index].num_files].filename[MAX_STRING - 1] = '\0';
-    
-    strncpy(users[user_index].files[users[user_index].num_files].description, description, MAX_STRING - 1);
-    users[user_index].files[users[user_index].num_files].description[MAX_STRING - 1] = '\0';
-    
-    users[user_index].num_files++;
-    
-    return result;
 }
 
-// Function to remove a file
-int remove_file(int user_index, char *filename) {
+// Main loop of the epoll front end. A single thread accepts connections
+// and reads requests as they arrive, without blocking on any of them;
+// whole requests are served by a fixed pool of worker threads.
+void run_event_loop(int workers) {
+    epoll_fd = epoll_create1(0);
+    if (epoll_fd < 0) {
+        perror("Error in epoll_create1");
+        exit(1);
+    }
     
-    int result = -1;
+    // The listening socket is watched for new connections (no data pointer)
+    fcntl(server_socket, F_SETFL, fcntl(server_socket, F_GETFL) | O_NONBLOCK);
+    struct epoll_event event;
+    event.events = EPOLLIN;
+    event.data.ptr = NULL;
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, server_socket, &event) < 0) {
+        perror("Error in epoll_ctl");
+        exit(1);
+    }
     
-    // Search for file
-    for (int i = 0; i < users[user_index].num_files; i++) {
-        if (strcmp(users[user_index].files[i].filename, filename) == 0) {
-            // Move last file to deleted position
-            if (i < users[user_index].num_files - 1) {
-                users[user_index].files[i] = users[user_index].files[users[user_index].num_files - 1];
-            }
-            users[user_index].num_files--;
-            result = 0;
-            break;
+    for (int i = 0; i < workers; i++) {
+        pthread_t thread_id;
+        if (pthread_create(&thread_id, NULL, worker_thread, NULL) != 0) {
+            perror("Error creating worker");
+            exit(1);
         }
+        pthread_detach(thread_id);
     }
+    workers_started = workers;
     
-    return result;
-}
-
-// Function to read a string from a socket
-int read_string(int socket, char *buffer, int max_length) {
-    memset(buffer, 0, max_length);
-    int total_read = 0;
-    char c;
-    
-    while (total_read < max_length - 1) {
-        int n = read(socket, &c, 1);
-        if (n <= 0) {
-            return -1; // Read error
+    struct epoll_event events[MAX_EVENTS];
+    while (1) {
+        int n = epoll_wait(epoll_fd, events, MAX_EVENTS, -1);
+        if (n < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            perror("Error in epoll_wait");
+            exit(1);
         }
         
-        if (c == '\0') {
-            break;
+        for (int i = 0; i < n; i++) {
+            Connection *conn = events[i].data.ptr;
+            if (!conn) {
+                accept_connections();
+                continue;
+            }
+            
+            // Write the rest of a reply before reading the next requests
+            if (conn->out_len > 0) {
+                int flushed = flush_output(conn);
+                if (flushed < 0) {
+                    connection_free(conn);
+                    continue;
+                }
+                if (flushed == 0) {
+                    if (watch_connection(conn, EPOLL_CTL_MOD) < 0) {
+                        connection_free(conn);
+                    }
+                    continue;
+                }
+            }
+            
+            if (read_available(conn) < 0) {
+                connection_free(conn);
+            } else if (request_ready(conn)) {
+                queue_connection(conn);
+            } else if (conn->eof) {
+                // A closed connection after the first request is the normal end
+                if (!conn->served) {
+                    printf("s > Error reading operation\n");
+                }
+                connection_free(conn);
+            } else if (watch_connection(conn, EPOLL_CTL_MOD) < 0) {
+                connection_free(conn);
+            }
         }
-        
-        buffer[total_read++] = c;
     }
-    
-    buffer[total_read] = '\0';
-    return total_read;
 }
 
-// Main function to handle client connections
-void *handle_client(void *socket_desc) {
-    int sock = *(int*)socket_desc;
-    free(socket_desc);
-    
+// Function to process one request. Returns -1 if the connection must be closed.
+int process_request(Connection *conn, char *operation, char *datetime) {
     char buffer[MAX_STRING];
-    char operation[MAX_STRING];
-    char datetime[MAX_STRING];  
     char username[MAX_STRING];
     char filename[MAX_STRING];
     char description[MAX_STRING];
-    char port_str[MAX_STRING];
     char remote_username[MAX_STRING];
     int port = 0;
     unsigned char response = 0;
     
-    // Read requested operation
-    if (read_string(sock, operation, MAX_STRING) <= 0) {
-        printf("s > Error reading operation\n");
-        close(sock);
-        return NULL;
-    }
-
-    // Read date and time (new functionality)
-    if (read_string(sock, datetime, MAX_STRING) <= 0) {
-        printf("s > Error reading date and time\n");
-        close(sock);
-        return NULL;
-    }
-    
     // Process operation
     if (strcmp(operation, "REGISTER") == 0) {
         // Read username
-        if (read_string(sock, username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         printf("s > OPERATION REGISTER FROM %s - Timestamp: %s\n", username, datetime);
@@ -374,25 +1991,25 @@ void *handle_client(void *socket_desc) {
         send_log(username, "REGISTER", datetime);
         
         // Check if user already exists
-        pthread_mutex_lock(&users_mutex);
+        lock_users(1);
         int user_index = find_user(username);
         
         if (user_index != -1) {
             response = 1; // User already registered
+        } else if (add_user(username) < 0) {
+            response = 2; // Error adding the user
         } else {
-            add_user(username);
             response = 0; // Success
         }
-        pthread_mutex_unlock(&users_mutex);
+        pthread_rwlock_unlock(&users_lock);
         
         // Send response
-        write(sock, &response, 1);
+        send_response(conn, response);
     }
     else if (strcmp(operation, "UNREGISTER") == 0) {
         // Read username
-        if (read_string(sock, username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         printf("s > OPERATION UNREGISTER FROM %s - Timestamp: %s\n", username, datetime);
@@ -400,7 +2017,7 @@ void *handle_client(void *socket_desc) {
         send_log(username, "UNREGISTER", datetime);
         
         // Check if user exists
-        pthread_mutex_lock(&users_mutex);
+        lock_users(1);
         int user_index = find_user(username);
         
         if (user_index == -1) {
@@ -409,25 +2026,21 @@ void *handle_client(void *socket_desc) {
             remove_user(username);
             response = 0; // Success
         }
-        pthread_mutex_unlock(&users_mutex);
+        pthread_rwlock_unlock(&users_lock);
         
         // Send response
-        write(sock, &response, 1);
+        send_response(conn, response);
     }
     else if (strcmp(operation, "CONNECT") == 0) {
         // Read username
-        if (read_string(sock, username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         // Read port
-        if (read_string(sock, port_str, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_int(conn, &port) < 0) {
+            return -1;
         }
-
-        port = atoi(port_str);
         
         printf("s > OPERATION CONNECT FROM %s - Timestamp: %s\n", username, datetime);
         // RPC service call
@@ -436,16 +2049,15 @@ void *handle_client(void *socket_desc) {
         // Get client IP address
         struct sockaddr_in addr;
         socklen_t addr_len = sizeof(addr);
-        if (getpeername(sock, (struct sockaddr*)&addr, &addr_len) < 0) {
+        if (getpeername(conn->sock, (struct sockaddr*)&addr, &addr_len) < 0) {
             perror("s > getpeername error");
-            close(sock);
-            return NULL;
+            return -1;
         }
         char ip[INET_ADDRSTRLEN];
         inet_ntop(AF_INET, &addr.sin_addr, ip, sizeof(ip));
         
         // Check if user exists
-        pthread_mutex_lock(&users_mutex);
+        lock_users(1);
         int user_index = find_user(username);
         
         if (user_index == -1) {
@@ -456,19 +2068,15 @@ void *handle_client(void *socket_desc) {
             connect_user(user_index, ip, port);
             response = 0; // Success
         }
-        pthread_mutex_unlock(&users_mutex);        
+        pthread_rwlock_unlock(&users_lock);
 
         // Send response
-        ssize_t bytes_written = write(sock, &response, 1);
-        if (bytes_written <= 0) {
-            perror("s > Error writing CONNECT response");
-        }
+        send_response(conn, response);
     }
     else if (strcmp(operation, "DISCONNECT") == 0) {
         // Read username
-        if (read_string(sock, username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         printf("s > OPERATION DISCONNECT FROM %s - Timestamp: %s\n", username, datetime);
@@ -476,7 +2084,7 @@ void *handle_client(void *socket_desc) {
         send_log(username, "DISCONNECT", datetime);
         
         // Check if user exists and is connected
-        pthread_mutex_lock(&users_mutex);
+        lock_users(1);
         int user_index = find_user(username);
         
         if (user_index == -1) {
@@ -487,34 +2095,31 @@ void *handle_client(void *socket_desc) {
             disconnect_user(user_index);
             response = 0; // Success
         }
-        pthread_mutex_unlock(&users_mutex);
+        pthread_rwlock_unlock(&users_lock);
         
         // Send response
-        write(sock, &response, 1);
+        send_response(conn, response);
     }
     else if (strcmp(operation, "PUBLISH") == 0) {
         // Read username
-        if (read_string(sock, username, MAX_STRING) <= 0) {
+        if (read_string(conn, username, MAX_STRING) <= 0) {
             response = 4;
-            write(sock, &response, 1);
-            close(sock);
-            return NULL;
+            send_response(conn, response);
+            return -1;
         }
         
         // Read filename
-        if (read_string(sock, filename, MAX_STRING) <= 0) {
+        if (read_string(conn, filename, MAX_STRING) <= 0) {
             response = 4;
-            write(sock, &response, 1);
-            close(sock);
-            return NULL;
+            send_response(conn, response);
+            return -1;
         }
         
         // Read description
-        if (read_string(sock, description, MAX_STRING) <= 0) {
+        if (read_string(conn, description, MAX_STRING) <= 0) {
             response = 4;
-            write(sock, &response, 1);
-            close(sock);
-            return NULL;
+            send_response(conn, response);
+            return -1;
         }
         
         printf("s > OPERATION PUBLISH FROM %s - Timestamp: %s\n", username, datetime);
@@ -527,11 +2132,10 @@ void *handle_client(void *socket_desc) {
         
         if (strcmp(username, "__NONE__") == 0) {
             response = 1;
-            write(sock, &response, 1);
-            close(sock);
-            return NULL;
+            send_response(conn, response);
+            return 0;
         }
-        pthread_mutex_lock(&users_mutex);
+        lock_users(1);
         int user_index = find_user(username);
         
         if (user_index == -1) {
@@ -548,22 +2152,20 @@ void *handle_client(void *socket_desc) {
                 response = 0; // Success
             }
         }
-        pthread_mutex_unlock(&users_mutex);
+        pthread_rwlock_unlock(&users_lock);
         
         // Send response
-        write(sock, &response, 1);
+        send_response(conn, response);
     }
     else if (strcmp(operation, "DELETE") == 0) {
         // Read username
-        if (read_string(sock, username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         // Read filename
-        if (read_string(sock, filename, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, filename, MAX_STRING) <= 0) {
+            return -1;
         }
         
         printf("s > OPERATION DELETE FROM %s - Timestamp: %s\n", username, datetime);
@@ -576,12 +2178,11 @@ void *handle_client(void *socket_desc) {
         
         if (strcmp(username, "__NONE__") == 0) {
             response = 1;
-            write(sock, &response, 1);
-            close(sock);
-            return NULL;
+            send_response(conn, response);
+            return 0;
         }
         // Check if user exists and is connected
-        pthread_mutex_lock(&users_mutex);
+        lock_users(1);
         int user_index = find_user(username);
         
         if (user_index == -1) {
@@ -596,16 +2197,15 @@ void *handle_client(void *socket_desc) {
                 response = 0; // Success
             }
         }
-        pthread_mutex_unlock(&users_mutex);
+        pthread_rwlock_unlock(&users_lock);
         
         // Send response
-        write(sock, &response, 1);
+        send_response(conn, response);
     }
     else if (strcmp(operation, "LIST_USERS") == 0) {
         // Read username
-        if (read_string(sock, username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         printf("s > OPERATION LIST_USERS FROM %s - Timestamp: %s\n", username, datetime);
@@ -614,23 +2214,21 @@ void *handle_client(void *socket_desc) {
         
         if (strcmp(username, "__NONE__") == 0) {
             response = 1;
-            write(sock, &response, 1);
-            close(sock);
-            return NULL;
+            send_response(conn, response);
+            return 0;
         }
-        // Check if user exists and is connected
-        pthread_mutex_lock(&users_mutex);
+        // Build the list from a snapshot taken under the read lock, and
+        // send it once the lock is released
+        Reply list = {.binary = conn->binary};
+        lock_users(0);
         int user_index = find_user(username);
         
         if (user_index == -1) {
             response = 1; // User does not exist
-            write(sock, &response, 1);
         } else if (!users[user_index].connected) {
             response = 2; // User not connected
-            write(sock, &response, 1);
         } else {
             response = 0; // Success
-            write(sock, &response, 1);
             
             // Count connected users
             int connected_users = 0;
@@ -640,38 +2238,119 @@ void *handle_client(void *socket_desc) {
                 }
             }
             
-            // Send number of connected users
-            sprintf(buffer, "%d", connected_users);
-            write(sock, buffer, strlen(buffer) + 1);
+            // Number of connected users
+            reply_add_int(&list, connected_users);
             
-            // Send information for each connected user
+            // Information for each connected user
             for (int i = 0; i < num_users; i++) {
                 if (users[i].connected) {
-                    // Send username
-                    write(sock, users[i].username, strlen(users[i].username) + 1);
-                    
-                    // Send IP
-                    write(sock, users[i].ip, strlen(users[i].ip) + 1);
-                    
-                    // Send port
-                    sprintf(buffer, "%d", users[i].port);
-                    write(sock, buffer, strlen(buffer) + 1);
+                    add_user_entry(&list, i);
                 }
             }
         }
-        pthread_mutex_unlock(&users_mutex);
+        pthread_rwlock_unlock(&users_lock);
+        
+        if (list.failed) {
+            response = 3; // Error building the list
+        }
+        send_reply(conn, response, response == 0 ? &list : NULL);
+        reply_free(&list);
+    }
+    else if (strcmp(operation, "LIST_USERS_DELTA") == 0) {
+        // Read username
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
+        }
+        
+        // Read the version of the list known by the client
+        if (read_string(conn, buffer, MAX_STRING) <= 0) {
+            return -1;
+        }
+        
+        printf("s > OPERATION LIST_USERS_DELTA FROM %s - Timestamp: %s\n", username, datetime);
+        // RPC service call
+        send_log(username, "LIST_USERS_DELTA", datetime);
+        
+        if (strcmp(username, "__NONE__") == 0) {
+            response = 1;
+            send_response(conn, response);
+            return 0;
+        }
+        // Build the changes under the read lock, send them once released
+        Reply list = {.binary = conn->binary};
+        lock_users(0);
+        int user_index = find_user(username);
+        
+        if (user_index == -1) {
+            response = 1; // User does not exist
+        } else if (!users[user_index].connected) {
+            response = 2; // User not connected
+        } else {
+            response = 0; // Success
+            add_users_delta(&list, buffer);
+        }
+        pthread_rwlock_unlock(&users_lock);
+        
+        if (list.failed) {
+            response = 3; // Error building the list
+        }
+        send_reply(conn, response, response == 0 ? &list : NULL);
+        reply_free(&list);
+    }
+    else if (strcmp(operation, "LOOKUP_USER") == 0) {
+        // Read username performing the operation
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
+        }
+        
+        // Read remote username
+        if (read_string(conn, remote_username, MAX_STRING) <= 0) {
+            return -1;
+        }
+        
+        printf("s > OPERATION LOOKUP_USER FROM %s - Timestamp: %s\n", username, datetime);
+        // RPC service call
+        send_log(username, "LOOKUP_USER", datetime);
+        
+        if (strcmp(username, "__NONE__") == 0) {
+            response = 1;
+            send_response(conn, response);
+            return 0;
+        }
+        // Copy the address of the remote user under the read lock
+        Reply address = {.binary = conn->binary};
+        lock_users(0);
+        int user_index = find_user(username);
+        int remote_user_index = find_user(remote_username);
+        
+        if (user_index == -1) {
+            response = 1; // Local user does not exist
+        } else if (!users[user_index].connected) {
+            response = 2; // Local user not connected
+        } else if (remote_user_index == -1 || !users[remote_user_index].connected) {
+            response = 3; // Remote user does not exist or is not connected
+        } else {
+            response = 0; // Success
+            reply_add_string(&address, users[remote_user_index].ip);
+            reply_add_int(&address, users[remote_user_index].port);
+        }
+        pthread_rwlock_unlock(&users_lock);
+        
+        if (address.failed) {
+            response = 4; // Error building the reply
+        }
+        send_reply(conn, response, response == 0 ? &address : NULL);
+        reply_free(&address);
     }
     else if (strcmp(operation, "LIST_CONTENT") == 0) {
         // Read username performing the operation
-        if (read_string(sock, username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         // Read remote username
-        if (read_string(sock, remote_username, MAX_STRING) <= 0) {
-            close(sock);
-            return NULL;
+        if (read_string(conn, remote_username, MAX_STRING) <= 0) {
+            return -1;
         }
         
         printf("s > OPERATION LIST_CONTENT FROM %s - Timestamp: %s\n", username, datetime);
@@ -680,45 +2359,362 @@ void *handle_client(void *socket_desc) {
         
         if (strcmp(username, "__NONE__") == 0) {
             response = 1;
-            write(sock, &response, 1);
-            close(sock);
-            return NULL;
+            send_response(conn, response);
+            return 0;
         }
-        // Check if users exist and if local user is connected
-        pthread_mutex_lock(&users_mutex);
+        // Build the list from a snapshot taken under the read lock, and
+        // send it once the lock is released
+        Reply list = {.binary = conn->binary};
+        lock_users(0);
         int user_index = find_user(username);
         int remote_user_index = find_user(remote_username);
         
         if (user_index == -1) {
             response = 1; // Local user does not exist
-            write(sock, &response, 1);
         } else if (!users[user_index].connected) {
             response = 2; // Local user not connected
-            write(sock, &response, 1);
         } else if (remote_user_index == -1) {
             response = 3; // Remote user does not exist
-            write(sock, &response, 1);
         } else {
             response = 0; // Success
-            write(sock, &response, 1);
             
-            // Send number of files
-            sprintf(buffer, "%d", users[remote_user_index].num_files);
-            write(sock, buffer, strlen(buffer) + 1);
+            User *remote = &users[remote_user_index];
+            
+            // Number of files
+            reply_add_int(&list, remote->num_files - remote->num_deleted);
+            
+            // Filenames
+            for (int i = 0; i < remote->num_files; i++) {
+                if (remote->files[i].filename) {
+                    reply_add_string(&list, remote->files[i].filename);
+                }
+            }
+        }
+        pthread_rwlock_unlock(&users_lock);
+        
+        if (list.failed) {
+            response = 4; // Error building the list
+        }
+        send_reply(conn, response, response == 0 ? &list : NULL);
+        reply_free(&list);
+    }
+    else if (strcmp(operation, "LIST_CONTENT_PAGE") == 0) {
+        char prefix[MAX_STRING];
+        int cursor, limit;
+        
+        // Read username performing the operation
+        if (read_string(conn, username, MAX_STRING) <= 0) {
+            return -1;
+        }
+        
+        // Read remote username
+        if (read_string(conn, remote_username, MAX_STRING) <= 0) {
+            return -1;
+        }
+        
+        // Read cursor, page size and filename prefix (may be empty)
+        if (read_int(conn, &cursor) < 0 ||
+            read_int(conn, &limit) < 0 ||
+            read_string(conn, prefix, MAX_STRING) < 0) {
+            return -1;
+        }
+        if (cursor < 0) {
+            cursor = 0;
+        }
+        if (limit <= 0 || limit > MAX_PAGE) {
+            limit = MAX_PAGE;
+        }
+        size_t prefix_len = strlen(prefix);
+        
+        printf("s > OPERATION LIST_CONTENT_PAGE FROM %s - Timestamp: %s\n", username, datetime);
+        // RPC service call
+        send_log(username, "LIST_CONTENT_PAGE", datetime);
+        
+        if (strcmp(username, "__NONE__") == 0) {
+            response = 1;
+            send_response(conn, response);
+            return 0;
+        }
+        // Build the page under the read lock, send it once released. The
+        // cursor is the publish number of the last file looked at: the
+        // files stay in publish order, so the next page starts after it
+        // even if files were deleted or published in between.
+        Reply page = {.binary = conn->binary};
+        Reply entries = {.binary = conn->binary};
+        int count = 0;
+        lock_users(0);
+        int user_index = find_user(username);
+        int remote_user_index = find_user(remote_username);
+        
+        if (user_index == -1) {
+            response = 1; // Local user does not exist
+        } else if (!users[user_index].connected) {
+            response = 2; // Local user not connected
+        } else if (remote_user_index == -1) {
+            response = 3; // Remote user does not exist
+        } else {
+            response = 0; // Success
+            User *remote = &users[remote_user_index];
+            int low = 0, high = remote->num_files;
+            while (low < high) {
+                int middle = low + (high - low) / 2;
+                if (remote->files[middle].seq <= cursor) {
+                    low = middle + 1;
+                } else {
+                    high = middle;
+                }
+            }
+            int i = low;
+            for (; i < remote->num_files && count < limit; i++) {
+                if (remote->files[i].filename &&
+                    strncmp(remote->files[i].filename, prefix, prefix_len) == 0) {
+                    reply_add_string(&entries, remote->files[i].filename);
+                    reply_add_string(&entries, remote->files[i].description);
+                    count++;
+                }
+            }
             
-            // Send filenames
-            for (int i = 0; i < users[remote_user_index].num_files; i++) {
-                write(sock, users[remote_user_index].files[i].filename, 
-                      strlen(users[remote_user_index].files[i].filename) + 1);
+            // Cursor of the next page, -1 after the last one
+            reply_add_int(&page, i < remote->num_files ? remote->files[i - 1].seq : -1);
+            reply_add_int(&page, count);
+            if (count > 0) {
+                reply_append(&page, entries.data, entries.len);
+            }
+        }
+        pthread_rwlock_unlock(&users_lock);
+        
+        if (page.failed || entries.failed) {
+            response = 4; // Error building the page
+        }
+        send_reply(conn, response, response == 0 ? &page : NULL);
+        reply_free(&page);
+        reply_free(&entries);
+    }
+    else if (strcmp(operation, "SEARCH") == 0) {
+        char query[MAX_STRING];
+        int cursor, limit;
+        
+        // Read username, query, cursor and page size
+        if (read_string(conn, username, MAX_STRING) <= 0 ||
+            read_string(conn, query, MAX_STRING) < 0 ||
+            read_int(conn, &cursor) < 0 ||
+            read_int(conn, &limit) < 0) {
+            return -1;
+        }
+        if (cursor < 0) {
+            cursor = 0;
+        }
+        if (limit <= 0 || limit > MAX_PAGE) {
+            limit = MAX_PAGE;
+        }
+        
+        printf("s > OPERATION SEARCH FROM %s - Timestamp: %s\n", username, datetime);
+        // RPC service call
+        send_log(username, "SEARCH", datetime);
+        
+        if (strcmp(username, "__NONE__") == 0) {
+            response = 1;
+            send_response(conn, response);
+            return 0;
+        }
+        // Search and build the page under the read lock, send it once
+        // released. Results are ranked again for every page.
+        Reply page = {.binary = conn->binary};
+        lock_users(0);
+        int user_index = find_user(username);
+        
+        if (user_index == -1) {
+            response = 1; // User does not exist
+        } else if (!users[user_index].connected) {
+            response = 2; // User not connected
+        } else {
+            Match *matches;
+            int total = search_files(query, &matches);
+            if (total < 0) {
+                response = 3; // Error searching
+            } else {
+                response = 0; // Success
+                // A cursor past the results gives an empty last page
+                if (cursor > total) {
+                    cursor = total;
+                }
+                int end = limit > total - cursor ? total : cursor + limit;
+                
+                // Total matches, cursor of the next page (-1 after the
+                // last one) and the entries of this page
+                reply_add_int(&page, total);
+                reply_add_int(&page, end < total ? end : -1);
+                reply_add_int(&page, end - cursor);
+                for (int i = cursor; i < end; i++) {
+                    const char *filename = matches[i].filename;
+                    reply_add_string(&page, matches[i].owner);
+                    reply_add_string(&page, filename);
+                    // The description follows the filename (see File)
+                    reply_add_string(&page, filename + strlen(filename) + 1);
+                    reply_add_int(&page, matches[i].score);
+                }
             }
+            free(matches);
         }
-        pthread_mutex_unlock(&users_mutex);
+        pthread_rwlock_unlock(&users_lock);
+        
+        if (page.failed) {
+            response = 3; // Error building the page
+        }
+        send_reply(conn, response, response == 0 ? &page : NULL);
+        reply_free(&page);
+    }
+    else if (strcmp(operation, "STATS") == 0) {
+        printf("s > OPERATION STATS - Timestamp: %s\n", datetime);
+        
+        // Samples of the metrics, named like Prometheus metrics
+        Reply stats = {.binary = conn->binary};
+        add_metrics(&stats);
+        if (stats.failed) {
+            response = 1; // Error building the reply
+        }
+        send_reply(conn, response, response == 0 ? &stats : NULL);
+        reply_free(&stats);
     }
     else {
         printf("s > Unknown operation: %s\n", operation);
+        return -1;
     }
     
-    // Close socket
-    close(sock);
-    return NULL;
+    return 0;
+}
+
+// Function to take users_lock for reading (write = 0) or for writing. The
+// wait is only timed when the lock is busy, so taking a free lock does not
+// read the clock.
+void lock_users(int write) {
+    __atomic_fetch_add(&lock_acquired[write], 1, __ATOMIC_RELAXED);
+    if ((write ? pthread_rwlock_trywrlock(&users_lock) : pthread_rwlock_tryrdlock(&users_lock)) == 0) {
+        return;
+    }
+    uint64_t start = metrics_now();
+    if (write) {
+        pthread_rwlock_wrlock(&users_lock);
+    } else {
+        pthread_rwlock_rdlock(&users_lock);
+    }
+    __atomic_fetch_add(&lock_contended[write], 1, __ATOMIC_RELAXED);
+    histogram_observe(&lock_wait[write], metrics_now() - start);
+}
+
+// Function to add delta to a gauge and raise its peak
+void gauge_add(int *gauge, int *peak, int delta) {
+    int value = __atomic_add_fetch(gauge, delta, __ATOMIC_RELAXED);
+    int seen = __atomic_load_n(peak, __ATOMIC_RELAXED);
+    while (value > seen &&
+           !__atomic_compare_exchange_n(peak, &seen, value, 0, __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+    }
+}
+
+// Function to add a sample, its name with the labels (may be empty)
+// between braces and its value
+void add_sample(Reply *samples, int *count, const char *name, const char *labels, double value) {
+    char buffer[MAX_STRING];
+    
+    if (labels[0]) {
+        snprintf(buffer, sizeof(buffer), "%s{%s}", name, labels);
+        reply_add_string(samples, buffer);
+    } else {
+        reply_add_string(samples, name);
+    }
+    snprintf(buffer, sizeof(buffer), "%.15g", value);
+    reply_add_string(samples, buffer);
+    (*count)++;
+}
+
+// Function to add the samples of a histogram: the cumulative count of
+// each bucket, the sum in seconds and the count
+void add_histogram(Reply *samples, int *count, const char *name, const char *labels, histogram *h) {
+    char sample[MAX_STRING];
+    char bucket_labels[MAX_STRING];
+    const char *separator = labels[0] ? "," : "";
+    unsigned long cumulative = 0;
+    
+    snprintf(sample, sizeof(sample), "%s_bucket", name);
+    for (int i = 0; i < HISTOGRAM_BUCKETS; i++) {
+        cumulative += h->buckets[i];
+        if (i < HISTOGRAM_BUCKETS - 1) {
+            snprintf(bucket_labels, sizeof(bucket_labels), "%s%sle=\"%g\"",
+                     labels, separator, (double)(1UL << i) / 1e6);
+        } else {
+            snprintf(bucket_labels, sizeof(bucket_labels), "%s%sle=\"+Inf\"", labels, separator);
+        }
+        add_sample(samples, count, sample, bucket_labels, cumulative);
+    }
+    snprintf(sample, sizeof(sample), "%s_sum", name);
+    add_sample(samples, count, sample, labels, h->sum_ns / 1e9);
+    snprintf(sample, sizeof(sample), "%s_count", name);
+    add_sample(samples, count, sample, labels, cumulative);
+}
+
+// Function to add the reply of a STATS request: the number of samples and
+// the name and value of each one, both as strings
+void add_metrics(Reply *reply) {
+    Reply samples = {.binary = reply->binary};
+    char labels[MAX_STRING];
+    int count = 0;
+    
+    add_sample(&samples, &count, "p2p_server_uptime_seconds", "", (metrics_now() - start_time) / 1e9);
+    lock_users(0);
+    add_sample(&samples, &count, "p2p_server_users", "", num_users);
+    pthread_rwlock_unlock(&users_lock);
+    
+    // Front end
+    add_sample(&samples, &count, "p2p_server_workers", "", workers_started);
+    add_sample(&samples, &count, "p2p_server_handlers_active", "", __atomic_load_n(&handlers_active, __ATOMIC_RELAXED));
+    add_sample(&samples, &count, "p2p_server_handlers_peak", "", __atomic_load_n(&handlers_peak, __ATOMIC_RELAXED));
+    add_sample(&samples, &count, "p2p_server_connections_open", "", __atomic_load_n(&connections_open, __ATOMIC_RELAXED));
+    add_sample(&samples, &count, "p2p_server_connections_total", "", __atomic_load_n(&connections_total, __ATOMIC_RELAXED));
+    pthread_mutex_lock(&work_lock);
+    int queued = work_queued;
+    int queued_peak = work_queued_peak;
+    pthread_mutex_unlock(&work_lock);
+    add_sample(&samples, &count, "p2p_server_work_queue_length", "", queued);
+    add_sample(&samples, &count, "p2p_server_work_queue_peak", "", queued_peak);
+    
+    // Operations received at least once
+    for (int i = 0; i <= NUM_OPERATIONS; i++) {
+        OperationMetrics *metrics = &operation_metrics[i];
+        if (metrics->latency.count == 0) {
+            continue;
+        }
+        snprintf(labels, sizeof(labels), "operation=\"%s\"",
+                 i < NUM_OPERATIONS ? request_fields[i].operation : "OTHER");
+        add_sample(&samples, &count, "p2p_server_requests_total", labels, metrics->latency.count);
+        add_sample(&samples, &count, "p2p_server_request_errors_total", labels, metrics->errors);
+        add_histogram(&samples, &count, "p2p_server_request_seconds", labels, &metrics->latency);
+    }
+    
+    // Waits for users_lock
+    for (int write = 0; write < 2; write++) {
+        snprintf(labels, sizeof(labels), "mode=\"%s\"", write ? "write" : "read");
+        add_sample(&samples, &count, "p2p_server_lock_acquisitions_total", labels, lock_acquired[write]);
+        add_sample(&samples, &count, "p2p_server_lock_contended_total", labels, lock_contended[write]);
+        add_histogram(&samples, &count, "p2p_server_lock_wait_seconds", labels, &lock_wait[write]);
+    }
+    
+    // Log records shipped to the RPC server
+    log_metrics log;
+    log_get_metrics(&log);
+    add_sample(&samples, &count, "p2p_server_log_records_total", "state=\"enqueued\"", log.enqueued);
+    add_sample(&samples, &count, "p2p_server_log_records_total", "state=\"shipped\"", log.shipped);
+    add_sample(&samples, &count, "p2p_server_log_records_total", "state=\"dropped\"", log.dropped);
+    add_sample(&samples, &count, "p2p_server_log_records_total", "state=\"lost\"", log.lost);
+    add_sample(&samples, &count, "p2p_server_log_queue_length", "", log.queued);
+    add_sample(&samples, &count, "p2p_server_log_calls_total", "", log.calls);
+    add_sample(&samples, &count, "p2p_server_log_failed_calls_total", "", log.failed_calls);
+    add_histogram(&samples, &count, "p2p_server_send_log_seconds", "", &log.send_log);
+    add_histogram(&samples, &count, "p2p_server_log_call_seconds", "", &log.call);
+    
+    reply_add_int(reply, count);
+    reply_append(reply, samples.data, samples.len);
+    if (samples.failed) {
+        reply->failed = 1;
+    }
+    reply_free(&samples);
 }
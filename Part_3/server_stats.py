@@ -0,0 +1,220 @@
+"""
+Metrics tool of the main server.
+
+Sends STATS requests to the server and shows its counters and latency
+histograms: requests, errors, latency percentiles and share of the time
+per operation, the waits for the users lock, the handler threads and the
+log records shipped to the RPC server. With --interval it scrapes again
+every N seconds and shows only what happened since the previous scrape.
+The samples can also be written in the Prometheus text format (e.g. for a
+textfile collector) or as JSON.
+
+Usage: python3 server_stats.py -s localhost -p 8888 [--interval 5]
+                               [--format table|prometheus|json] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+from p2p_client import Client, RequestError
+
+PREFIX = "p2p_server_"
+SAMPLE = re.compile(r'(\w+)(?:\{(.*)\})?$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+HISTOGRAM_SUFFIXES = ('_bucket', '_sum', '_count')
+
+
+# Function to split the name of a sample into its metric and its labels
+def parse_sample(sample):
+    match = SAMPLE.match(sample)
+    return match.group(1), dict(LABEL.findall(match.group(2) or ""))
+
+
+# Function to subtract an earlier scrape from the counters and histograms
+# of a scrape, so they cover only the time between both. Gauges are kept.
+def since(samples, previous):
+    if not previous:
+        return samples
+    result = {}
+    for sample, value in samples.items():
+        metric = parse_sample(sample)[0]
+        if metric.endswith(('_total',) + HISTOGRAM_SUFFIXES):
+            value -= previous.get(sample, 0)
+        result[sample] = value
+    return result
+
+
+# Function to collect the histograms of a metric by their labels (le
+# excluded): {labels: {"buckets": [(bound, cumulative count)], "sum", "count"}}
+def histograms(samples, name):
+    result = {}
+    for sample, value in samples.items():
+        metric, labels = parse_sample(sample)
+        kind = metric[len(name):]
+        if not metric.startswith(name) or kind not in HISTOGRAM_SUFFIXES:
+            continue
+        le = labels.pop('le', None)
+        histogram = result.setdefault(tuple(sorted(labels.items())),
+                                      {"buckets": [], "sum": 0.0, "count": 0})
+        if kind == '_bucket':
+            histogram["buckets"].append((float(le), value))
+        else:
+            histogram[kind[1:]] = value
+    for histogram in result.values():
+        histogram["buckets"].sort()
+    return result
+
+
+# Function to estimate a quantile (0 to 1) of a histogram, interpolating
+# inside the bucket that holds it like histogram_quantile in Prometheus
+def quantile(histogram, q):
+    buckets = histogram["buckets"]
+    if not buckets or buckets[-1][1] <= 0:
+        return 0.0
+    rank = q * buckets[-1][1]
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+# Function to render a scrape as tables. elapsed is the time covered by
+# the counters: the uptime of the server or the time since the last scrape.
+def render_table(samples, elapsed):
+    def value(name, labels=""):
+        return samples.get(PREFIX + name + (f"{{{labels}}}" if labels else ""), 0)
+
+    elapsed = max(elapsed, 1e-9)
+    workers = value("workers")
+    front_end = f"epoll, {workers:.0f} workers" if workers else "thread per connection"
+    lines = [f"uptime {value('uptime_seconds'):.0f} s, {value('users'):.0f} users, {front_end}",
+             f"handlers {value('handlers_active'):.0f} active (peak {value('handlers_peak'):.0f}), "
+             f"connections {value('connections_open'):.0f} open ({value('connections_total'):.0f} total), "
+             f"work queue {value('work_queue_length'):.0f} (peak {value('work_queue_peak'):.0f})",
+             ""]
+
+    requests = histograms(samples, PREFIX + "request_seconds")
+    busy = sum(h["sum"] for h in requests.values())
+    lines.append(f"{'operation':18s} {'requests':>9s} {'errors':>7s} {'req/s':>8s} {'mean ms':>8s} "
+                 f"{'p50 ms':>7s} {'p99 ms':>7s} {'time %':>7s}")
+    for labels, h in sorted(requests.items()):
+        operation = dict(labels)["operation"]
+        count = h["count"]
+        if count <= 0:
+            continue
+        errors = value("request_errors_total", f'operation="{operation}"')
+        lines.append(f"{operation:18s} {count:9.0f} {errors:7.0f} {count / elapsed:8.1f} "
+                     f"{h['sum'] / count * 1000:8.3f} {quantile(h, 0.5) * 1000:7.3f} "
+                     f"{quantile(h, 0.99) * 1000:7.3f} {h['sum'] / max(busy, 1e-12) * 100:7.1f}")
+
+    lines += ["", f"{'users lock':18s} {'acquired':>9s} {'waited':>7s} {'wait s':>8s} "
+                  f"{'mean us':>8s} {'p99 us':>7s}"]
+    waits = histograms(samples, PREFIX + "lock_wait_seconds")
+    for mode in ("read", "write"):
+        h = waits.get((("mode", mode),), {"buckets": [], "sum": 0.0, "count": 0})
+        labels = f'mode="{mode}"'
+        lines.append(f"{mode:18s} {value('lock_acquisitions_total', labels):9.0f} "
+                     f"{value('lock_contended_total', labels):7.0f} {h['sum']:8.3f} "
+                     f"{h['sum'] / max(h['count'], 1) * 1e6:8.1f} {quantile(h, 0.99) * 1e6:7.1f}")
+
+    send_log = histograms(samples, PREFIX + "send_log_seconds").get((), {"buckets": []})
+    call = histograms(samples, PREFIX + "log_call_seconds").get((), {"buckets": []})
+    records = {state: value("log_records_total", f'state="{state}"')
+               for state in ("enqueued", "shipped", "dropped", "lost")}
+    lines += ["",
+              "log records: " + ", ".join(f"{count:.0f} {state}" for state, count in records.items())
+              + f", {value('log_queue_length'):.0f} queued",
+              f"log_batch calls: {value('log_calls_total'):.0f} ({value('log_failed_calls_total'):.0f} failed), "
+              f"p50 {quantile(call, 0.5) * 1000:.3f} ms, p99 {quantile(call, 0.99) * 1000:.3f} ms; "
+              f"send_log p50 {quantile(send_log, 0.5) * 1e6:.1f} us, p99 {quantile(send_log, 0.99) * 1e6:.1f} us"]
+    return '\n'.join(lines) + '\n'
+
+
+# Function to render a scrape in the Prometheus text format
+def render_prometheus(samples):
+    lines = []
+    typed = set()
+    for sample, value in samples.items():
+        metric = parse_sample(sample)[0]
+        if metric.endswith(HISTOGRAM_SUFFIXES) and metric.rsplit('_', 1)[0].endswith('_seconds'):
+            metric, kind = metric.rsplit('_', 1)[0], "histogram"
+        else:
+            kind = "counter" if metric.endswith('_total') else "gauge"
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{sample} {value:.15g}")
+    return '\n'.join(lines) + '\n'
+
+
+# Function to write a rendered scrape to stdout or, replacing it at once,
+# to a file
+def write_output(text, output):
+    if output is None:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return
+    with open(output + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(output + '.tmp', output)
+
+
+async def run(args):
+    previous = None
+    async with Client(args.s, args.p, persistent=True, protocol=args.protocol) as api:
+        while True:
+            samples = await api.server_stats()
+            if args.format == 'json':
+                text = json.dumps(samples, indent=2) + '\n'
+            elif args.format == 'prometheus':
+                text = render_prometheus(samples)
+            else:
+                uptime = samples.get(PREFIX + "uptime_seconds", 0)
+                if previous:
+                    elapsed = uptime - previous.get(PREFIX + "uptime_seconds", 0)
+                    header = f"--- {time.strftime('%H:%M:%S')}, last {elapsed:.1f} s\n"
+                else:
+                    elapsed, header = uptime, ""
+                text = header + render_table(since(samples, previous), elapsed)
+                if args.interval and args.output is None:
+                    text += '\n'
+            write_output(text, args.output)
+            if not args.interval:
+                return
+            previous = samples
+            await asyncio.sleep(args.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', default='localhost', help='Server IP')
+    parser.add_argument('-p', type=int, required=True, help='Server port')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=1, help='Framing of the session')
+    parser.add_argument('--format', choices=('table', 'prometheus', 'json'), default='table',
+                        help='Output format')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='Seconds between scrapes (0: scrape once)')
+    parser.add_argument('--output', help='File written with each scrape (default: stdout)')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    except (RequestError, ConnectionError, EOFError, OSError) as e:
+        print(f"Error getting the server metrics: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,194 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from datetime import datetime
+import argparse
+import asyncio
+import os
+import socket
+import time
+
+DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+MAX_BATCH = 1000     # Maximum number of timestamps per batch request
 
 app = Flask(__name__)
 
+# Function to parse the n parameter of a batch request (1 if it is missing).
+# Returns None unless it is an integer between 1 and MAX_BATCH, so both
+# serving modes reject the same requests.
+def batch_size(value):
+    if value is None:
+        return 1
+    if not (value.isascii() and value.isdigit()):
+        return None
+    n = int(value)
+    return n if 1 <= n <= MAX_BATCH else None
+
 @app.route('/fecha', methods=['GET'])
 def get_date():
     # Get current date and time in DD/MM/YYYY HH:MM:SS format
-    current_date = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    current_date = datetime.now().strftime(DATE_FORMAT)
     return jsonify({"fecha": current_date})
 
+@app.route('/fecha/batch', methods=['GET'])
+def get_date_batch():
+    # Get n timestamps in a single request
+    n = batch_size(request.args.get('n'))
+    if n is None:
+        return jsonify({"error": f"n must be between 1 and {MAX_BATCH}"}), 400
+    current_date = datetime.now().strftime(DATE_FORMAT)
+    return jsonify({"fecha": [current_date] * n})
+
+
+# *
+# * @brief Production serving mode: asyncio HTTP/1.1 server with keep-alive.
+# *        The formatted date only changes once per second, so the response
+# *        bytes are rendered once per second and reused for every request.
+class DateServer:
+    def __init__(self):
+        self._date = None
+        self._response = None
+        self._batch_cache = {}
+        self.render()
+
+    # Function to render the cached responses for the current second
+    def render(self):
+        self._date = datetime.now().strftime(DATE_FORMAT)
+        self._response = self.build_response(200, f'{{"fecha": "{self._date}"}}')
+        self._batch_cache = {}
+
+    # Function to build a complete HTTP response with a JSON body
+    @staticmethod
+    def build_response(status, body):
+        reason = {200: "OK", 400: "BAD REQUEST", 404: "NOT FOUND", 405: "METHOD NOT ALLOWED"}[status]
+        body = body.encode()
+        return (f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+    # Task that re-renders the responses at every second boundary
+    async def refresh(self):
+        while True:
+            await asyncio.sleep(1 - time.time() % 1)
+            self.render()
+
+    # Function to get the response for a request target
+    def respond(self, method, target):
+        path, _, query = target.partition('?')
+        if path not in ('/fecha', '/fecha/batch'):
+            return self.build_response(404, '{"error": "not found"}')
+        if method != 'GET':
+            return self.build_response(405, '{"error": "method not allowed"}')
+        if path == '/fecha':
+            return self._response
+
+        value = None
+        for param in query.split('&'):
+            key, _, param_value = param.partition('=')
+            if key == 'n':
+                value = param_value
+                break
+        n = batch_size(value)
+        if n is None:
+            return self.build_response(400, f'{{"error": "n must be between 1 and {MAX_BATCH}"}}')
+        response = self._batch_cache.get(n)
+        if response is None:
+            dates = ', '.join([f'"{self._date}"'] * n)
+            response = self.build_response(200, f'{{"fecha": [{dates}]}}')
+            self._batch_cache[n] = response
+        return response
+
+    # Function to serve the requests of one connection until it is closed
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                parts = lines[0].split(' ')
+                if len(parts) != 3:
+                    break
+                method, target, version = parts
+
+                # HTTP/1.1 keeps the connection open unless asked otherwise
+                headers = {}
+                for line in lines[1:]:
+                    key, _, value = line.partition(':')
+                    headers[key.strip().lower()] = value.strip().lower()
+                connection = headers.get('connection', '')
+                keep_alive = (connection != 'close' if version == 'HTTP/1.1'
+                              else connection == 'keep-alive')
+
+                # Request bodies are not used, but must be skipped. Without a
+                # valid length the next request cannot be found.
+                try:
+                    length = int(headers.get('content-length', '0') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    response = self.build_response(400, '{"error": "invalid Content-Length"}')
+                    writer.write(response.replace(b'\r\n\r\n', b'\r\nConnection: close\r\n\r\n', 1))
+                    await writer.drain()
+                    break
+                if length:
+                    await reader.readexactly(length)
+
+                response = self.respond(method, target)
+                if not keep_alive:
+                    response = response.replace(b'\r\n\r\n', b'\r\nConnection: close\r\n\r\n', 1)
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, sock):
+        asyncio.create_task(self.refresh())
+        server = await asyncio.start_server(self.handle, sock=sock, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+
+# Function to run the production mode with pre-forked worker processes
+# sharing the listening socket
+def run_async(host, port, workers):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    print(f"Serving /fecha on {host}:{port} with {workers} worker(s)")
+
+    children = []
+    for _ in range(workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            children = []
+            break
+        children.append(pid)
+
+    try:
+        asyncio.run(DateServer().serve(sock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0', help='Listening address')
+    parser.add_argument('--port', type=int, default=5000, help='Listening port')
+    parser.add_argument('--mode', choices=['flask', 'async'], default='flask',
+                        help='flask: development server, async: production server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes in async mode')
+    args = parser.parse_args()
+
+    if args.mode == 'async':
+        run_async(args.host, args.port, max(1, args.workers))
+    else:
+        app.run(host=args.host, port=args.port)